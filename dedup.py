@@ -3,105 +3,1356 @@ Author: David Chaloupka
 Date:   18.8.2010 - 3.11.2016
 
 Description
-Finds duplicate files in the working directory and its subdirectories and
-interactively decides what to do with them.
-Matching of duplicates is performed first by file size and then by MD5 hash.
+Finds duplicate files in the given directories (the working directory by
+default) and their subdirectories and interactively decides what to do with
+them.
+Matching of duplicates is performed in stages, each stage only considering
+files that still collide after the previous one:
+  1) file size,
+  2) hash of the head and tail block of the file,
+  3) hash of chunks sampled evenly from the middle of the file,
+  4) hash of the full content (MD5 by default, see --hash),
+  5) optionally (--verify) byte-by-byte comparison of the files in a group.
+Reading a whole multi-gigabyte file is therefore only needed when its size,
+both ends and the samples all match another file.
+
+Computed digests can be kept in a persistent cache (--cache FILE), keyed by
+device, inode, size and modification time of the file, so that repeated scans
+of an unchanged tree don't need to read any file content.
+
+Hashing runs on a pool of threads per device; spinning disks get a single
+reader by default, other devices --workers readers.
+
+Paths of the same inode (hardlinks, or a symlink and its target) are treated
+as a single file.
+
+With --incremental FILE, the directories and files found are recorded in an
+index and the next scan doesn't list directories whose mtime hasn't changed,
+reusing their recorded content instead. Files modified in place (which
+doesn't change the mtime of their directory) keep their recorded stat, so it
+is checked against the file before the file is hashed and the file skipped if
+it has changed; deleting and linking always check the current state of all
+files of a group.
+
+A catalog of digests of all files under the given directories can be exported
+(--export-catalog FILE) and other trees then matched against one or more such
+catalogs (--catalog FILE) without walking the catalogued directories again.
+Copies are only deleted or linked with --verify, which compares them with the
+catalogued files, as those may have changed since the export.
+
+With --similar, images and videos are instead grouped by perceptual
+fingerprints, which finds also re-encoded or resized copies. Images are
+decoded by Pillow or ImageMagick, frames of videos by ffmpeg. Files similar
+through a chain of other files end up in one group, so similar groups are
+only reported or resolved interactively, never deleted or linked in batch.
+
+Instead of interactively resolving the groups, the duplicates can be deleted
+(--delete) or replaced by hardlinks or reflinks (--link) of the file chosen
+by the --keep and --prefer rules. With --report the groups are written to
+the standard output as JSON Lines or CSV as soon as they are found.
 '''
 
+import argparse
+import collections
+import csv
 import os
 import os.path
 import sys
 import re
-import itertools
+import shutil
+import subprocess
 import hashlib
+import itertools
+import json
+import errno
+import mmap
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# optional faster hash algorithms
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+# optional image decoder, ImageMagick is used without it
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# size of the block hashed at both the beginning and the end of a file
+HEAD_TAIL_BLOCK_SIZE = 64 * 1024
+# number and size of the chunks sampled from the middle of a file
+SAMPLE_CHUNK_COUNT = 16
+SAMPLE_CHUNK_SIZE = 64 * 1024
+# granularity of reads when hashing longer ranges of a file
+READ_CHUNK_SIZE = 1024 * 1024
+# number of hashing threads per non-rotational device
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+# factories of hash objects by algorithm name
+HASH_ALGORITHMS = {
+    "md5": hashlib.md5,
+    "blake2b": lambda: hashlib.blake2b(digest_size=16),
+}
+if xxhash:
+    HASH_ALGORITHMS["xxh128"] = xxhash.xxh3_128
+if blake3:
+    HASH_ALGORITHMS["blake3"] = blake3.blake3
+# algorithms provided by packages that may not be installed
+OPTIONAL_HASH_ALGORITHMS = ["xxh128", "blake3"]
+# stdlib algorithm used when an optional one is not available
+FALLBACK_HASH_ALGORITHM = "blake2b"
+# ioctl cloning a file into another one sharing its extents (Linux)
+FICLONE = 0x40049409
+# number of candidate files whose full content is hashed in one batch before
+# the confirmed groups are passed on
+FULL_HASH_BATCH_SIZE = 256
+
+# directories modified less than this before a scan started are listed again
+# by the next incremental scan, their mtime may not reflect a change made in
+# the same clock tick right after they were listed
+RACY_MTIME_WINDOW_NS = 2 * 10**9
+
+# files fingerprinted by --similar
+IMAGE_EXTENSIONS = {"bmp", "gif", "heic", "jpeg", "jpg", "png", "tif", "tiff", "webp"}
+VIDEO_EXTENSIONS = {"3gp", "asf", "avi", "flv", "webm", "mkv", "mp4", "mpeg", "mpg", "mov", "wmv"}
+# positions (fractions of the duration) of the video frames that are fingerprinted
+VIDEO_FRAME_POSITIONS = [0.1, 0.3, 0.5, 0.7, 0.9]
+# default maximal Hamming distance of similar images (per frame for videos), out of 64 bits
+DEFAULT_SIMILARITY_DISTANCE = 6
+
+# sort keys of the files of a group, the smallest one is kept
+KEEP_POLICIES = {
+    "first": lambda f: 0,
+    "oldest": lambda f: f.getMTimeNs(),
+    "newest": lambda f: -f.getMTimeNs(),
+    "shortest-path": lambda f: len(f.getPath()),
+    "largest": lambda f: -f.getSize(),
+}
 
 
 class FileInfo:
-    def __init__(self, path):
-        self._path = path
-        self._size = os.path.getsize(self._path)
-        self._md5 = None
+    # a scan holds one FileInfo per file, keep them small
+    __slots__ = ("_dir", "_name", "_size", "_device", "_inode", "_mtimeNs", "_nlink", "_links",
+                 "_digest", "_bytesRead", "_indexed")
+
+    def __init__(self, path, stat=None):
+        if stat is None:
+            stat = os.stat(path)
+        # the directory part is shared by all files of the directory
+        dirPath, self._name = os.path.split(path)
+        self._dir = sys.intern(dirPath)
+        self._size = stat.st_size
+        self._device = stat.st_dev
+        self._inode = stat.st_ino
+        self._mtimeNs = stat.st_mtime_ns
+        self._nlink = stat.st_nlink
+        # other paths hardlinked to the same inode, allocated when needed
+        self._links = None
+        # raw bytes of the full-content digest
+        self._digest = None
+        # number of bytes read from the file by the staged matching
+        self._bytesRead = 0
+        # the stat comes from a ScanIndex and hasn't been checked against the file
+        self._indexed = isinstance(stat, IndexedStat)
 
     def getSize(self):
         return self._size
     def getPath(self):
-        return self._path
-    def getMD5(self):
-        if self._md5 is None:
-            self._computeMD5()
-        return self._md5
-
-    def _computeMD5(self):
-        m = hashlib.md5()
-        f = None
-        try:
-            self._md5 = "error"
-            f = open(self._path, "rb")
-            buffer = f.read(1024)
-            while buffer:
-                m.update(buffer)
-                buffer = f.read(1024)
-            self._md5 = m.hexdigest()
-        except IOError:
-            self._md5 = "error"
-        finally:
-            f and f.close()
+        return os.path.join(self._dir, self._name)
+    def getDevice(self):
+        return self._device
+    def getInode(self):
+        return self._inode
+    def getMTimeNs(self):
+        return self._mtimeNs
+    def getPaths(self):
+        '''All known paths of the file, ie. including its hardlinks.'''
+        return [self.getPath()] + (self._links or [])
+    def getDigest(self):
+        '''Full-content digest; MD5 unless computed by a matcher using another algorithm.'''
+        if self._digest is None:
+            self._computeDigest()
+        return self._digest
+    def getHexDigest(self, compute=True):
+        '''Hex of the full-content digest; None if not computed yet and compute is false.'''
+        if not compute and self._digest is None:
+            return None
+        digest = self.getDigest()
+        return digest.hex() if digest != "error" else digest
+
+    def _computeDigest(self):
+        digest, _ = hashRanges(self.getPath(), [(0, self._size)])
+        self._digest = digest or "error"
 
     def __eq__(self, item):
         return (self._size == item._size
-                and self.getMD5() == item.getMD5()
-                and self.getMD5() != "error"
+                and self.getDigest() == item.getDigest()
+                and self.getDigest() != "error"
                 #and FileInfo.bitcmp(self.getPath(), item.getPath()) == 0
                 )
 
     def __repr__(self):
-        return "'%s' (%d B, md5: %s)" % (self._path, self._size, str(self._md5))
+        links = " +%d hardlinks" % len(self._links) if self._links else ""
+        digest = self._digest.hex() if isinstance(self._digest, bytes) else str(self._digest)
+        return "'%s' (%d B, digest: %s%s)" % (self.getPath(), self._size, digest, links)
 
     @staticmethod
     def bitcmp(file1, file2):
-        f1, f2 = None, None
+        '''Returns 0 when both files have the same content, 1 otherwise.'''
         try:
-            f1 = open(file1, "rb")
-            f2 = open(file2, "rb")
-            b1, b2 = f1.read(1), f2.read(1)
-            while b1 and b2:
-                if b1 != b2:
-                    return 1
-                b1, b2 = f1.read(1), f2.read(1)
-            if b1 == b2:
-                return 0
-            else:
-                return 1
-        except IOError:
+            return 0 if filesIdentical(file1, file2) else 1
+        except (IOError, ValueError):
             return 1
-        finally:
-            f1 and f1.close()
-            f2 and f2.close()
 
 
+def resolveHashAlgorithm(name):
+    '''Returns name of the algorithm to use in place of the requested one.'''
+    if name in HASH_ALGORITHMS:
+        return name
+    if name in OPTIONAL_HASH_ALGORITHMS:
+        print("Warning: hash algorithm '%s' is not installed, using '%s'" % (name, FALLBACK_HASH_ALGORITHM),
+              file=sys.stderr)
+        return FALLBACK_HASH_ALGORITHM
+    raise ValueError("Unknown hash algorithm '%s'" % name)
+
+def hashRanges(path, ranges, buffer=None, algorithm="md5"):
+    '''
+    Returns digest (raw bytes) of the given (offset, length) ranges of a file
+    together with the number of bytes read, or (None, bytesRead) when the
+    file cannot be read. The file is read into buffer (a writable memoryview),
+    which lets callers reuse one buffer for many files.
+    '''
+    if buffer is None:
+        buffer = memoryview(bytearray(READ_CHUNK_SIZE))
+    m = HASH_ALGORITHMS[algorithm]()
+    bytesRead = 0
+    try:
+        with open(path, "rb", buffering=0) as f:
+            for (offset, length) in ranges:
+                f.seek(offset)
+                while length > 0:
+                    n = f.readinto(buffer[:min(length, len(buffer))])
+                    if not n:
+                        break
+                    m.update(buffer[:n])
+                    bytesRead += n
+                    length -= n
+    except IOError:
+        return (None, bytesRead)
+    return (m.digest(), bytesRead)
+
+def filesIdentical(path1, path2):
+    '''
+    Compares content of two files chunk by chunk through mmap. Raises
+    IOError when a file cannot be read.
+    '''
+    with open(path1, "rb") as f1, open(path2, "rb") as f2:
+        size = os.fstat(f1.fileno()).st_size
+        if size != os.fstat(f2.fileno()).st_size:
+            return False
+        # empty files can't be mapped
+        if size == 0:
+            return True
+        with mmap.mmap(f1.fileno(), 0, access=mmap.ACCESS_READ) as m1, \
+             mmap.mmap(f2.fileno(), 0, access=mmap.ACCESS_READ) as m2:
+            for offset in range(0, size, READ_CHUNK_SIZE):
+                if m1[offset:offset + READ_CHUNK_SIZE] != m2[offset:offset + READ_CHUNK_SIZE]:
+                    return False
+    return True
+
+def headTailRanges(size):
+    # a file shorter than both blocks is hashed whole, which makes the digest
+    # equal to the full-content digest
+    if size <= 2 * HEAD_TAIL_BLOCK_SIZE:
+        return [(0, size)]
+    return [(0, HEAD_TAIL_BLOCK_SIZE), (size - HEAD_TAIL_BLOCK_SIZE, HEAD_TAIL_BLOCK_SIZE)]
+
+def sampleRanges(size):
+    middleStart = HEAD_TAIL_BLOCK_SIZE
+    middleSize = size - 2 * HEAD_TAIL_BLOCK_SIZE
+    if middleSize <= 0:
+        return []
+    if middleSize <= SAMPLE_CHUNK_COUNT * SAMPLE_CHUNK_SIZE:
+        return [(middleStart, middleSize)]
+    step = (middleSize - SAMPLE_CHUNK_SIZE) // (SAMPLE_CHUNK_COUNT - 1)
+    return [(middleStart + i * step, SAMPLE_CHUNK_SIZE) for i in range(SAMPLE_CHUNK_COUNT)]
+
+
+def grayThumbnail(path, width, height):
+    '''
+    Returns pixels of the image scaled to width x height in 8-bit grayscale,
+    row by row. Raises OSError when the image can't be decoded.
+    '''
+    if Image:
+        try:
+            with Image.open(path) as img:
+                return img.convert("L").resize((width, height)).tobytes()
+        except Exception as e:
+            # Pillow raises various exceptions on broken images
+            raise OSError(errno.EINVAL, str(e), path)
+    # "[0]" selects the first frame of animations
+    return _runDecoder(["convert", path + "[0]", "-colorspace", "Gray", "-resize", "%dx%d!" % (width, height),
+                        "-depth", "8", "gray:-"], width * height)
+
+def videoFrameThumbnail(path, seconds, width, height):
+    '''As grayThumbnail() for the frame of a video at the given time.'''
+    return _runDecoder(["ffmpeg", "-v", "error", "-ss", "%.3f" % seconds, "-i", path, "-frames:v", "1",
+                        "-vf", "scale=%d:%d,format=gray" % (width, height), "-f", "rawvideo", "-"], width * height)
+
+def videoDuration(path):
+    output = _runDecoder(["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path])
+    try:
+        return float(output)
+    except ValueError:
+        raise OSError(errno.EINVAL, "can't determine duration of the video", path)
+
+def _runDecoder(cmd, expectedSize=None):
+    '''Returns standard output of a decoder command, raises OSError when it fails.'''
+    if not shutil.which(cmd[0]):
+        raise OSError(errno.ENOENT, "decoder '%s' is not installed" % cmd[0])
+    result = subprocess.run(cmd, capture_output=True)
+    if result.returncode != 0 or (expectedSize is not None and len(result.stdout) != expectedSize):
+        raise OSError(errno.EINVAL, "'%s' failed: %s" % (cmd[0], result.stderr.decode(errors="replace").strip()))
+    return result.stdout
+
+def differenceHash(pixels, width=9, height=8):
+    '''
+    64-bit difference hash of a 9x8 grayscale thumbnail; each bit tells
+    whether a pixel is darker than its right neighbour.
+    '''
+    bits = 0
+    for y in range(height):
+        row = pixels[y * width:(y + 1) * width]
+        for x in range(width - 1):
+            bits = (bits << 1) | (row[x] < row[x + 1])
+    return bits
+
+def mediaKind(path):
+    ext = os.path.splitext(path)[1][1:].lower()
+    return "image" if ext in IMAGE_EXTENSIONS else "video" if ext in VIDEO_EXTENSIONS else None
+
+def perceptualFingerprint(path):
+    '''
+    Returns fingerprint of an image (difference hash, 8 bytes) or of a video
+    (difference hashes of frames at VIDEO_FRAME_POSITIONS), None for other
+    files. Raises OSError when the file can't be decoded.
+    '''
+    kind = mediaKind(path)
+    if kind == "image":
+        return differenceHash(grayThumbnail(path, 9, 8)).to_bytes(8, "big")
+    if kind == "video":
+        duration = videoDuration(path)
+        return b"".join(differenceHash(videoFrameThumbnail(path, duration * pos, 9, 8)).to_bytes(8, "big")
+                        for pos in VIDEO_FRAME_POSITIONS)
+    return None
+
+
+class BKTree:
+    '''
+    Burkhard-Keller tree of integer keys under the Hamming distance. A search
+    within a small radius visits only a fraction of the tree, which makes
+    finding all near pairs among n keys much cheaper than comparing all pairs.
+    '''
+    def __init__(self):
+        # node is [key, items, {distance: child node}]
+        self._root = None
+
+    def add(self, key, item):
+        if self._root is None:
+            self._root = [key, [item], {}]
+            return
+        node = self._root
+        while True:
+            d = (node[0] ^ key).bit_count()
+            if d == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [key, [item], {}]
+                return
+            node = child
+
+    def search(self, key, radius):
+        '''Returns items of all keys within radius from key.'''
+        result = []
+        stack = [self._root] if self._root else []
+        while stack:
+            node = stack.pop()
+            d = (node[0] ^ key).bit_count()
+            if d <= radius:
+                result.extend(node[1])
+            # by the triangle inequality only these children can hold keys within radius
+            for childDistance, child in node[2].items():
+                if d - radius <= childDistance <= d + radius:
+                    stack.append(child)
+        return result
+
+
+def isRotational(device):
+    '''
+    Tells whether the device with the given st_dev number is a spinning disk.
+    Only known on Linux, elsewhere the device is assumed not to be rotational.
+    '''
+    if not sys.platform.startswith("linux"):
+        return False
+    sysDir = "/sys/dev/block/%d:%d" % (os.major(device), os.minor(device))
+    # partitions don't have the queue directory, their parent disk does
+    for queueDir in [os.path.join(sysDir, "queue"), os.path.join(sysDir, "..", "queue")]:
+        try:
+            with open(os.path.join(queueDir, "rotational")) as f:
+                return f.read().strip() == "1"
+        except OSError:
+            pass
+    return False
+
+
+class HashingEngine:
+    '''
+    Hashes ranges of files on thread pools, one pool per device, so that the
+    number of outstanding reads can be bounded for each device separately.
+    Each thread reads into its own preallocated buffer.
+    '''
+    def __init__(self, workers=DEFAULT_WORKERS, deviceWorkers=None, algorithm="md5"):
+        self.algorithm = algorithm
+        self._workers = workers
+        # number of workers by st_dev, overrides the autodetection
+        self._deviceWorkers = deviceWorkers or {}
+        self._pools = {}
+        self._local = threading.local()
+
+    def workersFor(self, device):
+        if device in self._deviceWorkers:
+            return self._deviceWorkers[device]
+        return 1 if isRotational(device) else self._workers
+
+    def hashAll(self, jobs):
+        '''
+        Hashes (path, ranges, device) jobs. Returns a list of (digest, bytesRead)
+        pairs in the order of jobs, as returned by hashRanges.
+        '''
+        return self.runAll(self._hash, (((path, ranges), device) for (path, ranges, device) in jobs))
+
+    def runAll(self, func, jobs):
+        '''Runs func(*args) for (args, device) jobs on the pools, returns the results in order.'''
+        futures = [self._pool(device).submit(func, *args) for (args, device) in jobs]
+        return [future.result() for future in futures]
+
+    def _pool(self, device):
+        pool = self._pools.get(device)
+        if pool is None:
+            pool = ThreadPoolExecutor(self.workersFor(device), thread_name_prefix="hash-%d" % device)
+            self._pools[device] = pool
+        return pool
+
+    def _hash(self, path, ranges):
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            buffer = self._local.buffer = memoryview(bytearray(READ_CHUNK_SIZE))
+        return hashRanges(path, ranges, buffer, self.algorithm)
+
+    def close(self):
+        for pool in self._pools.values():
+            pool.shutdown()
+        self._pools = {}
+
+
+def _sqliteInt(value):
+    # SQLite integers are signed 64-bit, inode and device numbers are not
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def _fromSqliteInt(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+class HashCache:
+    '''
+    Persistent cache of file digests stored in an SQLite database. An entry
+    is identified by device and inode of the file and the hash algorithm and
+    is valid only as long as size and modification time of the file stay the
+    same. When the cache holds more than maxEntries entries, the least
+    recently used ones are evicted on close().
+    '''
+    # bumped on incompatible changes of the schema, an old cache is discarded
+    SCHEMA_VERSION = 4
+    # columns of the cached values by stage
+    STAGE_COLUMNS = {"head/tail": "head_tail", "samples": "samples", "full": "full", "fingerprint": "fingerprint"}
+
+    def __init__(self, path, maxEntries=None, algorithm="md5"):
+        self._maxEntries = maxEntries
+        self._algorithm = algorithm
+        self._db = sqlite3.connect(path)
+        if self._db.execute("PRAGMA user_version").fetchone()[0] != HashCache.SCHEMA_VERSION:
+            self._db.execute("DROP TABLE IF EXISTS digests")
+            self._db.execute("PRAGMA user_version = %d" % HashCache.SCHEMA_VERSION)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS digests (
+                device INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                algorithm TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                path TEXT NOT NULL,
+                head_tail BLOB,
+                samples BLOB,
+                full BLOB,
+                fingerprint BLOB,
+                last_used INTEGER NOT NULL,
+                PRIMARY KEY (device, inode, algorithm))""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS digests_last_used ON digests (last_used)")
+        row = self._db.execute("SELECT MAX(last_used) FROM digests").fetchone()
+        # LRU clock, one tick per run
+        self._now = (row[0] or 0) + 1
+        # entries of the files looked up during this run, by (device, inode, size, mtime)
+        self._entries = {}
+
+    def get(self, fileInfo, stage):
+        '''Returns the cached digest of the stage or None.'''
+        return self._entry(fileInfo).get(stage)
+
+    def put(self, fileInfo, stage, digest):
+        entry = self._entry(fileInfo)
+        entry[stage] = digest
+        self._db.execute(
+            "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            self._key(fileInfo) + (fileInfo.getSize(), fileInfo.getMTimeNs(), fileInfo.getPath())
+            + tuple(entry.get(stage) for stage in HashCache.STAGE_COLUMNS) + (self._now,))
+
+    def _entry(self, fileInfo):
+        key = self._key(fileInfo)
+        entry = self._entries.get(key + (fileInfo.getSize(), fileInfo.getMTimeNs()))
+        if entry is None:
+            entry = {}
+            row = self._db.execute(
+                "SELECT size, mtime_ns, %s FROM digests WHERE device = ? AND inode = ? AND algorithm = ?"
+                % ", ".join(HashCache.STAGE_COLUMNS.values()), key).fetchone()
+            # a changed file invalidates the whole entry
+            if row and row[0] == fileInfo.getSize() and row[1] == fileInfo.getMTimeNs():
+                entry = {stage: digest for stage, digest in zip(HashCache.STAGE_COLUMNS, row[2:]) if digest}
+                self._db.execute("UPDATE digests SET last_used = ?"
+                                 " WHERE device = ? AND inode = ? AND algorithm = ?", (self._now,) + key)
+            self._entries[key + (fileInfo.getSize(), fileInfo.getMTimeNs())] = entry
+        return entry
+
+    def _key(self, fileInfo):
+        return (_sqliteInt(fileInfo.getDevice()), _sqliteInt(fileInfo.getInode()), self._algorithm)
+
+    def prune(self):
+        '''Removes entries whose files no longer exist or have changed. Returns their number.'''
+        stale = []
+        for (rowid, device, inode, size, mtimeNs, path) in self._db.execute(
+                "SELECT rowid, device, inode, size, mtime_ns, path FROM digests").fetchall():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stale.append((rowid,))
+                continue
+            if ((_sqliteInt(stat.st_dev), _sqliteInt(stat.st_ino), stat.st_size, stat.st_mtime_ns)
+                    != (device, inode, size, mtimeNs)):
+                stale.append((rowid,))
+        self._db.executemany("DELETE FROM digests WHERE rowid = ?", stale)
+        return len(stale)
+
+    def evict(self):
+        '''Removes the least recently used entries over maxEntries. Returns their number.'''
+        if self._maxEntries is None:
+            return 0
+        count = self._db.execute("SELECT COUNT(*) FROM digests").fetchone()[0]
+        excess = count - self._maxEntries
+        if excess <= 0:
+            return 0
+        self._db.execute(
+            "DELETE FROM digests WHERE rowid IN (SELECT rowid FROM digests ORDER BY last_used LIMIT ?)",
+            (excess,))
+        return excess
+
+    def close(self):
+        self.evict()
+        self._db.commit()
+        self._db.close()
+
+
+# the fields of os.stat_result used by FileInfo
+IndexedStat = collections.namedtuple("IndexedStat", ["st_size", "st_dev", "st_ino", "st_mtime_ns", "st_nlink"])
+
+
+class ScanIndex:
+    '''
+    Directories and files found by the previous scans, stored in an SQLite
+    database, which lets walkFiles() skip listing directories whose mtime
+    hasn't changed since. Directories not seen by a scan are removed from
+    the index on close().
+    '''
+    SCHEMA_VERSION = 1
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path)
+        if self._db.execute("PRAGMA user_version").fetchone()[0] != ScanIndex.SCHEMA_VERSION:
+            self._db.execute("DROP TABLE IF EXISTS dirs")
+            self._db.execute("DROP TABLE IF EXISTS entries")
+            self._db.execute("PRAGMA user_version = %d" % ScanIndex.SCHEMA_VERSION)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS dirs (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER,
+                scan INTEGER NOT NULL)""")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                dir TEXT NOT NULL,
+                name TEXT NOT NULL,
+                is_dir INTEGER NOT NULL,
+                size INTEGER,
+                device INTEGER,
+                inode INTEGER,
+                mtime_ns INTEGER,
+                nlink INTEGER)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_dir ON entries (dir)")
+        row = self._db.execute("SELECT MAX(scan) FROM dirs").fetchone()
+        self._scan = (row[0] or 0) + 1
+        self._scanStartNs = time.time_ns()
+        self.dirsReused = 0
+        self.dirsListed = 0
+
+    def unchangedEntries(self, dirPath, mtimeNs):
+        '''
+        Returns [(name, stat or None for subdirectories)] recorded for the
+        directory, or None when it is not known or its mtime has changed.
+        '''
+        row = self._db.execute("SELECT mtime_ns FROM dirs WHERE path = ?", (dirPath,)).fetchone()
+        if not row or row[0] != mtimeNs:
+            return None
+        self._db.execute("UPDATE dirs SET scan = ? WHERE path = ?", (self._scan, dirPath))
+        self.dirsReused += 1
+        entries = []
+        for (name, isDir, size, device, inode, entryMTimeNs, nlink) in self._db.execute(
+                "SELECT name, is_dir, size, device, inode, mtime_ns, nlink FROM entries WHERE dir = ?", (dirPath,)):
+            stat = None if isDir else IndexedStat(size, _fromSqliteInt(device), _fromSqliteInt(inode), entryMTimeNs, nlink)
+            entries.append((name, stat))
+        return entries
+
+    def record(self, dirPath, mtimeNs, entries):
+        '''Records content of a listed directory, entries as in unchangedEntries().'''
+        self.dirsListed += 1
+        if mtimeNs >= self._scanStartNs - RACY_MTIME_WINDOW_NS:
+            mtimeNs = None
+        self._db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (dirPath, mtimeNs, self._scan))
+        self._db.execute("DELETE FROM entries WHERE dir = ?", (dirPath,))
+        self._db.executemany(
+            "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(dirPath, name, 1, None, None, None, None, None) if stat is None else
+             (dirPath, name, 0, stat.st_size, _sqliteInt(stat.st_dev), _sqliteInt(stat.st_ino),
+              stat.st_mtime_ns, stat.st_nlink)
+             for (name, stat) in entries])
+
+    def close(self):
+        self._db.execute("DELETE FROM entries WHERE dir IN (SELECT path FROM dirs WHERE scan != ?)", (self._scan,))
+        self._db.execute("DELETE FROM dirs WHERE scan != ?", (self._scan,))
+        self._db.commit()
+        self._db.close()
+
+
+class Catalog:
+    '''
+    Sizes, digests and paths of files under some directories, stored in an
+    SQLite database and indexed by size and digests, so that files of other
+    trees can be looked up without walking the catalogued directories.
+    '''
+    SCHEMA_VERSION = 1
+    # digest columns in the order of the matching stages
+    DIGEST_COLUMNS = ["head_tail", "samples", "full"]
+
+    def __init__(self, path, algorithm=None):
+        '''Opens a catalog; algorithm must be given when creating a new one.'''
+        self._db = sqlite3.connect(path)
+        version = self._db.execute("PRAGMA user_version").fetchone()[0]
+        if version not in [0, Catalog.SCHEMA_VERSION]:
+            raise ValueError("Unsupported version %d of catalog '%s'" % (version, path))
+        self._db.execute("PRAGMA user_version = %d" % Catalog.SCHEMA_VERSION)
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                size INTEGER NOT NULL,
+                head_tail BLOB NOT NULL,
+                samples BLOB NOT NULL,
+                full BLOB NOT NULL,
+                path TEXT NOT NULL)""")
+        # any prefix of the index serves the lookups of the matching stages
+        self._db.execute("CREATE INDEX IF NOT EXISTS files_digests ON files (size, head_tail, samples, full)")
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'algorithm'").fetchone()
+        if row is None:
+            if algorithm is None:
+                raise ValueError("'%s' is not a catalog" % path)
+            self._db.execute("INSERT INTO meta VALUES ('algorithm', ?)", (algorithm,))
+            row = (algorithm,)
+        self.algorithm = row[0]
+
+    def clear(self):
+        self._db.execute("DELETE FROM files")
+
+    def addAll(self, records):
+        '''Adds (size, headTail, samples, full, path) records.'''
+        self._db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?)", records)
+
+    def contains(self, size, *digests):
+        '''Tells whether there is a file of the size and with the leading digests (in DIGEST_COLUMNS order).'''
+        where = "".join(" AND %s = ?" % c for c in Catalog.DIGEST_COLUMNS[:len(digests)])
+        return self._db.execute("SELECT 1 FROM files WHERE size = ?%s LIMIT 1" % where,
+                                (size,) + digests).fetchone() is not None
+
+    def paths(self, size, headTail, samples, full):
+        return [row[0] for row in self._db.execute(
+            "SELECT path FROM files WHERE size = ? AND head_tail = ? AND samples = ? AND full = ?",
+            (size, headTail, samples, full))]
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+
+class StageStats:
+    '''Accounting of a single stage of the duplicate matching.'''
+    def __init__(self, name):
+        self.name = name
+        self.filesIn = 0
+        self.filesEliminated = 0
+        self.cacheHits = 0
+        self.bytesRead = 0
+        # bytes that a full-content hash of the eliminated files would have
+        # needed to read on top of what has already been read
+        self.bytesAvoided = 0
+
+    def __repr__(self):
+        return "%s: %d files in, %d eliminated, %d cache hits, %d B read, %d B avoided" % (
+            self.name, self.filesIn, self.filesEliminated, self.cacheHits, self.bytesRead, self.bytesAvoided)
+
+
+class DuplicateMatcher:
+    '''
+    Groups files into groups of identical files. Each stage splits the groups
+    of candidates of the previous stage by a more expensive key and drops
+    the files that ended up without a pair.
+    '''
+    STAGES = ["size", "head/tail", "samples", "full", "verify", "fingerprint"]
+
+    def __init__(self, cache=None, engine=None, verify=False, similar=False):
+        optional = {"verify": verify, "fingerprint": similar}
+        self.stats = [StageStats(name) for name in DuplicateMatcher.STAGES if optional.get(name, True)]
+        # paths merged into another FileInfo because they share its inode
+        self.hardlinksCollapsed = 0
+        self._cache = cache
+        self._engine = engine or HashingEngine()
+        self._verify = verify
+
+    def findGroups(self, files):
+        '''
+        Returns groups of identical files among files, which may be any
+        iterable, eg. the walkFiles() generator.
+        '''
+        return list(self.iterGroups(files))
+
+    def iterGroups(self, files):
+        '''
+        Yields groups of identical files among files. The last stages run in
+        batches of FULL_HASH_BATCH_SIZE files and each batch yields its groups
+        before the next one is hashed.
+        '''
+        sizeStats, headTailStats, sampleStats, fullStats = self.stats[:4]
+
+        groups = self._sizeGroups(files, sizeStats)
+        groups = self._refine(groups, self._headTailKeys, headTailStats)
+        groups = self._refine(groups, self._sampleKeys, sampleStats)
+        batch, batchSize = [], 0
+        for group in groups + [None]:
+            if group is not None:
+                batch.append(group)
+                batchSize += len(group)
+            if batch and (group is None or batchSize >= FULL_HASH_BATCH_SIZE):
+                confirmed = self._refine(batch, self._fullKeys, fullStats)
+                if self._verify:
+                    confirmed = self._verifyGroups(confirmed, self.stats[4])
+                yield from confirmed
+                batch, batchSize = [], 0
+
+    def iterSimilarGroups(self, files, maxDistance=DEFAULT_SIMILARITY_DISTANCE):
+        '''
+        Yields groups of images and videos whose perceptual fingerprints differ
+        in at most maxDistance bits (per frame for videos). Files similar
+        through a chain of other files are in the same group. Other files are
+        ignored.
+        '''
+        stats = next(s for s in self.stats if s.name == "fingerprint")
+        media = [f for f in files if mediaKind(f.getPath())]
+        stats.filesIn += len(media)
+        fingerprints = self._fingerprints(media, stats)
+
+        # union-find of the files with a near pair
+        parent = list(range(len(media)))
+        def root(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        # separate trees for images and videos, their fingerprints differ in length
+        trees = {}
+        for i, fp in enumerate(fingerprints):
+            if fp is None:
+                continue
+            tree = trees.setdefault(len(fp), BKTree())
+            key = int.from_bytes(fp, "big")
+            for j in tree.search(key, maxDistance * (len(fp) // 8)):
+                parent[root(i)] = root(j)
+            tree.add(key, i)
+
+        groups = {}
+        for i, fp in enumerate(fingerprints):
+            if fp is not None:
+                groups.setdefault(root(i), []).append(media[i])
+        stats.filesEliminated += fingerprints.count(None)
+        for group in groups.values():
+            if len(group) > 1:
+                yield group
+            else:
+                stats.filesEliminated += 1
+
+    def _fingerprints(self, files, stats):
+        '''Returns fingerprints of files, None for files that can't be decoded.'''
+        fingerprints = [None] * len(files)
+        jobs = []
+        for i, f in enumerate(files):
+            if not self._statCurrent(f):
+                continue
+            cached = self._cache and self._cache.get(f, "fingerprint")
+            if cached:
+                stats.cacheHits += 1
+                fingerprints[i] = cached
+            else:
+                jobs.append(i)
+        def fingerprint(path):
+            try:
+                return perceptualFingerprint(path)
+            except OSError as e:
+                print("Warning: can't fingerprint \"%s\" (%s)" % (path, str(e)), file=sys.stderr)
+                return None
+        results = self._engine.runAll(fingerprint, (((files[i].getPath(),), files[i].getDevice()) for i in jobs))
+        for i, fp in zip(jobs, results):
+            if fp is not None and self._cache:
+                self._cache.put(files[i], "fingerprint", fp)
+            fingerprints[i] = fp
+        return fingerprints
+
+    def exportCatalog(self, files, catalog):
+        '''Computes all digests of all files and stores them in the catalog.'''
+        sizeStats = self.stats[0]
+        for batch in _batches(files, FULL_HASH_BATCH_SIZE):
+            sizeStats.filesIn += len(batch)
+            keys = self._stageKeys(batch, [self._headTailKeys, self._sampleKeys, self._fullKeys])
+            catalog.addAll((f.getSize(),) + k + (f.getPath(),) for f, k in zip(batch, keys) if None not in k)
+
+    def iterCatalogMatches(self, files, catalogs):
+        '''
+        Yields groups of files that are already in any of the catalogs, each
+        group starts with a FileInfo of the catalogued file. A file passes to
+        the next stage only if some catalogued file has the same size and
+        digests so far; files with a size not in the catalogs are never read.
+        The catalogued file must still exist with the catalogued size (the
+        first such path is used), otherwise the group is skipped; with verify
+        the files must also be byte-identical to it. Scanned paths of the
+        catalogued file are dropped and linked files collapsed.
+        '''
+        sizeStats, headTailStats, sampleStats, fullStats = self.stats[:4]
+        known = lambda f, *digests: any(c.contains(f.getSize(), *digests) for c in catalogs)
+        for batch in _batches(files, FULL_HASH_BATCH_SIZE):
+            candidates = self._filterKnown([(f, ()) for f in batch], None, sizeStats, known)
+            candidates = self._filterKnown(candidates, self._headTailKeys, headTailStats, known)
+            candidates = self._filterKnown(candidates, self._sampleKeys, sampleStats, known)
+            candidates = self._filterKnown(candidates, self._fullKeys, fullStats, known)
+            groups = {}
+            for f, digests in candidates:
+                groups.setdefault((f.getSize(),) + digests, []).append(f)
+            for (size, headTail, samples, full), group in groups.items():
+                paths = [p for c in catalogs for p in c.paths(size, headTail, samples, full)]
+                catalogued = self._cataloguedFile(paths, size)
+                if catalogued is None:
+                    print("Warning: catalogued \"%s\" is missing or has changed, skipping its copies" % paths[0],
+                          file=sys.stderr)
+                    continue
+                catalogued._digest = full
+                # the catalogued file itself (or a link to it) may be among the
+                # scanned files, it must never be reported as its own copy
+                inode = (catalogued.getDevice(), catalogued.getInode())
+                group = self._collapseLinks([f for f in group if (f.getDevice(), f.getInode()) != inode], fullStats)
+                if not group:
+                    continue
+                if self._verify:
+                    group = self._verifyGroups([[catalogued] + group], self.stats[4])
+                    if group and group[0][0] is catalogued:
+                        yield group[0]
+                else:
+                    yield [catalogued] + group
+
+    @staticmethod
+    def _cataloguedFile(paths, size):
+        '''Returns FileInfo of the first of paths that exists and has the size, or None.'''
+        for path in paths:
+            try:
+                f = FileInfo(path)
+            except OSError:
+                continue
+            if f.getSize() == size:
+                return f
+        return None
+
+    def _stageKeys(self, files, keysOfStages):
+        '''Returns tuples of keys of all the stages for each of files.'''
+        keys = [() for _ in files]
+        for keysOf, stats in zip(keysOfStages, self.stats[1:]):
+            bytesBefore = sum(f._bytesRead for f in files)
+            keys = [k + (stageKey,) for k, stageKey in zip(keys, keysOf(files))]
+            stats.filesIn += len(files)
+            stats.bytesRead += sum(f._bytesRead for f in files) - bytesBefore
+        return keys
+
+    def _filterKnown(self, candidates, keysOf, stats, known):
+        '''
+        Extends digests of (file, digests) candidates by keys of the stage
+        (unless keysOf is None) and keeps those for which known(file, *digests).
+        '''
+        files = [f for f, _ in candidates]
+        stats.filesIn += len(files)
+        if keysOf is not None:
+            bytesBefore = sum(f._bytesRead for f in files)
+            candidates = [(f, digests + (k,)) for (f, digests), k in zip(candidates, keysOf(files))]
+            stats.bytesRead += sum(f._bytesRead for f in files) - bytesBefore
+        result = []
+        for f, digests in candidates:
+            if None not in digests and known(f, *digests):
+                result.append((f, digests))
+            else:
+                stats.filesEliminated += 1
+                stats.bytesAvoided += max(0, f.getSize() - f._bytesRead)
+        return result
+
+    def _verifyGroups(self, groups, stats):
+        '''Splits groups into groups of files with byte-identical content.'''
+        result = []
+        for group in groups:
+            stats.filesIn += len(group)
+            while len(group) > 1:
+                first, identical, rest = group[0], [group[0]], []
+                for f in group[1:]:
+                    try:
+                        same = filesIdentical(first.getPath(), f.getPath())
+                    except (IOError, ValueError):
+                        same = False
+                    stats.bytesRead += 2 * f.getSize()
+                    (identical if same else rest).append(f)
+                if len(identical) > 1:
+                    result.append(identical)
+                else:
+                    stats.filesEliminated += 1
+                group = rest
+            stats.filesEliminated += len(group)
+        return result
+
+    def _sizeGroups(self, files, stats):
+        # bucketing consumes files one by one as they are found; a bucket holds
+        # the only file of its size directly and becomes a list on collision
+        buckets = {}
+        for f in files:
+            stats.filesIn += 1
+            bucket = buckets.get(f.getSize())
+            if bucket is None:
+                buckets[f.getSize()] = f
+            elif isinstance(bucket, list):
+                bucket.append(f)
+            else:
+                buckets[f.getSize()] = [bucket, f]
+        result = []
+        for bucket in buckets.values():
+            group = self._collapseLinks(bucket, stats) if isinstance(bucket, list) else [bucket]
+            if len(group) > 1:
+                result.append(group)
+            else:
+                stats.filesEliminated += 1
+                stats.bytesAvoided += group[0].getSize()
+        return result
+
+    def _collapseLinks(self, files, stats):
+        '''
+        Merges files of the same (device, inode) into the first of them, the
+        other paths are attached to it instead of being matched (and hashed)
+        again. Besides hardlinks these are symlinks followed by the walk and
+        files reached through overlapping directories, whatever their nlink;
+        all of them have the same size, so this runs within size buckets.
+        '''
+        byInode = {}
+        for f in files:
+            first = byInode.setdefault((f.getDevice(), f.getInode()), f)
+            if first is not f:
+                first._links = (first._links or []) + f.getPaths()
+                self.hardlinksCollapsed += 1
+                stats.filesIn -= 1
+        return list(byInode.values())
+
+    def _refine(self, groups, keysOf, stats):
+        # keys of all candidates are computed in one batch so that they can be
+        # hashed in parallel
+        candidates = [f for group in groups for f in group]
+        bytesBefore = sum(f._bytesRead for f in candidates)
+        keys = iter(keysOf(candidates))
+        stats.filesIn += len(candidates)
+        stats.bytesRead += sum(f._bytesRead for f in candidates) - bytesBefore
+
+        result = []
+        for group in groups:
+            buckets = {}
+            for f in group:
+                k = next(keys)
+                # unreadable files can't be matched with anything
+                if k is None:
+                    stats.filesEliminated += 1
+                    continue
+                buckets.setdefault(k, []).append(f)
+            for bucket in buckets.values():
+                if len(bucket) > 1:
+                    result.append(bucket)
+                else:
+                    stats.filesEliminated += 1
+                    stats.bytesAvoided += max(0, bucket[0].getSize() - bucket[0]._bytesRead)
+        return result
+
+    def _digests(self, files, stage, rangesOf):
+        '''
+        Returns digests of the ranges of files given by rangesOf(size),
+        taking them from the cache when possible.
+        '''
+        digests = [None] * len(files)
+        jobs = []
+        for i, f in enumerate(files):
+            if not self._statCurrent(f):
+                continue
+            if self._cache:
+                digest = self._cache.get(f, stage)
+                if digest is not None:
+                    self.stats[DuplicateMatcher.STAGES.index(stage)].cacheHits += 1
+                    digests[i] = digest
+                    continue
+            jobs.append((i, f))
+
+        results = self._engine.hashAll((f.getPath(), rangesOf(f.getSize()), f.getDevice()) for (_, f) in jobs)
+        for (i, f), (digest, bytesRead) in zip(jobs, results):
+            f._bytesRead += bytesRead
+            if self._cache and digest is not None:
+                self._cache.put(f, stage, digest)
+            digests[i] = digest
+        return digests
+
+    @staticmethod
+    def _statCurrent(f):
+        '''
+        Returns whether the file may be hashed by its stat. A file modified in
+        place keeps its old stat in the ScanIndex, hashing it by the old size
+        (or caching it under the old stat) would match its old content, so
+        such a file is checked first and skipped if it has changed.
+        '''
+        if f._indexed:
+            try:
+                statUnchanged(f, f.getPath())
+            except OSError as e:
+                print("Warning: skipping \"%s\" (%s)" % (f.getPath(), str(e)), file=sys.stderr)
+                return False
+            f._indexed = False
+        return True
+
+    def _headTailKeys(self, files):
+        digests = self._digests(files, "head/tail", headTailRanges)
+        for f, digest in zip(files, digests):
+            if digest is not None and headTailRanges(f.getSize()) == [(0, f.getSize())]:
+                f._digest = digest
+        return digests
+
+    def _sampleKeys(self, files):
+        sampled = [f for f in files if sampleRanges(f.getSize())]
+        digests = dict(zip(map(id, sampled), self._digests(sampled, "samples", sampleRanges)))
+        return [digests.get(id(f), b"") for f in files]
+
+    def _fullKeys(self, files):
+        unhashed = [f for f in files if f._digest is None]
+        for f, digest in zip(unhashed, self._digests(unhashed, "full", lambda size: [(0, size)])):
+            f._digest = digest or "error"
+        return [f._digest if f._digest != "error" else None for f in files]
+
+
+def _batches(iterable, size):
+    it = iter(iterable)
+    batch = list(itertools.islice(it, size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(it, size))
+
+def cloneFile(source, target):
+    '''Creates target as a reflink of source (shares extents; Linux only).'''
+    if fcntl is None or not sys.platform.startswith("linux"):
+        raise OSError(errno.EOPNOTSUPP, "reflinks are not supported on this OS")
+    with open(source, "rb") as src, open(target, "xb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(target)
+            raise
+
+def statUnchanged(fileInfo, path):
+    '''Returns fresh stat of path, raises OSError if the file has changed since the scan.'''
+    stat = os.stat(path)
+    if (stat.st_size, stat.st_mtime_ns) != (fileInfo.getSize(), fileInfo.getMTimeNs()):
+        raise OSError(errno.EAGAIN, "file changed since it was scanned", path)
+    return stat
+
+def copyMetadata(stat, path):
+    '''
+    Gives path the owner (as far as permitted), permissions and times from
+    stat of another file.
+    '''
+    if hasattr(os, "chown"):
+        try:
+            os.chown(path, stat.st_uid, stat.st_gid)
+        except PermissionError:
+            # only root can give a file away, the group may still be allowed
+            try:
+                os.chown(path, -1, stat.st_gid)
+            except PermissionError:
+                pass
+    # after chown, which may clear the setuid and setgid bits
+    os.chmod(path, stat.st_mode & 0o7777)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+def replaceWithLink(keep, duplicate, method):
+    '''
+    Atomically replaces all paths of duplicate by a hardlink (method "hard")
+    or a reflink (method "reflink") of keep. A reflink is a new file, it
+    gets the owner, permissions and times of the duplicate. Raises OSError
+    when the duplicate has changed since it was scanned or the link can't be
+    made.
+    '''
+    for path in duplicate.getPaths():
+        stat = statUnchanged(duplicate, path)
+        tmpPath = os.path.join(os.path.dirname(path), ".%s.dedup-tmp" % os.path.basename(path))
+        if method == "hard":
+            os.link(keep.getPath(), tmpPath)
+        else:
+            cloneFile(keep.getPath(), tmpPath)
+        try:
+            if method != "hard":
+                copyMetadata(stat, tmpPath)
+            os.replace(tmpPath, path)
+        except OSError:
+            os.remove(tmpPath)
+            raise
+
+def orderByKeepPolicy(group, policy="first", preferredPrefixes=()):
+    '''
+    Returns files of the group ordered so that the file to keep is the first
+    one. A file under an earlier of preferredPrefixes wins, files under the
+    same prefix are ordered by the policy (see KEEP_POLICIES).
+    '''
+    prefixes = [os.path.normpath(p) for p in preferredPrefixes]
+    def prefixRank(f):
+        path = os.path.normpath(f.getPath())
+        for i, prefix in enumerate(prefixes):
+            if path == prefix or path.startswith(prefix.rstrip(os.sep) + os.sep):
+                return i
+        return len(prefixes)
+    return sorted(group, key=lambda f: (prefixRank(f), KEEP_POLICIES[policy](f)))
+
+def resolveGroup(group, action, linkMethod=None):
+    '''
+    Deletes (action "delete") or replaces by links (action "link") all files
+    of the group but the first one; does nothing for action None. Nothing is
+    done when the first file has changed since it was scanned. Returns the
+    number of bytes reclaimed and a list of (path, error message) of the files
+    that failed.
+    '''
+    reclaimed, errors = 0, []
+    if action is None:
+        return (reclaimed, errors)
+    keep = group[0]
+    try:
+        statUnchanged(keep, keep.getPath())
+    except OSError as e:
+        # the duplicates may be the only copies of what keep contained
+        return (reclaimed, [(d.getPath(), "kept file: %s" % str(e)) for d in group[1:]])
+    for duplicate in group[1:]:
+        try:
+            if action == "delete":
+                for path in duplicate.getPaths():
+                    statUnchanged(duplicate, path)
+                    os.remove(path)
+            else:
+                replaceWithLink(keep, duplicate, linkMethod)
+        except OSError as e:
+            errors.append((duplicate.getPath(), str(e)))
+            continue
+        reclaimed += duplicate.getSize()
+    return (reclaimed, errors)
+
+
+class JsonLinesReport:
+    '''Writes one JSON object per group of duplicates.'''
+    def __init__(self, out):
+        self._out = out
+
+    def write(self, group, action, reclaimed, errors):
+        record = {
+            "size": group[0].getSize(),
+            # not computed for groups of similar files
+            "digest": group[0].getHexDigest(compute=False),
+            "keep": group[0].getPath(),
+            "duplicates": [path for f in group[1:] for path in f.getPaths()],
+            "action": action,
+            "reclaimed": reclaimed,
+            "errors": dict(errors),
+        }
+        self._out.write(json.dumps(record) + "\n")
+        self._out.flush()
+
+
+class CsvReport:
+    '''Writes one CSV row per path of a group of duplicates.'''
+    def __init__(self, out):
+        self._out = out
+        self._writer = csv.writer(out)
+        self._writer.writerow(["group", "size", "digest", "role", "path", "action", "error"])
+        self._groups = 0
+
+    def write(self, group, action, reclaimed, errors):
+        self._groups += 1
+        errors = dict(errors)
+        for i, f in enumerate(group):
+            for path in f.getPaths():
+                self._writer.writerow([self._groups, f.getSize(), f.getHexDigest(compute=False), "keep" if i == 0 else "duplicate",
+                                       path, action if i else "", errors.get(f.getPath(), "")])
+        self._out.flush()
+
+
+REPORT_FORMATS = {"jsonl": JsonLinesReport, "csv": CsvReport}
+
+
+def runBatch(groups, report=None, action=None, linkMethod=None, keepPolicy="first", preferredPrefixes=(),
+             keepFirst=False):
+    '''
+    Resolves groups without asking, as they come. With keepFirst, the first
+    file of each group is kept regardless of the keep policy. Returns number
+    of groups and total number of bytes reclaimed.
+    '''
+    groupCount, totalReclaimed = 0, 0
+    for group in groups:
+        if keepFirst:
+            group = group[:1] + orderByKeepPolicy(group[1:], keepPolicy, preferredPrefixes)
+        else:
+            group = orderByKeepPolicy(group, keepPolicy, preferredPrefixes)
+        reclaimed, errors = resolveGroup(group, action, linkMethod)
+        for (path, error) in errors:
+            print("Error: can't %s \"%s\" (%s)" % (action, path, error), file=sys.stderr)
+        if report:
+            report.write(group, action, reclaimed, errors)
+        groupCount += 1
+        totalReclaimed += reclaimed
+    return (groupCount, totalReclaimed)
+
+def walkFiles(rootDir, index=None):
+    '''
+    Lazily yields FileInfo of every file in rootDir and its subdirectories.
+    Directories are listed by os.scandir from an explicit stack, so the depth
+    of the tree is not limited by recursion. Symlinks are followed, but each
+    directory is entered only once, which also breaks symlink loops.
+    With a ScanIndex, directories that haven't changed since the previous
+    scan are not listed, their recorded content is used instead.
+    '''
+    # on Windows DirEntry.stat() doesn't fill in st_dev and st_ino
+    useEntryStat = os.name != "nt"
+    rootStat = os.stat(rootDir)
+    visited = {(rootStat.st_dev, rootStat.st_ino)}
+    stack = [(rootDir, rootStat.st_mtime_ns)]
+
+    def enter(path, stat):
+        if (stat.st_dev, stat.st_ino) not in visited:
+            visited.add((stat.st_dev, stat.st_ino))
+            stack.append((path, stat.st_mtime_ns))
+
+    while stack:
+        dirPath, mtimeNs = stack.pop()
+        known = index and index.unchangedEntries(dirPath, mtimeNs)
+        if known is not None:
+            for (name, stat) in known:
+                path = os.path.join(dirPath, name)
+                if stat is not None:
+                    yield FileInfo(path, stat)
+                    continue
+                try:
+                    enter(path, os.stat(path))
+                except OSError:
+                    continue
+            continue
+
+        try:
+            it = os.scandir(dirPath)
+        except OSError as e:
+            print("Warning: can't list \"%s\" (%s)" % (dirPath, str(e)), file=sys.stderr)
+            continue
+        entries = []
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_file():
+                        f = FileInfo(entry.path, entry.stat() if useEntryStat else None)
+                        if index:
+                            entries.append((entry.name, IndexedStat(f.getSize(), f.getDevice(), f.getInode(),
+                                                                    f.getMTimeNs(), f._nlink)))
+                        yield f
+                    elif entry.is_dir():
+                        enter(entry.path, entry.stat() if useEntryStat else os.stat(entry.path))
+                        entries.append((entry.name, None))
+                except OSError:
+                    # vanished or broken entry
+                    continue
+        if index:
+            index.record(dirPath, mtimeNs, entries)
+
 def listAllFiles(rootDir):
-    entries = [os.path.join(rootDir, e) for e in os.listdir(rootDir)]
-    files = [FileInfo(item) for item in entries if os.path.isfile(item)]
-    for subdir in [item for item in entries if os.path.isdir(item)]:
-        files.extend(listAllFiles(subdir))
-    return files
-
-def groupsWithDuplicates(files):
-    # first group by file size...
-    # sort required by itertools.groupby
-    files.sort(key=lambda f: f.getSize())
-    equiSizeGroups = [list(group) for _, group in itertools.groupby(files, lambda f: f.getSize())]
-    equiSizeGroups = [g for g in equiSizeGroups if len(g) > 1]
-
-    # ...then group based on md5
-    duplicateGroups = []
-    for equiSizeGroup in equiSizeGroups:
-        equiSizeGroup.sort(key=lambda f: f.getMD5())
-        equiMD5Groups = [list(group) for _, group in itertools.groupby(equiSizeGroup, lambda f: f.getMD5())]
-        equiMD5Groups = [g for g in equiMD5Groups if len(g) > 1]
-        duplicateGroups.extend(equiMD5Groups)
-
-    return duplicateGroups
+    return list(walkFiles(rootDir))
+
+def groupsWithDuplicates(files, matcher=None):
+    if matcher is None:
+        engine = HashingEngine()
+        try:
+            return DuplicateMatcher(engine=engine).findGroups(files)
+        finally:
+            engine.close()
+    return matcher.findGroups(files)
+
+def printStageReport(stats, out=sys.stdout):
+    print("%-10s %10s %10s %10s %16s %16s" % ("Stage", "Files", "Eliminated", "Cached", "Bytes read", "Bytes avoided"),
+          file=out)
+    for s in stats:
+        print("%-10s %10d %10d %10d %16d %16d" % (s.name, s.filesIn, s.filesEliminated, s.cacheHits, s.bytesRead, s.bytesAvoided),
+              file=out)
 
 def openFile(file):
     if sys.platform == "linux":
@@ -114,11 +1365,127 @@ def openFile(file):
         raise Error("Unknown Operating system '%s'" % sys.platform)
 
 if __name__ == "__main__":
-    files = listAllFiles(".")
-    groups = groupsWithDuplicates(files)
+    parser = argparse.ArgumentParser(
+        description="Finds duplicate files in the given directories and their subdirectories.")
+    parser.add_argument("dirs", nargs="*", default=["."], help="directories to scan (default: working directory)")
+    parser.add_argument("--cache", metavar="FILE", help="persistent cache of file digests (SQLite database)")
+    parser.add_argument("--cache-max-entries", type=int, metavar="N",
+                        help="evict least recently used cache entries over N")
+    parser.add_argument("--cache-prune", action="store_true",
+                        help="remove cache entries of missing or changed files and exit")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, metavar="N",
+                        help="hashing threads per non-rotational device (default: %(default)d)")
+    parser.add_argument("--device-workers", action="append", default=[], metavar="PATH=N",
+                        help="hashing threads for the device holding PATH, can be repeated")
+    parser.add_argument("--hash", default="md5", choices=["md5", "blake2b"] + OPTIONAL_HASH_ALGORITHMS,
+                        help="hash algorithm, unavailable optional ones fall back to %s (default: %%(default)s)"
+                        % FALLBACK_HASH_ALGORITHM)
+    parser.add_argument("--verify", action="store_true",
+                        help="confirm duplicates by byte-by-byte comparison")
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument("--delete", action="store_true",
+                        help="delete duplicates without asking")
+    action.add_argument("--link", choices=["hard", "reflink"],
+                        help="replace duplicates by hardlinks or reflinks without asking")
+    parser.add_argument("--keep", choices=sorted(KEEP_POLICIES), default="first",
+                        help="which file of a group to keep with --delete and --link (default: %(default)s)")
+    parser.add_argument("--prefer", action="append", default=[], metavar="PREFIX",
+                        help="keep files under PREFIX in the first place, can be repeated in order of priority")
+    parser.add_argument("--report", choices=sorted(REPORT_FORMATS),
+                        help="write groups to the standard output as they are found, without asking")
+    parser.add_argument("--incremental", metavar="FILE",
+                        help="index of the scanned tree (SQLite database), unchanged directories are not listed"
+                        " again; best combined with --cache")
+    parser.add_argument("--export-catalog", metavar="FILE",
+                        help="write digests of all files to the catalog FILE (SQLite database) and exit")
+    parser.add_argument("--catalog", action="append", default=[], metavar="FILE",
+                        help="only find files already in the catalog FILE, which is kept in each group;"
+                        " can be repeated")
+    parser.add_argument("--similar", action="store_true",
+                        help="group similar images and videos by perceptual fingerprints instead of identical files")
+    parser.add_argument("--similar-distance", type=int, default=DEFAULT_SIMILARITY_DISTANCE, metavar="BITS",
+                        help="maximal difference of fingerprints of similar files, out of 64 bits per image or"
+                        " video frame (default: %(default)d)")
+    args = parser.parse_args()
+    if args.similar and (args.delete or args.link or args.catalog or args.export_catalog):
+        # similarity is transitive through chains of files, a group may hold clearly different images
+        parser.error("--similar can't be combined with --delete, --link, --catalog or --export-catalog")
+    if args.catalog and (args.delete or args.link) and not args.verify:
+        # the catalog may be older than the catalogued files
+        parser.error("--delete and --link with --catalog require --verify")
+    algorithm = resolveHashAlgorithm(args.hash)
+
+    deviceWorkers = {}
+    for spec in args.device_workers:
+        mo = re.fullmatch(r"(.+)=(\d+)", spec)
+        if not mo or int(mo.group(2)) < 1:
+            parser.error("invalid --device-workers '%s', expected PATH=N" % spec)
+        deviceWorkers[os.stat(mo.group(1)).st_dev] = int(mo.group(2))
+
+    cache = args.cache and HashCache(args.cache, args.cache_max_entries, algorithm)
+    if args.cache_prune:
+        if not cache:
+            parser.error("--cache-prune requires --cache")
+        print("Pruned %d cache entries." % cache.prune())
+        cache.close()
+        sys.exit(0)
+
+    catalogs = []
+    try:
+        catalogs = [Catalog(path) for path in args.catalog]
+    except (sqlite3.Error, ValueError) as e:
+        parser.error("can't open catalog (%s)" % str(e))
+    for catalog in catalogs:
+        if catalog.algorithm != algorithm:
+            parser.error("catalogs use hash '%s', use the same --hash" % catalog.algorithm)
+
+    index = args.incremental and ScanIndex(args.incremental)
+    files = itertools.chain.from_iterable(walkFiles(d, index) for d in args.dirs)
+    engine = HashingEngine(args.workers, deviceWorkers, algorithm)
+    matcher = DuplicateMatcher(cache, engine, args.verify, args.similar)
+    batch = args.report or args.delete or args.link
+    try:
+        if args.export_catalog:
+            catalog = Catalog(args.export_catalog, algorithm)
+            catalog.clear()
+            matcher.exportCatalog(files, catalog)
+            catalog.close()
+            printStageReport(matcher.stats)
+            sys.exit(0)
+        if args.similar:
+            groups = matcher.iterSimilarGroups(files, args.similar_distance)
+        elif catalogs:
+            groups = matcher.iterCatalogMatches(files, catalogs)
+        else:
+            groups = matcher.iterGroups(files)
+        if batch:
+            report = args.report and REPORT_FORMATS[args.report](sys.stdout)
+            action = "delete" if args.delete else "link" if args.link else None
+            groupCount, reclaimed = runBatch(groups, report, action, args.link, args.keep, args.prefer,
+                                             keepFirst=bool(catalogs))
+        else:
+            groups = list(groups)
+    finally:
+        engine.close()
+        cache and cache.close()
+        index and index.close()
+        for catalog in catalogs:
+            catalog.close()
+
+    # in batch mode the standard output may be taken by the report
+    out = sys.stderr if batch else sys.stdout
+    printStageReport(matcher.stats, out)
+    print(file=out)
+    if matcher.hardlinksCollapsed:
+        print("Skipped %d paths linked (hard or symbolic) to other scanned files." % matcher.hardlinksCollapsed, file=out)
+    if index:
+        print("Listed %d directories, reused %d unchanged ones." % (index.dirsListed, index.dirsReused), file=out)
+    if batch:
+        print("Found %d groups of identical files, reclaimed %d B." % (groupCount, reclaimed), file=out)
+        sys.exit(0)
+
     # show groups with biggest size first
     groups.sort(key=lambda g: g[0].getSize(), reverse=True)
-
     print("Found %d groups of identical files." % len(groups))
 
     for group in groups:
@@ -137,11 +1504,22 @@ if __name__ == "__main__":
                 openFile(os.path.normpath(group[i].getPath()))
             elif re.match(r"p(preserve)? \d+", action):
                 iPreserve = int(re.match(r"p(preserve)? (\d+)", action).group(2)) - 1
+                if not 0 <= iPreserve < len(group):
+                    print("No file %d, try again" % (iPreserve + 1))
+                    continue
+                try:
+                    # the others may be the only copies of what it contained
+                    statUnchanged(group[iPreserve], group[iPreserve].getPath())
+                except OSError as e:
+                    print("Error: can't preserve \"%s\" (%s)" % (group[iPreserve].getPath(), str(e)))
+                    continue
                 for toDelete in [group[i] for i in range(len(group)) if i != iPreserve]:
-                    try:
-                        os.remove(toDelete.getPath())
-                    except OSError as e:
-                        print("Error: can't delete \"%s\" (%s)" % (toDelete.getPath(), str(e)))
+                    for path in toDelete.getPaths():
+                        try:
+                            statUnchanged(toDelete, path)
+                            os.remove(path)
+                        except OSError as e:
+                            print("Error: can't delete \"%s\" (%s)" % (path, str(e)))
                 resolved = True
             else:
                 print("Unrecognized action '%s', try again" % action)
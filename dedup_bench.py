@@ -0,0 +1,297 @@
+'''
+Benchmarks of dedup.py.
+
+Description
+Three benchmarks, selected by the first argument:
+
+scan    Generates reproducible synthetic trees (many small files, a few huge
+        files, heavy size collisions, deep nesting, hardlinks) and scans each
+        of them in a fresh process. Reports wall time, files/s, MB hashed,
+        read syscalls and bytes read (from /proc/self/io, Linux only) and peak
+        RSS. With --json FILE the results are saved together with the commit
+        and Python version, --compare FILE prints them side by side with
+        results saved earlier.
+hash    Measures how fast the duplicate matching runs with each of the
+        available hash algorithms, with and without the --verify stage. The
+        files are read repeatedly, so after the first round they come from
+        the page cache and the numbers mostly reflect the cost of hashing and
+        comparing rather than of the disk.
+memory  Feeds N synthetic files (no disk access) through the size stage and
+        reports the peak RSS per million files.
+
+Usage: python3 dedup_bench.py scan [--scale N] [--json FILE] [--compare FILE]
+       python3 dedup_bench.py hash [--files N] [--size-mb N] [--rounds N]
+       python3 dedup_bench.py memory N
+'''
+
+import argparse
+import json
+import os
+import os.path
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import dedup
+
+
+class FakeStat:
+    '''Stat of a file that doesn't exist, for benchmarks not touching the disk.'''
+    def __init__(self, size, inode):
+        self.st_size = size
+        self.st_dev = 1
+        self.st_ino = inode
+        self.st_mtime_ns = 1500000000 * 10**9 + inode
+        self.st_nlink = 1
+
+
+def peakRss():
+    '''
+    Peak resident set size of this process in bytes. Prefers VmHWM, which
+    starts from zero in a new process, while ru_maxrss is inherited from the
+    parent on Linux.
+    '''
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+def ioCounters():
+    '''
+    I/O counters of this process (all threads) from /proc/self/io: rchar
+    (bytes returned by read calls), syscr (read calls) and read_bytes (bytes
+    fetched from storage). Empty where not available.
+    '''
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+    except OSError:
+        return {}
+    return {k: int(counters[k]) for k in ["rchar", "syscr", "read_bytes"] if k in counters}
+
+
+#############################################################################
+#######################         synthetic trees        ######################
+#############################################################################
+
+def writeFile(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+def makeSmallFiles(root, rng, scale):
+    '''Many small files in many directories, every fifth one a copy of another.'''
+    contents = []
+    for i in range(20000 * scale):
+        if contents and i % 5 == 0:
+            content = rng.choice(contents)
+        else:
+            content = rng.randbytes(rng.randrange(4096))
+            contents.append(content)
+        writeFile(os.path.join(root, "d%03d" % (i // 100), "f%06d" % i), content)
+
+def makeHugeFiles(root, rng, scale):
+    '''A few huge files: an identical pair and a pair differing in one byte in the middle.'''
+    size = 64 * 1024 * 1024 * scale
+    content = rng.randbytes(size)
+    changed = content[:size // 2] + bytes([content[size // 2] ^ 1]) + content[size // 2 + 1:]
+    for name, c in [("a", content), ("a_copy", content), ("b", changed)]:
+        writeFile(os.path.join(root, name), c)
+
+def makeSizeCollisions(root, rng, scale):
+    '''
+    Files of a single size differing at the head, in the middle, at the tail
+    or not at all, so that each stage of the matching has work to do.
+    '''
+    size = 1024 * 1024
+    base = rng.randbytes(size)
+    for i in range(500 * scale):
+        position = [0, size // 3, size - 1, None][i % 4]
+        content = base
+        if position is not None:
+            content = base[:position] + bytes([(base[position] + 1 + i // 4) % 256]) + base[position + 1:]
+        writeFile(os.path.join(root, "d%02d" % (i % 20), "f%05d" % i), content)
+
+def makeDeepNesting(root, rng, scale):
+    '''A chain of 400 nested directories with two files in each.'''
+    path = root
+    # shutil.rmtree is recursive, deeper trees couldn't be cleaned up
+    for depth in range(400):
+        path = os.path.join(path, "d")
+        writeFile(os.path.join(path, "a"), b"%d" % (depth % (10 * scale)))
+        writeFile(os.path.join(path, "b"), rng.randbytes(100))
+
+def makeHardlinks(root, rng, scale):
+    '''Files with three more hardlinks each, every tenth one also with a real copy.'''
+    for i in range(2000 * scale):
+        path = os.path.join(root, "orig", "f%05d" % i)
+        content = rng.randbytes(rng.randrange(1, 65536))
+        writeFile(path, content)
+        for link in range(3):
+            linkPath = os.path.join(root, "links%d" % link, "f%05d" % i)
+            os.makedirs(os.path.dirname(linkPath), exist_ok=True)
+            os.link(path, linkPath)
+        if i % 10 == 0:
+            writeFile(os.path.join(root, "copies", "f%05d" % i), content)
+
+
+SCENARIOS = {
+    "small-files": makeSmallFiles,
+    "huge-files": makeHugeFiles,
+    "size-collisions": makeSizeCollisions,
+    "deep-nesting": makeDeepNesting,
+    "hardlinks": makeHardlinks,
+}
+
+
+#############################################################################
+#######################           benchmarks           ######################
+#############################################################################
+
+def scanOnce(root):
+    '''Scans root the way dedup.py does and returns the measurements.'''
+    ioBefore = ioCounters()
+    start = time.perf_counter()
+    engine = dedup.HashingEngine()
+    matcher = dedup.DuplicateMatcher(engine=engine)
+    groups = list(matcher.iterGroups(dedup.walkFiles(root)))
+    engine.close()
+    elapsed = time.perf_counter() - start
+    ioAfter = ioCounters()
+
+    files = matcher.stats[0].filesIn + matcher.hardlinksCollapsed
+    result = {
+        "files": files,
+        "groups": len(groups),
+        "seconds": elapsed,
+        "files_per_second": files / elapsed if elapsed else 0,
+        "mb_hashed": sum(s.bytesRead for s in matcher.stats) / 1e6,
+        "peak_rss_mb": peakRss() / 1e6,
+    }
+    for counter in ioAfter:
+        result[counter] = ioAfter[counter] - ioBefore[counter]
+    return result
+
+def benchScan(scale, seed=0):
+    '''Generates the trees and scans each one in a separate process.'''
+    results = {}
+    for name, makeTree in SCENARIOS.items():
+        with tempfile.TemporaryDirectory() as root:
+            makeTree(root, random.Random(seed), scale)
+            output = subprocess.run([sys.executable, __file__, "scan-tree", root],
+                                    capture_output=True, text=True, check=True).stdout
+            results[name] = json.loads(output)
+    return results
+
+def printScanResults(results, baseline=None):
+    columns = ["files", "seconds", "files_per_second", "mb_hashed", "syscr", "rchar", "peak_rss_mb"]
+    print("%-16s" % "Scenario" + "".join("%18s" % c for c in columns))
+    for name, result in results.items():
+        cells = []
+        for c in columns:
+            value = result.get(c)
+            cell = "-" if value is None else "%.3f" % value if isinstance(value, float) else "%d" % value
+            old = baseline and baseline.get(name, {}).get(c)
+            if old:
+                cell += " (%.2fx)" % (value / old)
+            cells.append("%18s" % cell)
+        print("%-16s" % name + "".join(cells))
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {"commit": commit or None, "python": platform.python_version(), "platform": platform.platform()}
+
+def makeDuplicatePairs(root, pairCount, fileSize):
+    '''Creates pairCount pairs of identical files of fileSize bytes in root.'''
+    for i in range(pairCount):
+        content = os.urandom(fileSize)
+        for copy in ["a", "b"]:
+            with open(os.path.join(root, "%d_%s" % (i, copy)), "wb") as f:
+                f.write(content)
+
+def benchHashAlgorithms(root, algorithms, rounds):
+    print("%-8s %-7s %10s %12s" % ("Hash", "Verify", "Time [s]", "MB/s"))
+    for algorithm in algorithms:
+        for verify in [False, True]:
+            best = None
+            for _ in range(rounds):
+                files = dedup.listAllFiles(root)
+                engine = dedup.HashingEngine(algorithm=algorithm)
+                matcher = dedup.DuplicateMatcher(engine=engine, verify=verify)
+                start = time.perf_counter()
+                matcher.findGroups(files)
+                elapsed = time.perf_counter() - start
+                engine.close()
+                best = elapsed if best is None else min(best, elapsed)
+            bytesRead = sum(s.bytesRead for s in matcher.stats)
+            print("%-8s %-7s %10.3f %12.1f" % (algorithm, "yes" if verify else "no", best,
+                                               bytesRead / best / 1e6 if best else 0))
+
+def benchMemory(fileCount, filesPerDir=100):
+    '''
+    Buckets fileCount synthetic files by size, the way a scan of a tree of
+    fileCount files does, and reports the growth of the peak RSS.
+    '''
+    rng = random.Random(0)
+    baseline = peakRss()
+    files = (dedup.FileInfo("/archive/photos/%06d/IMG_%08d.jpg" % (i // filesPerDir, i),
+                            FakeStat(rng.randrange(fileCount), i))
+             for i in range(fileCount))
+    stats = dedup.StageStats("size")
+    groups = dedup.DuplicateMatcher()._sizeGroups(files, stats)
+    growth = peakRss() - baseline
+    print("%d files, %d candidates in %d size groups" % (fileCount, stats.filesIn - stats.filesEliminated, len(groups)))
+    print("peak RSS growth %.1f MB, %.1f MB per million files" % (growth / 1e6, growth / 1e6 / fileCount * 1e6))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of dedup.py.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    scan = subparsers.add_parser("scan", help="scan synthetic trees")
+    scan.add_argument("--scale", type=int, default=1, help="multiplies number and size of the generated files")
+    scan.add_argument("--seed", type=int, default=0, help="seed of the generated content")
+    scan.add_argument("--json", metavar="FILE", help="save the results to FILE")
+    scan.add_argument("--compare", metavar="FILE", help="show ratios to results saved by --json")
+    # internal: measures a scan of one tree in a fresh process
+    scanTree = subparsers.add_parser("scan-tree")
+    scanTree.add_argument("root")
+    hashing = subparsers.add_parser("hash", help="compare hash algorithms")
+    hashing.add_argument("--files", type=int, default=20, help="number of pairs of identical files")
+    hashing.add_argument("--size-mb", type=int, default=32, help="size of each file in MB")
+    hashing.add_argument("--rounds", type=int, default=3, help="runs of each variant, the best one is reported")
+    memory = subparsers.add_parser("memory", help="peak RSS per million files")
+    memory.add_argument("files", type=int)
+    args = parser.parse_args()
+
+    if args.benchmark == "scan":
+        results = benchScan(args.scale, args.seed)
+        baseline = None
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f)["results"]
+        printScanResults(results, baseline)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(dict(environment(), scale=args.scale, seed=args.seed, results=results), f, indent=2)
+    elif args.benchmark == "scan-tree":
+        print(json.dumps(scanOnce(args.root)))
+    elif args.benchmark == "hash":
+        with tempfile.TemporaryDirectory() as root:
+            makeDuplicatePairs(root, args.files, args.size_mb * 1024 * 1024)
+            benchHashAlgorithms(root, sorted(dedup.HASH_ALGORITHMS), args.rounds)
+    elif args.benchmark == "memory":
+        benchMemory(args.files)
@@ -0,0 +1,458 @@
+import dedup
+import hashlib
+import io
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class TestDedup(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.root = self._tmp.name
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_identical_files_are_grouped(self):
+        self.write_file('a', b'x' * 1000)
+        self.write_file('b', b'x' * 1000)
+        self.write_file('c', b'y' * 1000)
+
+        groups = dedup.groupsWithDuplicates(dedup.listAllFiles(self.root))
+
+        self.assertEqual([['a', 'b']], self.group_names(groups))
+
+    def test_files_differing_only_in_the_middle_are_not_grouped(self):
+        size = 4 * 1024 * 1024
+        self.write_file('a', b'\0' * size)
+        self.write_file('b', b'\0' * (size // 2) + b'\1' + b'\0' * (size // 2 - 1))
+
+        groups = dedup.groupsWithDuplicates(dedup.listAllFiles(self.root))
+
+        self.assertEqual([], groups)
+
+    # Files with different heads are told apart by the head/tail stage, so
+    # nothing more than the head/tail blocks should be read from them.
+    def test_head_difference_avoids_full_read(self):
+        size = 4 * 1024 * 1024
+        self.write_file('a', b'a' + b'\0' * (size - 1))
+        self.write_file('b', b'b' + b'\0' * (size - 1))
+
+        matcher = dedup.DuplicateMatcher()
+        groups = dedup.groupsWithDuplicates(dedup.listAllFiles(self.root), matcher)
+
+        self.assertEqual([], groups)
+        stats = {s.name: s for s in matcher.stats}
+        self.assertEqual(2, stats['head/tail'].filesEliminated)
+        self.assertEqual(4 * dedup.HEAD_TAIL_BLOCK_SIZE, stats['head/tail'].bytesRead)
+        self.assertEqual(2 * size - 4 * dedup.HEAD_TAIL_BLOCK_SIZE, stats['head/tail'].bytesAvoided)
+        self.assertEqual(0, stats['full'].bytesRead)
+
+    def test_small_files_are_read_once(self):
+        self.write_file('a', b'small')
+        self.write_file('b', b'small')
+
+        matcher = dedup.DuplicateMatcher()
+        groups = dedup.groupsWithDuplicates(dedup.listAllFiles(self.root), matcher)
+
+        self.assertEqual([['a', 'b']], self.group_names(groups))
+        self.assertEqual(0, sum(s.bytesRead for s in matcher.stats if s.name != 'head/tail'))
+        self.assertEqual(groups[0][0].getDigest(), groups[0][1].getDigest())
+
+    def test_cached_digests_are_reused_by_next_scan(self):
+        size = 1024 * 1024
+        self.write_file('a', b'\0' * size)
+        self.write_file('b', b'\0' * size)
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        cache_path = os.path.join(cache_dir.name, 'cache.sqlite')
+
+        bytes_read = []
+        for _ in range(2):
+            cache = dedup.HashCache(cache_path)
+            matcher = dedup.DuplicateMatcher(cache)
+            groups = dedup.groupsWithDuplicates(dedup.listAllFiles(self.root), matcher)
+            cache.close()
+
+            self.assertEqual([['a', 'b']], self.group_names(groups))
+            bytes_read.append(sum(s.bytesRead for s in matcher.stats))
+
+        self.assertGreaterEqual(bytes_read[0], 2 * size)
+        self.assertEqual(0, bytes_read[1])
+
+    def test_cache_entry_of_changed_file_is_invalidated(self):
+        path = self.write_file('a', b'old')
+        cache = dedup.HashCache(':memory:')
+        cache.put(dedup.FileInfo(path), 'full', b'digest')
+        os.utime(path, ns=(0, 0))
+
+        self.assertIsNone(cache.get(dedup.FileInfo(path), 'full'))
+
+    def test_cache_prune_and_eviction(self):
+        paths = [self.write_file(name, name.encode()) for name in 'abc']
+        cache = dedup.HashCache(':memory:', maxEntries=1)
+        for path in paths:
+            cache.put(dedup.FileInfo(path), 'full', b'digest')
+        os.remove(paths[0])
+
+        self.assertEqual(1, cache.prune())
+        self.assertEqual(1, cache.evict())
+
+    def test_hashing_engine_matches_serial_hash(self):
+        contents = [bytes([i]) * (i * 1000) for i in range(1, 10)]
+        paths = [self.write_file(str(i), c) for i, c in enumerate(contents)]
+        device = os.stat(self.root).st_dev
+        engine = dedup.HashingEngine(workers=4, deviceWorkers={device: 2})
+        self.addCleanup(engine.close)
+
+        results = engine.hashAll((p, [(0, len(c))], device) for p, c in zip(paths, contents))
+
+        self.assertEqual(2, engine.workersFor(device))
+        self.assertEqual([(hashlib.md5(c).digest(), len(c)) for c in contents], results)
+
+    def test_hash_ranges_reuses_small_buffer(self):
+        content = bytes(range(256)) * 10
+        path = self.write_file('a', content)
+        buffer = memoryview(bytearray(100))
+
+        digest, bytes_read = dedup.hashRanges(path, [(10, 1000), (2000, 1000)], buffer)
+
+        self.assertEqual(hashlib.md5(content[10:1010] + content[2000:]).digest(), digest)
+        self.assertEqual(1560, bytes_read)
+
+    def test_hash_algorithm_is_selectable(self):
+        self.write_file('a', b'x' * 1000)
+        self.write_file('b', b'x' * 1000)
+        engine = dedup.HashingEngine(algorithm='blake2b')
+        self.addCleanup(engine.close)
+
+        groups = dedup.groupsWithDuplicates(dedup.listAllFiles(self.root), dedup.DuplicateMatcher(engine=engine))
+
+        self.assertEqual(hashlib.blake2b(b'x' * 1000, digest_size=16).digest(), groups[0][0].getDigest())
+
+    def test_unavailable_optional_hash_falls_back_to_stdlib(self):
+        for name in dedup.OPTIONAL_HASH_ALGORITHMS:
+            if name not in dedup.HASH_ALGORITHMS:
+                self.assertEqual(dedup.FALLBACK_HASH_ALGORITHM, dedup.resolveHashAlgorithm(name))
+        self.assertRaises(ValueError, dedup.resolveHashAlgorithm, 'crc32')
+
+    def test_verify_splits_colliding_groups(self):
+        a = dedup.FileInfo(self.write_file('a', b'same'))
+        b = dedup.FileInfo(self.write_file('b', b'same'))
+        c = dedup.FileInfo(self.write_file('c', b'diff'))
+        matcher = dedup.DuplicateMatcher(verify=True)
+
+        # pretend the hash collided
+        groups = matcher._verifyGroups([[a, c, b]], matcher.stats[-1])
+
+        self.assertEqual([['a', 'b']], self.group_names(groups))
+        self.assertEqual(1, matcher.stats[-1].filesEliminated)
+        self.assertEqual(1, dedup.FileInfo.bitcmp(a.getPath(), c.getPath()))
+        self.assertEqual(0, dedup.FileInfo.bitcmp(a.getPath(), b.getPath()))
+
+    def test_walk_files_handles_deep_trees_and_symlink_loops(self):
+        deep = os.path.join(self.root, *(['d'] * 200))
+        self.write_file(os.path.relpath(os.path.join(deep, 'f'), self.root), b'deep')
+        self.write_file('top', b'top')
+        os.symlink(self.root, os.path.join(deep, 'loop'))
+
+        names = sorted(os.path.basename(f.getPath()) for f in dedup.walkFiles(self.root))
+
+        self.assertEqual(['f', 'top'], names)
+
+    def test_hardlinks_are_collapsed_without_hashing(self):
+        a = self.write_file('a', b'linked')
+        os.link(a, os.path.join(self.root, 'b'))
+
+        matcher = dedup.DuplicateMatcher()
+        groups = dedup.groupsWithDuplicates(dedup.listAllFiles(self.root), matcher)
+
+        self.assertEqual([], groups)
+        self.assertEqual(1, matcher.hardlinksCollapsed)
+        self.assertEqual(0, sum(s.bytesRead for s in matcher.stats))
+
+    def test_symlink_and_its_target_are_one_file(self):
+        real = self.write_file('real.txt', b'content')
+        os.symlink(real, os.path.join(self.root, 'a'))
+
+        matcher = dedup.DuplicateMatcher()
+        group_count, reclaimed = dedup.runBatch(matcher.iterGroups(dedup.walkFiles(self.root)), action='delete',
+                                                keepPolicy='shortest-path')
+
+        self.assertEqual((0, 0), (group_count, reclaimed))
+        self.assertEqual(1, matcher.hardlinksCollapsed)
+        self.assertTrue(os.path.exists(real))
+
+    def test_link_duplicates_replaces_them_by_hardlinks(self):
+        self.write_file('a', b'same')
+        self.write_file('b', b'same')
+        self.write_file('sub/c', b'same')
+
+        groups = dedup.groupsWithDuplicates(dedup.listAllFiles(self.root))
+        reclaimed, errors = dedup.resolveGroup(groups[0], 'link', 'hard')
+
+        self.assertEqual((8, []), (reclaimed, errors))
+        inodes = {os.stat(os.path.join(self.root, p)).st_ino for p in ['a', 'b', 'sub/c']}
+        self.assertEqual(1, len(inodes))
+        self.assertEqual(['a', 'b', 'c'], sorted(f for _, _, fs in os.walk(self.root) for f in fs))
+
+    def test_reflink_keeps_mode_and_owner_of_duplicate(self):
+        self.write_file('a', b'same')
+        b = self.write_file('b', b'same')
+        os.chmod(b, 0o640)
+        owner = (1234, 1234) if hasattr(os, 'geteuid') and os.geteuid() == 0 else None
+        if owner:
+            os.chown(b, *owner)
+        groups = dedup.groupsWithDuplicates(dedup.listAllFiles(self.root))
+        group = sorted(groups[0], key=lambda f: f.getPath())
+
+        # a plain copy stands in for the reflink, it is a new file as well
+        with patch('dedup.cloneFile', side_effect=lambda source, target: shutil.copyfile(source, target)):
+            self.assertEqual((4, []), dedup.resolveGroup(group, 'link', 'reflink'))
+
+        stat = os.stat(b)
+        self.assertEqual(0o640, stat.st_mode & 0o7777)
+        if owner:
+            self.assertEqual(owner, (stat.st_uid, stat.st_gid))
+
+    def test_changed_duplicate_is_not_linked(self):
+        self.write_file('a', b'same')
+        self.write_file('b', b'same')
+        groups = dedup.groupsWithDuplicates(dedup.listAllFiles(self.root))
+        duplicate = groups[0][1].getPath()
+        os.utime(duplicate, ns=(0, 0))
+
+        reclaimed, errors = dedup.resolveGroup(groups[0], 'link', 'hard')
+
+        self.assertEqual(0, reclaimed)
+        self.assertEqual([duplicate], [path for path, _ in errors])
+        self.assertEqual(1, os.stat(duplicate).st_nlink)
+
+    def test_keep_policy_and_preferred_prefix(self):
+        old = dedup.FileInfo(self.write_file('long/old', b'same'))
+        new = dedup.FileInfo(self.write_file('new', b'same'))
+        os.utime(old.getPath(), ns=(0, 0))
+        old = dedup.FileInfo(old.getPath())
+        names = lambda group: [os.path.relpath(f.getPath(), self.root) for f in group]
+
+        self.assertEqual(['long/old', 'new'], names(dedup.orderByKeepPolicy([new, old], 'oldest')))
+        self.assertEqual(['new', 'long/old'], names(dedup.orderByKeepPolicy([old, new], 'shortest-path')))
+        self.assertEqual(['new', 'long/old'], names(dedup.orderByKeepPolicy(
+            [old, new], 'oldest', [os.path.join(self.root, 'new')])))
+
+    def test_batch_deletes_and_streams_report(self):
+        self.write_file('keep/a', b'same')
+        self.write_file('b', b'same')
+        self.write_file('c', b'other')
+        out = io.StringIO()
+
+        matcher = dedup.DuplicateMatcher()
+        group_count, reclaimed = dedup.runBatch(
+            matcher.iterGroups(dedup.walkFiles(self.root)), dedup.JsonLinesReport(out), 'delete',
+            preferredPrefixes=[os.path.join(self.root, 'keep')])
+
+        self.assertEqual((1, 4), (group_count, reclaimed))
+        record = json.loads(out.getvalue())
+        self.assertEqual(os.path.join(self.root, 'keep', 'a'), record['keep'])
+        self.assertEqual([os.path.join(self.root, 'b')], record['duplicates'])
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'b')))
+
+    def test_incremental_scan_reuses_unchanged_directories(self):
+        self.write_file('a/x', b'same')
+        self.write_file('b/y', b'same')
+        for d in ['a', 'b', '']:
+            os.utime(os.path.join(self.root, d), ns=(0, 0))
+        index_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(index_dir.cleanup)
+        index_path = os.path.join(index_dir.name, 'index.sqlite')
+
+        def scan():
+            index = dedup.ScanIndex(index_path)
+            names = sorted(os.path.relpath(f.getPath(), self.root) for f in dedup.walkFiles(self.root, index))
+            index.close()
+            return (names, index.dirsListed, index.dirsReused)
+
+        self.assertEqual((['a/x', 'b/y'], 3, 0), scan())
+        self.assertEqual((['a/x', 'b/y'], 0, 3), scan())
+        self.write_file('a/z', b'new')
+        self.assertEqual((['a/x', 'a/z', 'b/y'], 1, 2), scan())
+
+    def test_file_edited_in_place_is_not_matched_from_cache(self):
+        self.write_file('a/x', b'same')
+        self.write_file('b/y', b'same')
+        for d in ['a', 'b', '']:
+            os.utime(os.path.join(self.root, d), ns=(0, 0))
+        db_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(db_dir.cleanup)
+
+        def scan(action):
+            index = dedup.ScanIndex(os.path.join(db_dir.name, 'index.sqlite'))
+            cache = dedup.HashCache(os.path.join(db_dir.name, 'cache.sqlite'))
+            try:
+                groups = dedup.DuplicateMatcher(cache).iterGroups(dedup.walkFiles(self.root, index))
+                return dedup.runBatch(groups, action=action, preferredPrefixes=[os.path.join(self.root, 'a')])
+            finally:
+                cache.close()
+                index.close()
+
+        self.assertEqual((1, 0), scan(None))
+        # edited in place, the directory mtime stays
+        self.write_file('a/x', b'edit')
+        os.utime(os.path.join(self.root, 'a'), ns=(0, 0))
+
+        with patch('sys.stderr', io.StringIO()):
+            self.assertEqual((0, 0), scan('delete'))
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'b', 'y')))
+
+    def test_file_grown_in_place_is_not_hashed_by_indexed_size(self):
+        self.write_file('d/a', b'same')
+        self.write_file('d/b', b'same')
+        os.utime(os.path.join(self.root, 'd'), ns=(0, 0))
+        index_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(index_dir.cleanup)
+
+        def scan():
+            index = dedup.ScanIndex(os.path.join(index_dir.name, 'index.sqlite'))
+            try:
+                return self.group_names(dedup.DuplicateMatcher().iterGroups(dedup.walkFiles(self.root, index)))
+            finally:
+                index.close()
+
+        self.assertEqual([['d/a', 'd/b']], scan())
+        with open(os.path.join(self.root, 'd', 'a'), 'ab') as f:
+            f.write(b' and more')
+        os.utime(os.path.join(self.root, 'd'), ns=(0, 0))
+
+        with patch('sys.stderr', io.StringIO()) as err:
+            self.assertEqual([], scan())
+        self.assertIn(os.path.join(self.root, 'd', 'a'), err.getvalue())
+
+    def test_changed_kept_file_skips_group(self):
+        self.write_file('a', b'same')
+        self.write_file('b', b'same')
+        groups = dedup.groupsWithDuplicates(dedup.listAllFiles(self.root))
+        with open(groups[0][0].getPath(), 'wb') as f:
+            f.write(b'edit')
+        os.utime(groups[0][0].getPath(), ns=(0, 0))
+
+        reclaimed, errors = dedup.resolveGroup(groups[0], 'delete')
+
+        self.assertEqual((0, [groups[0][1].getPath()]), (reclaimed, [path for path, _ in errors]))
+        self.assertTrue(os.path.exists(groups[0][1].getPath()))
+
+    def test_files_are_matched_against_exported_catalog(self):
+        big = os.urandom(1024 * 1024)
+        self.write_file('archive/small', b'small')
+        self.write_file('archive/big', big)
+        self.write_file('ingest/small copy', b'small')
+        self.write_file('ingest/big copy', big)
+        self.write_file('ingest/same size', big[:512 * 1024] + bytes([big[512 * 1024] ^ 1]) + big[512 * 1024 + 1:])
+        self.write_file('ingest/new', b'new')
+        catalog = dedup.Catalog(':memory:', 'md5')
+
+        dedup.DuplicateMatcher().exportCatalog(dedup.walkFiles(os.path.join(self.root, 'archive')), catalog)
+        matcher = dedup.DuplicateMatcher()
+        groups = list(matcher.iterCatalogMatches(dedup.walkFiles(os.path.join(self.root, 'ingest')), [catalog]))
+
+        self.assertEqual([['archive/big', 'ingest/big copy'], ['archive/small', 'ingest/small copy']],
+                         sorted([os.path.relpath(f.getPath(), self.root) for f in g] for g in groups))
+        stats = {s.name: s for s in matcher.stats}
+        # 'new' has a size that is not in the catalog and is never read
+        self.assertEqual(1, stats['size'].filesEliminated)
+        self.assertEqual(1, stats['samples'].filesEliminated)
+
+    def test_catalogued_file_must_still_exist(self):
+        self.write_file('archive/a', b'catalogued')
+        self.write_file('archive/b', b'catalogued')
+        self.write_file('ingest/a copy', b'catalogued')
+        catalog = dedup.Catalog(':memory:', 'md5')
+        dedup.DuplicateMatcher().exportCatalog(dedup.walkFiles(os.path.join(self.root, 'archive')), catalog)
+        ingest = lambda: dedup.walkFiles(os.path.join(self.root, 'ingest'))
+        keptNames = lambda matcher: [os.path.relpath(g[0].getPath(), self.root)
+                                     for g in matcher.iterCatalogMatches(ingest(), [catalog])]
+
+        os.remove(os.path.join(self.root, 'archive', 'a'))
+        self.assertEqual(['archive/b'], keptNames(dedup.DuplicateMatcher()))
+
+        # same size, different content: only --verify notices
+        self.write_file('archive/b', b'CATALOGUED')
+        with patch('sys.stderr', io.StringIO()):
+            self.assertEqual([], keptNames(dedup.DuplicateMatcher(verify=True)))
+            os.remove(os.path.join(self.root, 'archive', 'b'))
+            self.assertEqual([], keptNames(dedup.DuplicateMatcher()))
+
+    def test_catalogued_tree_is_not_its_own_copy(self):
+        self.write_file('archive/a', b'catalogued')
+        self.write_file('archive/b', b'other')
+        os.link(os.path.join(self.root, 'archive', 'a'), os.path.join(self.root, 'archive', 'a link'))
+        catalog = dedup.Catalog(':memory:', 'md5')
+        dedup.DuplicateMatcher().exportCatalog(dedup.walkFiles(os.path.join(self.root, 'archive')), catalog)
+
+        matcher = dedup.DuplicateMatcher(verify=True)
+        group_count, reclaimed = dedup.runBatch(
+            matcher.iterCatalogMatches(dedup.walkFiles(os.path.join(self.root, 'archive')), [catalog]),
+            action='delete', keepFirst=True)
+
+        self.assertEqual((0, 0), (group_count, reclaimed))
+        self.assertEqual(['a', 'a link', 'b'], sorted(os.listdir(os.path.join(self.root, 'archive'))))
+
+    def test_bk_tree_finds_keys_within_radius(self):
+        keys = [0b0000, 0b0001, 0b0011, 0b0111, 0b1111, 0b1000]
+        tree = dedup.BKTree()
+        for k in keys:
+            tree.add(k, k)
+
+        for radius in range(5):
+            for query in range(16):
+                expected = sorted(k for k in keys if (k ^ query).bit_count() <= radius)
+                self.assertEqual(expected, sorted(tree.search(query, radius)))
+
+    def test_difference_hash_of_gradient(self):
+        left_to_right = bytes(x * 10 for _ in range(8) for x in range(9))
+
+        self.assertEqual(2**64 - 1, dedup.differenceHash(left_to_right))
+        self.assertEqual(0, dedup.differenceHash(left_to_right[::-1]))
+
+    # Decoding is faked: the "image" files hold their 9x8 thumbnail.
+    @patch('dedup.grayThumbnail', lambda path, w, h: read_file(path)[:w * h])
+    def test_similar_images_are_grouped(self):
+        gradient = bytes(x * 10 for _ in range(8) for x in range(9))
+        self.write_file('a.jpg', gradient + b'original')
+        self.write_file('a_small.png', bytes(p // 2 for p in gradient))
+        self.write_file('b.jpg', gradient[::-1])
+        self.write_file('notes.txt', gradient)
+
+        matcher = dedup.DuplicateMatcher(similar=True)
+        groups = list(matcher.iterSimilarGroups(dedup.walkFiles(self.root)))
+
+        self.assertEqual([['a.jpg', 'a_small.png']], self.group_names(groups))
+        self.assertEqual((3, 1), (matcher.stats[-1].filesIn, matcher.stats[-1].filesEliminated))
+
+
+    # Helper methods.
+
+    def write_file(self, name, content):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def group_names(self, groups):
+        names = [sorted(os.path.relpath(f.getPath(), self.root) for f in g) for g in groups]
+        return sorted(names)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -24,6 +24,13 @@
 # -------------                                                                #
 # ./fr.py [-s salt] sourceSpecificPattern destinationSpecificPattern           #
 # ./fr.py [--salt salt] sourceSpecificPattern destinationSpecificPattern       #
+# ./fr.py [-d dir] [-y|--yes] [-n|--dry-run] [--json] src dst                  #
+# ./fr.py -r [--scope directory|subtree|tree] [-j jobs] src dst                #
+# ./fr.py [--journal file] src dst; ./fr.py --rollback file                    #
+#                                                                              #
+# Jako knihovna:                                                               #
+#   for (source, old, new) in FileRenamer.planRenames(src, dst, salt, dir):    #
+#   FileRenamer.renameFiles(plan, dir)                                         #
 #                                                                              #
 # Příklad:                                                                     #
 # ./fr.py -s ".cze" "<s:\d>x<ep:\d{2}>" "s0<s:\d>e<ep:\d{2}>"                  #
@@ -62,14 +69,54 @@
 # CHANGELOG                                                                    #
 # 19.6.2010 - soubory, jejichž název by se nezměnil, nejsou při projekci       #
 #             uvažovány                                                        #
+# 17.10.2026 - planRenames/renameFiles jako API (generátor trojic), CLI přes   #
+#              argparse s --yes, --dry-run a --json; import nic nespouští      #
+#              rekurzivní režim (-r) s párováním v rámci adresáře/stromu       #
+#              specific pattern se parsuje jednou (SpecificPattern, LRU cache) #
+#              přejmenování nikdy nepřepíše soubor, řetězce a cykly se řadí,   #
+#              žurnál (--journal) pro --rollback                               #
 #                                                                              #
 ################################################################################
 
 
 
+import argparse
+import collections
+import ctypes
+import errno
+import functools
+import json
 import os
+import platform
 import sys
 import re
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import fswalk
+
+
+
+AT_FDCWD = -100
+RENAME_NOREPLACE = 1
+
+def _loadRenameat2():
+    '''
+    Vrátí funkci renameat2 z libc (Linux), jinak None.
+    '''
+    if platform.system() != "Linux":
+        return None
+    try:
+        func = ctypes.CDLL(None, use_errno=True).renameat2
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    func.restype = ctypes.c_int
+    return func
+
+renameat2 = _loadRenameat2()
 
 
 
@@ -80,96 +127,406 @@ class FileRenamer:
     SPECIFIC_PATTERN_GROUPNAME_LEGAL_CHARACTERS = "[A-Za-z0-9_-]"
     # regexp pro matchování groups ve specific pattern
     _SPECIFIC_PATTERN_GROUP_MATCHER = re.compile("<(?P<id>" + SPECIFIC_PATTERN_GROUPNAME_LEGAL_CHARACTERS + "+):(?P<re>[^>]+)>")
+    # rozsah párování v rekurzivním režimu: název -> funkce, která relativní
+    # cestě souboru přiřadí skupinu; páry se hledají jen v rámci skupiny
+    SCOPES = {
+        "directory": os.path.dirname,                                   # jen v jednom adresáři
+        "subtree": lambda path: path.split(os.sep, 1)[0] if os.sep in path else "",  # pod jedním podadresářem root
+        "tree": lambda path: "",                                        # v celém stromu
+    }
+    # počet souběžně zpracovávaných adresářů
+    DEFAULT_JOBS = fswalk.DEFAULT_JOBS
     
 
 
-    def projectNames(sourceSpecificPattern, destinationSpecificPattern, salt=""):
+    @staticmethod
+    def planRenames(sourceSpecificPattern, destinationSpecificPattern, salt="", directory="."):
         '''
-        V aktuálním adresáři provede promítnutí jmen souborů. Platí, že
-        názvy souborů odpovídající sourceSpecificPattern budou promítnuty
-        na soubory odpovídající destinationSpecificPattern, kde v příslušné
+        V adresáři directory najde páry souborů pro promítnutí jmen a pro
+        každý pár vygeneruje trojici (sourceFile, oldDestinationName,
+        newDestinationName) - jména souborů v directory. Platí, že názvy
+        souborů odpovídající sourceSpecificPattern budou promítnuty na
+        soubory odpovídající destinationSpecificPattern, kde v příslušné
         dvojici se musí rovnat části se stejným SPECIFIC_PATTERN_NAME.
+        Nic nepřejmenovává, k tomu slouží renameFiles.
         Vyhazuje re.error pri nespravnem regularnim vyrazu.
         '''
-        
-        # načteme obsah adresáře a jména souborů roztřídíme podle toho, zda odpovídají source/destination specific pattern
-        fileList = os.listdir(".")
+        matchers = FileRenamer._compilePatterns(sourceSpecificPattern, destinationSpecificPattern)
+        yield from FileRenamer._planNames(os.listdir(directory), matchers, salt)
 
-        sourceFileList = []
-        destinationFileList = []
 
-        sourceMatcher = re.compile(FileRenamer._specificPatternToRE(sourceSpecificPattern))
-        destinationMatcher = re.compile(FileRenamer._specificPatternToRE(destinationSpecificPattern))
 
-        for fileName in fileList:
-            if sourceMatcher.match(fileName):
-                sourceFileList.append(fileName)
-            elif destinationMatcher.match(fileName):
-                destinationFileList.append(fileName)
+    @staticmethod
+    def planRenamesRecursive(sourceSpecificPattern, destinationSpecificPattern, salt="", root=".",
+                             scope="directory", jobs=DEFAULT_JOBS):
+        '''
+        Jako planRenames, ale pro všechny soubory ve stromu pod root; cesty
+        v trojicích jsou relativní k root. scope (klíč FileRenamer.SCOPES)
+        určuje, mezi kterými soubory se páry hledají. Přejmenovaný soubor
+        vždy zůstává ve svém adresáři. Adresáře čte souběžně nejvýše jobs
+        vláken (viz. fswalk).
+        '''
+        if scope not in FileRenamer.SCOPES:
+            raise ValueError("unknown scope %s" % scope)
+        scopeOf = FileRenamer.SCOPES[scope]
+        matchers = FileRenamer._compilePatterns(sourceSpecificPattern, destinationSpecificPattern)
 
-        # vyhledáme odpovídající si páry v source a destination file listech
-        
-        # identifikátory proměnných polí ve specific pattern
-        # (bereme pouze názvy vyskytujících se v obou patterns)
-        groupsSource = FileRenamer._getSpecificPatternGroups(sourceSpecificPattern)
-        groupsDestination = FileRenamer._getSpecificPatternGroups(destinationSpecificPattern)
+        # soubory roztřídíme do skupin podle scope (v pořadí procházení stromu)
+        groups = {}
+        for entry in fswalk.walk_files(root, jobs=jobs):
+            path = os.path.relpath(entry.path, root)
+            groups.setdefault(scopeOf(path), []).append(path)
 
-        if set(groupsSource) ^ set(groupsDestination):
-            print("warning: in source and destination patterns aren't the same names")
-        specificPatternGroups = list( set(groupsSource) & set(groupsDestination) )
+        for paths in groups.values():
+            yield from FileRenamer._planNames(paths, matchers, salt)
 
 
-        # páry souborů, které k sobě podle jejich specific patterns groups patří
-        matchedPairs = []
 
-        for sourceFile in sourceFileList:
-            sourceFileMatchObj = sourceMatcher.match(sourceFile)
-            # porovnání všech souborů se všemi
-            for destinationFile in destinationFileList:
-                destinationFileMatchObj = destinationMatcher.match(destinationFile)
-                
-                # rovnají se všude všechny groups?
-                for patternGroup in specificPatternGroups:
-                    srcGroup = sourceFileMatchObj.group(patternGroup)
-                    dstGroup = destinationFileMatchObj.group(patternGroup)                    
+    @staticmethod
+    def renameFiles(plan, directory=".", verbose=True, journal=None):
+        '''
+        Provede přejmenování podle plánu (iterable trojic ze planRenames).
+        Nikdy nepřepíše existující soubor (viz. _renameNoReplace). Pořadí
+        řetězců a cykly řeší orderRenames, trojice se společným cílem se
+        nepřejmenují vůbec. Je-li zadán journal (RenameJournal), zapíše
+        se do něj každý krok před jeho provedením. Vrací dvojici (počet
+        přejmenovaných souborů, list neúspěšných trojic).
+        '''
+        (units, conflicts) = FileRenamer.orderRenames(plan)
+        failed = list(conflicts)
+        if verbose:
+            for (_, oldDestinationName, newDestinationName) in conflicts:
+                print("skipping \"%s\"" % oldDestinationName)
+                print("  more files would be renamed to \"%s\"" % newDestinationName)
+
+        renamed = 0
+        for (triples, steps) in units:
+            done = []
+            try:
+                for (old, new) in steps:
+                    if verbose:
+                        print("renaming \"%s\"" % old)
+                        print("  to \"%s\"" % new)
+                    FileRenamer._renameStep(directory, old, new, journal)
+                    done.append((old, new))
+                renamed += len(triples)
+            except OSError as e:
+                if verbose:
+                    print("  failed: %s" % e.strerror)
+                # cyklus přes dočasné jméno vrátíme do původního stavu
+                for (old, new) in reversed(done):
                     try:
-                        # groups, které jsou výhradně číselné porovnáváme jako čísla, jinak porovnáváme řetězcově
-                        if srcGroup == dstGroup or int(srcGroup) == int(dstGroup):
-                            pass
-                        else:
-                            break # groups se nerovnají jako řetězce a ani jako čísla
-                    except ValueError: # groups nejsou číselné
-                        break
-                # dvojice souborů k sobě patří (nebyl nalezen konflikt v žádné group (= poli))
-                else:
-                    matchedPairs.append((sourceFile, destinationFile))
-                    destinationFileList.remove(destinationFile)
-        
-        if len(matchedPairs) == 0:
+                        FileRenamer._renameStep(directory, new, old, journal)
+                    except OSError:
+                        print("warning: cannot rename \"%s\" back to \"%s\"" % (new, old), file=sys.stderr)
+                failed.extend(triples)
+        return (renamed, failed)
+
+
+
+    @staticmethod
+    def orderRenames(plan):
+        '''
+        Seřadí přejmenování z plánu tak, aby žádné nemuselo přepsat jiný
+        soubor z plánu. Vrací dvojici (units, conflicts):
+        units     - list dvojic (trojice, kroky), kde kroky jsou dvojice
+                    (old, new) k provedení v daném pořadí; trojice jsou
+                    přejmenované, projdou-li všechny kroky
+        conflicts - trojice, jejichž cíl je cílem i jiné trojice (nebo se
+                    stejný soubor přejmenovává víckrát); ty se neprovádějí
+
+        Řetězec a->b, b->c se provede odzadu (b->c, pak a->b). Cyklus
+        a->b, b->a se provede přes dočasné jméno (a->tmp, b->a, tmp->b).
+        Cíl obsazený souborem mimo plán se tu nekontroluje, takové
+        přejmenování selže až při provedení.
+        '''
+        triples = list(plan)
+        targets = collections.Counter(new for (_, _, new) in triples)
+        sources = collections.Counter(old for (_, old, _) in triples)
+        conflicts = [t for t in triples if targets[t[2]] > 1 or sources[t[1]] > 1]
+        remaining = [t for t in triples if targets[t[2]] == 1 and sources[t[1]] == 1]
+
+        # každý soubor je přejmenován nejvýše jednou a na každé jméno se
+        # přejmenovává nejvýše jeden, graf old -> new je tedy tvořen jen
+        # cestami a cykly
+        byOld = {t[1]: t for t in remaining}
+        units = []
+        emitted = set()
+        for triple in remaining:
+            chain = []
+            t = triple
+            while t is not None and t not in emitted:
+                chain.append(t)
+                emitted.add(t)
+                t = byOld.get(t[2])
+
+            if t is not None and t in chain and t[1] != t[2]:
+                # cyklus (začíná vždy na začátku chain, do cyklu nevede hrana zvenčí)
+                cycle = chain[chain.index(t):]
+                chain = chain[:chain.index(t)]
+                temp = FileRenamer._tempName(cycle[0][1])
+                steps = [(cycle[0][1], temp)] + [(c[1], c[2]) for c in reversed(cycle[1:])] + [(temp, cycle[0][2])]
+                units.append((tuple(cycle), steps))
+
+            # konec řetězce musí proběhnout první, uvolní jméno předchozímu
+            for c in reversed(chain):
+                units.append(((c,), [] if c[1] == c[2] else [(c[1], c[2])]))
+        return (units, conflicts)
+
+
+
+    @staticmethod
+    def rollback(journalPath, verbose=True):
+        '''
+        Vrátí přejmenování zapsaná v žurnálu (viz. RenameJournal) v opačném
+        pořadí. Kroky, které se neprovedly (new neexistuje nebo old opět
+        existuje), přeskočí. Vrací dvojici (počet vrácených kroků, list
+        neúspěšných (old, new)).
+        '''
+        restored = 0
+        failed = []
+        for (old, new) in reversed(list(RenameJournal.records(journalPath))):
+            if not os.path.lexists(new) or os.path.lexists(old):
+                continue
+            if verbose:
+                print("renaming \"%s\"" % new)
+                print("  back to \"%s\"" % old)
+            try:
+                FileRenamer._renameNoReplace(new, old)
+                restored += 1
+            except OSError as e:
+                if verbose:
+                    print("  failed: %s" % e.strerror)
+                failed.append((old, new))
+        return (restored, failed)
+
+
+
+    @staticmethod
+    def renameFilesByDirectory(plan, root=".", jobs=DEFAULT_JOBS, journal=None):
+        '''
+        Provede přejmenování podle plánu z planRenamesRecursive, adresáře
+        zpracovává souběžně nejvýše jobs vlákny (na síťovém disku je
+        přejmenování pomalé). Přejmenovaný soubor zůstává ve svém adresáři,
+        takže řetězce a cykly (viz. orderRenames) adresáře nepřekračují.
+        Vrací dict adresář -> (počet přejmenovaných,
+        list neúspěšných trojic), v pořadí plánu.
+        '''
+        byDirectory = FileRenamer._groupByDirectory(plan)
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            results = executor.map(lambda directoryPlan: FileRenamer.renameFiles(directoryPlan, root, False, journal),
+                                   byDirectory.values())
+            return dict(zip(byDirectory.keys(), results))
+
+
+
+    @staticmethod
+    def projectNames(sourceSpecificPattern, destinationSpecificPattern, salt="", directory=".", ask=True, dryRun=False,
+                     recursive=False, scope="directory", jobs=DEFAULT_JOBS, journal=None):
+        '''
+        V adresáři directory provede promítnutí jmen souborů (viz.
+        planRenames, s recursive v celém stromu viz. planRenamesRecursive).
+        Páry vypíše a před přejmenováním se zeptá uživatele (není-li ask
+        False). Přejmenování se zapisují do journal (viz. renameFiles).
+        Vrací počet neúspěšně přejmenovaných souborů.
+        '''
+        if recursive:
+            plan = list(FileRenamer.planRenamesRecursive(sourceSpecificPattern, destinationSpecificPattern, salt,
+                                                         directory, scope, jobs))
+        else:
+            plan = list(FileRenamer.planRenames(sourceSpecificPattern, destinationSpecificPattern, salt, directory))
+        if len(plan) == 0:
             print("No matching pairs of files were found.")
-            return
+            return 0
 
         # vypsání párů a dotázání se uživatele zda si přeje pokračovat
-        FileRenamer._printProjectedNames(matchedPairs, salt)
-        choice = input("\n\nDo you want to proceed with renaming? (y/n): ")
-        if choice.lower() not in ("y", "yes"):
-            return
-        
+        FileRenamer._printPlan(plan)
+        if recursive:
+            FileRenamer._printSummary(plan)
+        (_, conflicts) = FileRenamer.orderRenames(plan)
+        if conflicts:
+            print("\nwarning: %d files won't be renamed, more files would get the same name:" % len(conflicts))
+            for (_, oldDestinationName, newDestinationName) in conflicts:
+                print(" - \"%s\" -> \"%s\"" % (oldDestinationName, newDestinationName))
+        if dryRun:
+            return 0
+        if ask:
+            choice = input("\n\nDo you want to proceed with renaming? (y/n): ")
+            if choice.lower() not in ("y", "yes"):
+                return 0
+
         # přejmenování souborů
-        fails = 0
-        for (source, oldDestinationName) in matchedPairs:
-            newDestinationName = FileRenamer._getProjectedName(source, oldDestinationName, salt)
-            print("renaming \"%s\"" % oldDestinationName)
-            print("  to \"%s\"" % newDestinationName)
-            try:
-                os.rename(oldDestinationName, newDestinationName)
-            except OSError:
-                fails += 1
+        if recursive:
+            results = FileRenamer.renameFilesByDirectory(plan, directory, jobs, journal)
+            FileRenamer._printSummary(plan, results)
+            failed = [f for (_, directoryFailed) in results.values() for f in directoryFailed]
+            renamed = len(plan) - len(failed)
+        else:
+            (renamed, failed) = FileRenamer.renameFiles(plan, directory, journal=journal)
+        print("\nRenaming done! (%d of %d files renamed succesfully)" % (renamed, len(plan)))
+        return len(failed)
+
+
+
+    @staticmethod
+    def _compilePatterns(sourceSpecificPattern, destinationSpecificPattern):
+        '''
+        Přeloží oba specific patterns (viz. SpecificPattern.compile), vrací
+        trojici (sourceMatcher, destinationMatcher, specificPatternGroups),
+        kde specificPatternGroups jsou názvy groups vyskytující se v obou
+        patterns.
+        Vyhazuje re.error pri nespravnem regularnim vyrazu.
+        '''
+        sourceMatcher = SpecificPattern.compile(sourceSpecificPattern)
+        destinationMatcher = SpecificPattern.compile(destinationSpecificPattern)
+
+        if set(sourceMatcher.groups) ^ set(destinationMatcher.groups):
+            print("warning: in source and destination patterns aren't the same names", file=sys.stderr)
+        return (sourceMatcher, destinationMatcher, [g for g in sourceMatcher.groups if g in destinationMatcher.groups])
+
+
+
+    @staticmethod
+    def _planNames(paths, matchers, salt):
+        '''
+        Spáruje soubory z paths (podle jejich jmen, bez adresáře) a pro každý
+        pár vygeneruje trojici (sourceFile, oldDestinationName,
+        newDestinationName). Nové jméno je ve stejném adresáři jako
+        oldDestinationName. Source soubory bez koncovky se s varováním
+        vynechají.
+        '''
+        (sourceMatcher, destinationMatcher, specificPatternGroups) = matchers
+
+        # jména souborů roztřídíme podle toho, zda odpovídají source/destination specific pattern
+        sourceFileList = []
+        destinationFileList = []
+        for path in paths:
+            fileName = os.path.basename(path)
+            if sourceMatcher.match(fileName):
+                # název bez koncovky nelze promítnout (viz. _getProjectedName)
+                if "." not in fileName:
+                    print("warning: skipping \"%s\", it has no file extension" % path, file=sys.stderr)
+                    continue
+                sourceFileList.append(path)
+            elif destinationMatcher.match(fileName):
+                destinationFileList.append(path)
+
+        # páry souborů, které k sobě podle jejich specific patterns groups patří
+        for (sourceFile, oldDestinationName) in FileRenamer._matchPairs(
+                sourceFileList, destinationFileList, sourceMatcher, destinationMatcher, specificPatternGroups):
+            newDestinationName = FileRenamer._getProjectedName(
+                os.path.basename(sourceFile), os.path.basename(oldDestinationName), salt)
+            # soubory, jejichž název by se nezměnil, nejsou uvažovány
+            if newDestinationName == os.path.basename(oldDestinationName):
+                continue
+            yield (sourceFile, oldDestinationName, os.path.join(os.path.dirname(oldDestinationName), newDestinationName))
 
-        print("\nRenaming done! (%d of %d files renamed succesfully)" % (len(matchedPairs)-fails, len(matchedPairs)))
 
 
+    @staticmethod
+    def _renameStep(directory, old, new, journal):
+        '''
+        Jeden krok přejmenování v adresáři directory, do journal se zapíše
+        předem (s absolutními cestami).
+        '''
+        (old, new) = (os.path.join(directory, old), os.path.join(directory, new))
+        if journal:
+            journal.log(os.path.abspath(old), os.path.abspath(new))
+        FileRenamer._renameNoReplace(old, new)
+
+
+
+    @staticmethod
+    def _renameNoReplace(old, new):
+        '''
+        Přejmenuje old na new, ale nikdy nepřepíše existující new (vyhodí
+        FileExistsError). Na Linuxu atomicky přes renameat2 s
+        RENAME_NOREPLACE, na Windows os.rename nepřepisuje nikdy; jinde (nebo
+        nepodporuje-li flag souborový systém) se new nejdřív zkontroluje,
+        mezi kontrolou a přejmenováním ale může vzniknout.
+        '''
+        if renameat2:
+            if renameat2(AT_FDCWD, os.fsencode(old), AT_FDCWD, os.fsencode(new), RENAME_NOREPLACE) == 0:
+                return
+            err = ctypes.get_errno()
+            if err not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                raise OSError(err, os.strerror(err), old, None, new)
+        if os.name != "nt" and os.path.lexists(new):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), old, None, new)
+        os.rename(old, new)
+
 
+
+    @staticmethod
+    def _tempName(path):
+        '''
+        Dočasné jméno pro soubor path (ve stejném adresáři) při řešení cyklu.
+        '''
+        (directory, name) = os.path.split(path)
+        return os.path.join(directory, ".%s.fr-%d.tmp" % (name, os.getpid()))
+
+
+
+    @staticmethod
+    def _groupByDirectory(plan):
+        '''
+        Rozdělí plán podle adresáře přejmenovávaného souboru, vrací dict
+        adresář -> list trojic (v pořadí plánu).
+        '''
+        byDirectory = {}
+        for triple in plan:
+            byDirectory.setdefault(os.path.dirname(triple[1]), []).append(triple)
+        return byDirectory
+
+
+
+    @staticmethod
+    def _matchPairs(sourceFileList, destinationFileList, sourceMatcher, destinationMatcher, specificPatternGroups):
+        '''
+        Spáruje soubory ze sourceFileList se soubory z destinationFileList,
+        které mají stejné hodnoty všech specificPatternGroups. Každý source
+        soubor dostane první (v pořadí destinationFileList) dosud nespárovaný
+        destination soubor. Vrací list párů (sourceFile, destinationFile).
+
+        Hash join: klíč (hodnoty groups) spočítáme pro každý soubor jen jednou
+        a destination soubory zaindexujeme podle klíče, takže párování je
+        lineární místo porovnávání všech souborů se všemi.
+        '''
+        destinationIndex = {}
+        for destinationFile in destinationFileList:
+            key = FileRenamer._joinKey(destinationMatcher.match(os.path.basename(destinationFile)), specificPatternGroups)
+            destinationIndex.setdefault(key, collections.deque()).append(destinationFile)
+
+        matchedPairs = []
+        for sourceFile in sourceFileList:
+            candidates = destinationIndex.get(
+                FileRenamer._joinKey(sourceMatcher.match(os.path.basename(sourceFile)), specificPatternGroups))
+            if candidates:
+                matchedPairs.append((sourceFile, candidates.popleft()))
+        return matchedPairs
+
+
+
+    @staticmethod
+    def _joinKey(matchObj, specificPatternGroups):
+        '''
+        Klíč souboru pro párování: hodnoty groups v pořadí specificPatternGroups.
+        Groups, které jsou výhradně číselné, převedeme na čísla, takže "04" a "4"
+        dají stejný klíč; ostatní zůstanou řetězci (a číslu se nikdy nerovnají).
+        '''
+        key = []
+        for patternGroup in specificPatternGroups:
+            value = matchObj.group(patternGroup)
+            try:
+                value = int(value)
+            except (ValueError, TypeError): # group není číselná (nebo se neúčastnila matchování)
+                pass
+            key.append(value)
+        return tuple(key)
+
+
+
+    @staticmethod
     def _getProjectedName(sourceFile, destinationFile, salt):
         '''
         Vrátí jméno, které bude mít destinationFile po promítnutí přes
@@ -182,7 +539,7 @@ class FileRenamer:
         if sourceFile.rfind(".") != -1:
             ret = sourceFile[:sourceFile.rfind(".")]
         else:
-            raise ParameterException("sourceFile %s has no file extension" % sourceFile)
+            raise ValueError("sourceFile %s has no file extension" % sourceFile)
 
         if salt:
             ret += salt
@@ -197,136 +554,261 @@ class FileRenamer:
 
 
     
-    def _printProjectedNames(pairs, salt):
+    @staticmethod
+    def _printPlan(plan):
         '''
-        Vypíše jak budou soubory přejmenovány. Pairs je iterable párů
-        (sourceFile, destinationOriginalFile), kde sourceFile je původní
-        název souboru, který se promítne na destinationOriginalFile.
+        Vypíše jak budou soubory přejmenovány. plan je iterable trojic
+        (sourceFile, destinationOriginalFile, destinationNewFile), kde
+        sourceFile je původní název souboru, který se promítne na
+        destinationOriginalFile.
         '''
         print("Following files match together:")
-        for (a, b) in pairs:
+        for (a, b, c) in plan:
             print("\"%s\"" % a)
             print(" - old: \"%s\"" % b)
-            print(" - new: \"%s\"" % FileRenamer._getProjectedName(a, b, salt))
-    
+            print(" - new: \"%s\"" % c)
 
 
-    def _specificPatternToRE(pattern):
+
+    @staticmethod
+    def _printSummary(plan, results=None):
+        '''
+        Vypíše počet plánovaných přejmenování po adresářích; jsou-li zadány
+        results (z renameFilesByDirectory), i počet provedených.
         '''
-        Specific pattern převádí na regexp a tento vrací. Pojmenování
-        polí ve specific pattern se promítne do pojmenování skupin ve
-        výsledném regexpu.
+        print("\nSummary by directory:")
+        for (directory, directoryPlan) in FileRenamer._groupByDirectory(plan).items():
+            if results is None:
+                print("%6d planned   %s" % (len(directoryPlan), directory or "."))
+            else:
+                print("%6d/%d renamed   %s" % (results[directory][0], len(directoryPlan), directory or "."))
+
+
+
+
+class SpecificPattern:
+    '''
+    Přeložený specific pattern. Syntaxe se parsuje jen jednou, pro stejný
+    pattern vrací SpecificPattern.compile stále stejný objekt.
+
+    pattern - původní specific pattern
+    regexp  - odpovídající regulární výraz, pojmenování polí ve specific
+              pattern se promítne do pojmenování skupin
+    groups  - jména proměnných polí v pořadí výskytu (tuple stringů)
 
-        Příklad:
-        >>> pattern = "<season:\\d>x<episode:\\d{2}>"
-        >>> return_value = _specificPatternToRE(pattern)
-        >>> return_value
-        >>> "(?P<season>\\d)x(?P<episode>\\d{2})"
-        ...
-        >>> re.match(return_value, "himym 3x15 - Goat.srt").group("episode")
-        >>> 15
+    Příklad:
+    >>> compiled = SpecificPattern.compile("<season:\\d>x<episode:\\d{2}>")
+    >>> compiled.regexp
+    "(?P<season>\\d)x(?P<episode>\\d{2})"
+    >>> compiled.groups
+    ("season", "episode")
+    >>> compiled.match("himym 3x15 - Goat.srt").group("episode")
+    "15"
+    '''
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def compile(pattern):
+        '''
+        Vrátí přeložený pattern, výsledky si pamatuje (LRU cache podle
+        pattern). Vyhazuje re.error pri nespravnem regularnim vyrazu.
         '''
-        result = ""
+        return SpecificPattern(pattern)
+
 
-        while pattern != "":
-            matchObj = FileRenamer._SPECIFIC_PATTERN_GROUP_MATCHER.search(pattern)
 
-            # v pattern máme konstantní část specific pattern, kterou beze změny zkopírujeme
-            if not matchObj or matchObj.start() != 0:
-                if matchObj: numberOfCharsToCopy = matchObj.start()
-                else: numberOfCharsToCopy = len(pattern)
+    def __init__(self, pattern):
+        self.pattern = pattern
 
-                result += pattern[:numberOfCharsToCopy]
-                pattern = pattern[numberOfCharsToCopy:]
+        # jedním průchodem: konstantní části kopírujeme beze změny, groups
+        # převádíme na pojmenované skupiny regexpu
+        regexp = []
+        groups = []
+        end = 0
+        for matchObj in FileRenamer._SPECIFIC_PATTERN_GROUP_MATCHER.finditer(pattern):
+            if not matchObj.group("id"):
+                raise ValueError("specific pattern group has no groupname (pattern: %s)" % matchObj.group(0))
+            if not matchObj.group("re"):
+                raise ValueError("specific pattern group has no regexp (pattern: %s)" % matchObj.group(0))
+            regexp.append(pattern[end:matchObj.start()])
+            regexp.append("(?P<" + matchObj.group("id") + ">" + matchObj.group("re") + ")")
+            groups.append(matchObj.group("id"))
+            end = matchObj.end()
+        regexp.append(pattern[end:])
 
-            # zpracováváme regexp část specific pattern
-            if matchObj:
-                if not matchObj.group("id"):
-                    raise ArgumentException("specific pattern group has no groupname (pattern: %s)" % matchObj.group(0))
-                if not matchObj.group("re"):
-                    raise ArgumentException("specific pattern group has no regexp (pattern: %s)" % matchObj.group(0))
-                result += "(?P<" + matchObj.group("id") + ">" + matchObj.group("re") + ")"
-                pattern = pattern[len(matchObj.group(0)):]
-        return "^.*" + result + ".*$"
+        self.regexp = "".join(regexp)
+        self.groups = tuple(groups)
+        self.matcher = re.compile(self.regexp)
+        # hladový začátek ustupuje zprava, první shoda je tedy ta nejvíc vpravo
+        self._rightmostMatcher = re.compile(".*(?:" + self.regexp + ")")
 
 
 
-    def _getSpecificPatternGroups(pattern):
+    def match(self, fileName):
         '''
-        Z dané specific pattern vyextrahuje jména proměnných polí a vrátí je
-        jako list stringů.
+        Najde pattern kdekoli v fileName, vrací match object nebo None.
+        Při více výskytech vrací ten, který začíná nejvíc vpravo (stejně
+        jako dřív "^.*" + regexp + ".*$"), najde ho jediné zpětné
+        prohledání přes ".*"; hledání znovu od každého výskytu by bylo na
+        dlouhých jménech kvadratické.
         '''
-        ret = []
+        return self._rightmostMatcher.match(fileName)
 
-        while pattern != "":
-            matchObj = FileRenamer._SPECIFIC_PATTERN_GROUP_MATCHER.search(pattern)
-            if matchObj:
-                ret.append(matchObj.group("id"))
-                pattern = pattern[matchObj.end():]
-            else:
-                pattern = ""
 
-        return ret
-                
 
+    def __repr__(self):
+        return "SpecificPattern(%r)" % self.pattern
 
 
 
-#############################################################################
-#######################               UI               ######################
-#############################################################################
 
-sourceSpecificPattern = ""
-destinationSpecificPattern = ""
-salt = ""
+class RenameJournal:
+    '''
+    Žurnál kroků přejmenování (JSON lines, absolutní cesty) pro pozdější
+    FileRenamer.rollback. Záznam se předá OS ještě před přejmenováním;
+    drahé fsync se dělá jen po SYNC_RECORDS záznamech nebo SYNC_SECS
+    sekundách, výpadek napájení tedy může ztratit poslední záznamy.
+    Lze používat z více vláken.
+    '''
+
+    SYNC_RECORDS = 1000
+    SYNC_SECS = 1.0
+
+
+
+    def __init__(self, path):
+        self.file = open(path, "a", encoding="utf-8")
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        self.lastSync = time.monotonic()
+
+
+
+    def log(self, old, new):
+        with self.lock:
+            self.file.write(json.dumps({"old": old, "new": new}) + "\n")
+            self.file.flush()
+            self.unsynced += 1
+            if self.unsynced >= RenameJournal.SYNC_RECORDS or time.monotonic() - self.lastSync >= RenameJournal.SYNC_SECS:
+                self._sync()
+
+
 
+    def close(self):
+        with self.lock:
+            self._sync()
+            self.file.close()
 
-# zpracování parametrů příkazové řádky
 
-print()
-argc = len(sys.argv)
-if argc not in (2, 3, 5):
-    print("error: incorect parameters")
-    exit(2)
 
-if argc == 2:
-    if sys.argv[1] not in ("-h", "--help"):
-        print("error: incorect parameter \"%s\"" % sys.argv[1])
-        exit(2)
-    else:
+    def _sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.lastSync = time.monotonic()
+
+
+
+    @staticmethod
+    def records(path):
+        '''
+        Vrací dvojice (old, new) zapsané v žurnálu path, v pořadí zápisu.
+        '''
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # poslední záznam mohl být useknut pádem
+                    continue
+                yield (record["old"], record["new"])
+
+
+
+
+#############################################################################
+#######################               UI               ######################
+#############################################################################
+
+def main(argv=None):
+    '''
+    Zpracuje parametry příkazové řádky a provede promítnutí v zadaném
+    adresáři. Vrací exit code.
+    '''
+    parser = argparse.ArgumentParser(
+        prog="fr.py",
+        description="FileRenamer - projects names of files matching sourceSpecificPattern"
+                    " onto files matching destinationSpecificPattern.",
+        epilog="example: ./fr.py -s \".cze\" \"<season:\\d>x<episode:\\d{2}>\" \"s0<season:\\d>e<episode:\\d{2}>\"\n"
+               "For more extensive help read begining of source file fr.py.",
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-s", "--salt", default="", help="suffix added before the extension of renamed files")
+    parser.add_argument("-d", "--directory", default=".", help="directory with the files (default: working directory)")
+    parser.add_argument("-r", "--recursive", action="store_true", help="process the whole directory tree")
+    parser.add_argument("--scope", choices=sorted(FileRenamer.SCOPES), default="directory",
+                        help="with -r, pair files within one directory (default), within each top-level"
+                             " subdirectory, or anywhere in the tree")
+    parser.add_argument("-j", "--jobs", type=int, default=FileRenamer.DEFAULT_JOBS,
+                        help="with -r, directories processed at once (default: %(default)s)")
+    parser.add_argument("-y", "--yes", action="store_true", help="rename without asking")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="only print the plan, rename nothing")
+    parser.add_argument("--json", action="store_true",
+                        help="print the plan as JSON (renames only with --yes, never asks)")
+    parser.add_argument("--journal", metavar="FILE", help="append every rename to FILE, so that it can be rolled back")
+    parser.add_argument("--rollback", metavar="FILE", help="undo the renames recorded in journal FILE and exit")
+    parser.add_argument("sourceSpecificPattern", nargs="?")
+    parser.add_argument("destinationSpecificPattern", nargs="?")
+    args = parser.parse_args(argv)
+
+    if args.rollback:
+        (restored, failed) = FileRenamer.rollback(args.rollback)
+        print("\nRollback done! (%d renames undone, %d failed)" % (restored, len(failed)))
+        return 1 if failed else 0
+    if args.destinationSpecificPattern is None:
+        parser.error("sourceSpecificPattern and destinationSpecificPattern are required")
+
+    journal = RenameJournal(args.journal) if args.journal and not args.dry_run else None
+    try:
+        if args.json:
+            if args.recursive:
+                plan = list(FileRenamer.planRenamesRecursive(args.sourceSpecificPattern, args.destinationSpecificPattern,
+                                                             args.salt, args.directory, args.scope, args.jobs))
+            else:
+                plan = list(FileRenamer.planRenames(args.sourceSpecificPattern, args.destinationSpecificPattern,
+                                                    args.salt, args.directory))
+            json.dump([{"source": a, "old": b, "new": c} for (a, b, c) in plan], sys.stdout, indent=2)
+            print()
+            if args.yes and not args.dry_run:
+                results = FileRenamer.renameFilesByDirectory(plan, args.directory, args.jobs, journal)
+                return 1 if any(failed for (_, failed) in results.values()) else 0
+            return 0
+
+        # tisk vstupních parametrů, prostředí
+        print()
         print("FileRenamer")
         print("(c) David Chaloupka")
         print()
-        print("usage: ./fr.py [-s|--salt salt] sourceSpecificPattern destinationSpecificPattern")
-        print("example: ./fr.py -s \".cze\" \"<season:\d>x<episode:\d{2}>\" \"s0<season:\d>e<episode:\d{2}>\"")
+        print("working directory:            %s%s" % (os.path.abspath(args.directory),
+                                                 " (recursive, %s scope)" % args.scope if args.recursive else ""))
+        print("source specific pattern:      %s" % args.sourceSpecificPattern)
+        print("destination specific pattern: %s" % args.destinationSpecificPattern)
+        print("salt:                         %s" % args.salt)
+        print("-" * 76)
+        print(end="\n\n")
+
+        # samotné promítnutí
+        fails = FileRenamer.projectNames(args.sourceSpecificPattern, args.destinationSpecificPattern, args.salt,
+                                         args.directory, ask=not args.yes, dryRun=args.dry_run,
+                                         recursive=args.recursive, scope=args.scope, jobs=args.jobs, journal=journal)
         print()
-        print("For more extensive help read begining of source file fr.py.")
-        exit(0)
-elif argc == 5:
-    if sys.argv[1] not in ("-s", "--salt"):
-        print("error: incorect parameter \"%s\"" % sys.argv[1])
-        exit(2)
-    salt = sys.argv[2]
-
-sourceSpecificPattern = sys.argv[-2]
-destinationSpecificPattern = sys.argv[-1]
-
-
-# tisk vstupních parametrů, prostředí
-print("FileRenamer")
-print("(c) David Chaloupka")
-print()
-print("working directory:            %s" % os.getcwd())
-print("source specific pattern:      %s" % sourceSpecificPattern)
-print("destination specific pattern: %s" % destinationSpecificPattern)
-print("salt:                         %s" % salt)
-print("-" * 76)
-print(end="\n\n")
-
-# samotné promítnutí
-try:
-    FileRenamer.projectNames(sourceSpecificPattern, destinationSpecificPattern, salt)
-except re.error:
-    print("Error: invalid regular expression.")
-print()
+        return 1 if fails else 0
+    except re.error:
+        print("Error: invalid regular expression.", file=sys.stderr)
+        return 2
+    finally:
+        if journal:
+            journal.close()
+
+
 
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+'''
+Micro-benchmark of the specific pattern matching of fr.py.
+
+Description
+Matches a reproducible set of long synthetic file names (half of them
+containing the pattern somewhere in the middle, half not) against common
+specific patterns, once through the old anchoring "^.*" + regexp + ".*$"
+and once through SpecificPattern.match. Reports names matched per second
+for both and checks that both find the same groups. The same is done for a
+few very long names made of many occurrences of the pattern, where finding
+the rightmost one must not cost a search per occurrence. Also reports the
+cost of getting a compiled pattern with and without the LRU cache, which is
+paid per directory when fr.py runs over many directories.
+
+Usage: python3 fr_bench.py [--names N] [--length N] [--long-length N] [--rounds N] [--seed N]
+'''
+
+import argparse
+import random
+import re
+import string
+import time
+
+from fr import SpecificPattern
+
+
+PATTERNS = [
+    "<season:\\d>x<episode:\\d{2}>",
+    "s0<season:\\d>e<episode:\\d{2}>",
+    "[sS]<season:\\d+>[eE]<episode:\\d+>",
+]
+
+
+
+def makeNames(count, length, seed):
+    '''
+    Returns count file names about length characters long. Every other one
+    contains "1x02" and "s01e02" in the middle, the rest nothing alike.
+    '''
+    rng = random.Random(seed)
+    alphabet = string.ascii_lowercase + " ._-"
+    names = []
+    for i in range(count):
+        prefix = "".join(rng.choice(alphabet) for _ in range(length // 2))
+        suffix = "".join(rng.choice(alphabet) for _ in range(length // 2))
+        middle = " 1x02 s01e02 " if i % 2 == 0 else " "
+        names.append(prefix + middle + suffix + ".srt")
+    return names
+
+
+
+def bestOf(rounds, func):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return (best, result)
+
+
+
+def makeLongNames(length):
+    '''
+    Returns names of about length characters full of occurrences of the
+    patterns: all digits, and repeated "1x02 s01e02 ".
+    '''
+    return ["7" * length + ".srt", " 1x02 s01e02 " * (length // 13) + ".srt"]
+
+
+
+def benchMatch(names, rounds, patterns=PATTERNS):
+    print("%-36s | %12s | %12s | Speedup" % ("Pattern", "^.* names/s", "names/s"))
+    for pattern in patterns:
+        compiled = SpecificPattern.compile(pattern)
+        anchored = re.compile("^.*" + compiled.regexp + ".*$")
+
+        (oldTime, oldGroups) = bestOf(rounds, lambda: [m and m.groupdict() for m in map(anchored.match, names)])
+        (newTime, newGroups) = bestOf(rounds, lambda: [m and m.groupdict() for m in map(compiled.match, names)])
+        assert oldGroups == newGroups, pattern
+
+        print("%-36s | %12.0f | %12.0f | %.1fx" % (pattern, len(names) / oldTime, len(names) / newTime, oldTime / newTime))
+
+
+
+def benchCompile(rounds, count=10000):
+    (uncachedTime, _) = bestOf(rounds, lambda: [SpecificPattern(p) for _ in range(count) for p in PATTERNS])
+    (cachedTime, _) = bestOf(rounds, lambda: [SpecificPattern.compile(p) for _ in range(count) for p in PATTERNS])
+    calls = count * len(PATTERNS)
+    print("\ncompile: %.2f us uncached, %.2f us cached per pattern"
+          % (uncachedTime / calls * 1e6, cachedTime / calls * 1e6))
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmark of the specific pattern matching of fr.py.")
+    parser.add_argument("--names", type=int, default=20000, help="number of file names")
+    parser.add_argument("--length", type=int, default=240, help="length of the file names")
+    parser.add_argument("--long-length", type=int, default=8000, help="length of the very long file names")
+    parser.add_argument("--rounds", type=int, default=5, help="runs of each variant, the best one is reported")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated names")
+    args = parser.parse_args()
+
+    benchMatch(makeNames(args.names, args.length, args.seed), args.rounds)
+    print("\n%d characters long names:" % args.long_length)
+    benchMatch(makeLongNames(args.long_length), args.rounds, PATTERNS + ["<episode:\\d+>"])
+    benchCompile(args.rounds)
@@ -0,0 +1,200 @@
+import contextlib
+import io
+import json
+import os
+import os.path
+import tempfile
+import unittest
+
+import fr
+from fr import FileRenamer, RenameJournal, SpecificPattern
+
+
+SOURCE_PATTERN = "<season:\\d>x<episode:\\d{2}>"
+DESTINATION_PATTERN = "s0<season:\\d>e<episode:\\d{2}>"
+
+
+class TestFileRenamer(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+        for name in ["4x10 - The Fight.avi", "4x11 - Little Minnesota.avi",
+                     "himym_s04e10.srt", "himym_s04e11.srt", "himym_s04e12.srt"]:
+            open(os.path.join(self.root, name), 'w').close()
+
+    def plan(self, salt=".cze"):
+        return sorted(FileRenamer.planRenames(SOURCE_PATTERN, DESTINATION_PATTERN, salt, self.root))
+
+    def test_plan_renames_nothing(self):
+        self.assertEqual(self.plan(), [
+            ("4x10 - The Fight.avi", "himym_s04e10.srt", "4x10 - The Fight.cze.srt"),
+            ("4x11 - Little Minnesota.avi", "himym_s04e11.srt", "4x11 - Little Minnesota.cze.srt"),
+        ])
+        self.assertIn("himym_s04e10.srt", os.listdir(self.root))
+
+    def test_source_without_extension_is_skipped(self):
+        open(os.path.join(self.root, "4x12 - No Extension"), 'w').close()
+
+        with contextlib.redirect_stderr(io.StringIO()) as err, contextlib.redirect_stdout(io.StringIO()):
+            code = fr.main(["-n", "-d", self.root, SOURCE_PATTERN, DESTINATION_PATTERN])
+            plan = self.plan()
+
+        self.assertEqual(code, 0)
+        self.assertIn("4x12 - No Extension", err.getvalue())
+        self.assertEqual([old for (_, old, _) in plan], ["himym_s04e10.srt", "himym_s04e11.srt"])
+
+    def test_rename_files(self):
+        (renamed, failed) = FileRenamer.renameFiles(self.plan(), self.root, verbose=False)
+
+        self.assertEqual((renamed, failed), (2, []))
+        self.assertEqual(sorted(os.listdir(self.root)), [
+            "4x10 - The Fight.avi", "4x10 - The Fight.cze.srt",
+            "4x11 - Little Minnesota.avi", "4x11 - Little Minnesota.cze.srt", "himym_s04e12.srt"])
+
+    def test_main_json_dry_run(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            code = fr.main(["--json", "-s", ".cze", "-d", self.root, SOURCE_PATTERN, DESTINATION_PATTERN])
+
+        self.assertEqual(code, 0)
+        plan = json.loads(out.getvalue())
+        self.assertEqual(sorted((p["source"], p["old"], p["new"]) for p in plan), self.plan())
+        self.assertIn("himym_s04e10.srt", os.listdir(self.root))
+
+    def test_main_yes_renames_without_asking(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            code = fr.main(["--yes", "-d", self.root, SOURCE_PATTERN, DESTINATION_PATTERN])
+
+        self.assertEqual(code, 0)
+        self.assertIn("4x10 - The Fight.srt", os.listdir(self.root))
+
+
+class TestPairing(unittest.TestCase):
+
+    def pairs(self, sources, destinations, sourcePattern=SOURCE_PATTERN, destinationPattern=DESTINATION_PATTERN):
+        (sourceMatcher, destinationMatcher, groups) = FileRenamer._compilePatterns(sourcePattern, destinationPattern)
+        return FileRenamer._matchPairs(sources, destinations, sourceMatcher, destinationMatcher, groups)
+
+    def test_numeric_groups_are_compared_as_numbers(self):
+        self.assertEqual(self.pairs(["4x7 - A.avi", "4x8 - B.avi"], ["s04e07.srt", "s04e008.srt"],
+                                    "<season:\\d+>x<episode:\\d+>", "s<season:\\d+>e<episode:\\d+>"),
+                         [("4x7 - A.avi", "s04e07.srt"), ("4x8 - B.avi", "s04e008.srt")])
+
+    def test_string_groups_are_compared_as_strings(self):
+        self.assertEqual(self.pairs(["ab - A.avi", "04 - B.avi"], ["ab.srt", "4.srt"],
+                                    "<id:\\w+> - ", "<id:\\w+>\\.srt"),
+                         [("ab - A.avi", "ab.srt"), ("04 - B.avi", "4.srt")])
+
+    def test_destination_is_used_once(self):
+        # several destinations with the same key: the first unpaired one wins
+        self.assertEqual(self.pairs(["1x01 - A.avi"], ["x.s01e01.srt", "y.s01e01.srt"]),
+                         [("1x01 - A.avi", "x.s01e01.srt")])
+        self.assertEqual(self.pairs(["1x01 - A.avi", "1x01 - B.avi", "1x01 - C.avi"], ["x.s01e01.srt", "y.s01e01.srt"]),
+                         [("1x01 - A.avi", "x.s01e01.srt"), ("1x01 - B.avi", "y.s01e01.srt")])
+
+
+class TestSpecificPattern(unittest.TestCase):
+
+    def test_compiled_once(self):
+        compiled = SpecificPattern.compile(SOURCE_PATTERN)
+
+        self.assertIs(SpecificPattern.compile(SOURCE_PATTERN), compiled)
+        self.assertEqual(compiled.regexp, "(?P<season>\\d)x(?P<episode>\\d{2})")
+        self.assertEqual(compiled.groups, ("season", "episode"))
+
+    def test_match_takes_rightmost_occurrence(self):
+        compiled = SpecificPattern.compile("<episode:\\d{2}>")
+
+        self.assertEqual(compiled.match("Show 2010 - 05.srt").group("episode"), "05")
+        self.assertIsNone(compiled.match("Show - 5.srt"))
+
+
+class TestRecursive(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+        for rel_path in ["S1/1x01 - Pilot.avi", "S1/himym_s01e01.srt",
+                         "S2/2x01 - Where Were We.avi", "S2/subs/himym_s02e01.srt", "S2/subs/himym_s01e01.srt"]:
+            os.makedirs(os.path.join(self.root, os.path.dirname(rel_path)), exist_ok=True)
+            open(os.path.join(self.root, rel_path), 'w').close()
+
+    def plan(self, scope):
+        return list(FileRenamer.planRenamesRecursive(SOURCE_PATTERN, DESTINATION_PATTERN, "", self.root, scope, jobs=2))
+
+    def test_scopes(self):
+        s1 = (os.path.join("S1", "1x01 - Pilot.avi"), os.path.join("S1", "himym_s01e01.srt"),
+              os.path.join("S1", "1x01 - Pilot.srt"))
+        s2 = (os.path.join("S2", "2x01 - Where Were We.avi"), os.path.join("S2", "subs", "himym_s02e01.srt"),
+              os.path.join("S2", "subs", "2x01 - Where Were We.srt"))
+
+        self.assertEqual(self.plan("directory"), [s1])
+        self.assertEqual(self.plan("subtree"), [s1, s2])
+        # Over the whole tree S1/1x01 pairs with the first s01e01 subtitles, a destination is used once.
+        self.assertEqual(self.plan("tree"), [s1, s2])
+
+    def test_rename_by_directory(self):
+        plan = self.plan("subtree")
+
+        results = FileRenamer.renameFilesByDirectory(plan, self.root, jobs=2)
+
+        self.assertEqual(results, {"S1": (1, []), os.path.join("S2", "subs"): (1, [])})
+        for (_, _, new) in plan:
+            self.assertTrue(os.path.exists(os.path.join(self.root, new)))
+
+
+class TestSafeRename(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+        for name in ["a", "b", "c", "x"]:
+            with open(os.path.join(self.root, name), 'w') as f:
+                f.write(name)
+
+    def contents(self):
+        ret = {}
+        for name in os.listdir(self.root):
+            with open(os.path.join(self.root, name)) as f:
+                ret[name] = f.read()
+        return ret
+
+    def test_chains_cycles_and_collisions(self):
+        plan = [("", "a", "b"), ("", "b", "a"),   # cycle
+                ("", "c", "d"), ("", "x", "c"),   # chain
+                ("", "e", "f"), ("", "g", "f")]   # collision
+
+        (renamed, failed) = FileRenamer.renameFiles(plan, self.root, verbose=False)
+
+        self.assertEqual(renamed, 4)
+        self.assertEqual(sorted(failed), [("", "e", "f"), ("", "g", "f")])
+        self.assertEqual(self.contents(), {"a": "b", "b": "a", "c": "x", "d": "c"})
+
+    def test_never_overwrites(self):
+        (renamed, failed) = FileRenamer.renameFiles([("", "a", "b"), ("", "c", "e")], self.root, verbose=False)
+
+        self.assertEqual((renamed, failed), (1, [("", "a", "b")]))
+        self.assertEqual(self.contents(), {"a": "a", "b": "b", "e": "c", "x": "x"})
+
+    def test_rollback(self):
+        journalPath = os.path.join(self.root, "journal")
+        original = self.contents()
+        journal = RenameJournal(journalPath)
+        FileRenamer.renameFiles([("", "a", "b"), ("", "b", "c"), ("", "c", "a"), ("", "x", "y")],
+                                self.root, verbose=False, journal=journal)
+        journal.close()
+        self.assertNotEqual(self.contents(), dict(original, journal=self.contents()["journal"]))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            (restored, failed) = FileRenamer.rollback(journalPath)
+
+        self.assertEqual((restored, failed), (5, []))
+        self.assertEqual(self.contents(), dict(original, journal=self.contents()["journal"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+# Directory walker shared by the tools in this repo.
+#
+# Directories are listed concurrently on a thread pool (listing is latency bound
+# on network mounts and slow disks), yet the output order is deterministic: all
+# files of a directory sorted by name, then its subdirectories in name order,
+# depth first. The walk is iterative, so it isn't limited by the recursion depth.
+# Symlinks are followed, but each directory is entered only once, which also
+# breaks symlink loops. A directory that can't be listed is skipped with a
+# warning (silently if it has vanished meanwhile).
+
+import fnmatch
+import os
+import os.path
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, Optional
+
+
+DEFAULT_JOBS = 8
+
+
+def walk_files(
+        root : str,
+        include : Iterable[str] = (),
+        exclude : Iterable[str] = (),
+        max_depth : Optional[int] = None,
+        jobs : int = DEFAULT_JOBS) -> Iterator[os.DirEntry]:
+    """
+    Yields files under `root` as `os.DirEntry`.
+
+    include   -- if given, only files matching one of these globs are yielded
+    exclude   -- files and directories matching one of these globs are skipped,
+                 excluded directories aren't even listed (e.g. '.git', '*.hdn')
+    max_depth -- depth of subdirectories to descend into, 0 is `root` only
+    jobs      -- number of directories listed at once, 1 lists them serially
+
+    A glob matches either the name of an entry or its path relative to `root`.
+    """
+    include = list(include)
+    exclude = list(exclude)
+
+    def matches(entry : os.DirEntry, patterns : list[str]) -> bool:
+        return matches_any(entry.name, os.path.relpath(entry.path, root), patterns)
+
+    def dir_key(path : str, entry : Optional[os.DirEntry] = None) -> tuple[int, int]:
+        # On Windows DirEntry.stat() doesn't fill in st_dev and st_ino.
+        st = entry.stat() if entry and os.name != 'nt' else os.stat(path)
+        return (st.st_dev, st.st_ino)
+
+    def list_dir(path : str) -> tuple[list[os.DirEntry], list[tuple[os.DirEntry, tuple[int, int]]]]:
+        files = []
+        dirs = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if exclude and matches(entry, exclude):
+                        continue
+                    try:
+                        if entry.is_dir():
+                            dirs.append((entry, dir_key(entry.path, entry)))
+                        elif entry.is_file() and (not include or matches(entry, include)):
+                            files.append(entry)
+                    except OSError:
+                        continue  # Vanished or broken entry.
+        except FileNotFoundError:
+            pass  # Removed since its parent was listed.
+        except OSError as e:
+            print(f"Warning: can't list '{path}' ({e.strerror or e})", file=sys.stderr)
+        files.sort(key=lambda e: e.name)
+        dirs.sort(key=lambda d: d[0].name)
+        return (files, dirs)
+
+    executor = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+
+    def start_listing(path : str):
+        # Serially, a directory is only listed once the walk gets to it.
+        return executor.submit(list_dir, path) if executor else path
+
+    def finish_listing(listing) -> tuple[list[os.DirEntry], list[os.DirEntry]]:
+        return listing.result() if executor else list_dir(listing)
+
+    # Directories already entered by (st_dev, st_ino), decided in walk order.
+    visited = {dir_key(root)}
+    try:
+        # Stack of (depth, iterator over pending listings of sibling directories).
+        stack = [(0, iter([start_listing(root)]))]
+        while stack:
+            (depth, listings) = stack[-1]
+            listing = next(listings, None)
+            if listing is None:
+                stack.pop()
+                continue
+            (files, dirs) = finish_listing(listing)
+            yield from files
+            if max_depth is None or depth < max_depth:
+                subdirs = []
+                for (d, key) in dirs:
+                    if key not in visited:
+                        visited.add(key)
+                        subdirs.append(d)
+                # Start listing all subdirectories now, they get consumed in order.
+                stack.append((depth + 1, iter([start_listing(d.path) for d in subdirs])))
+    finally:
+        if executor:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def matches_any(name : str, rel_path : str, patterns : Iterable[str]) -> bool:
+    return any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(rel_path, p) for p in patterns)
+
+
+def path_included(
+        root : str,
+        path : str,
+        include : Iterable[str] = (),
+        exclude : Iterable[str] = (),
+        max_depth : Optional[int] = None,
+        is_dir : bool = False) -> bool:
+    """
+    Whether `walk_files` with the same options would yield the file `path`
+    (or list the directory `path` if `is_dir`), judged by the path alone. For
+    paths learned otherwise, e.g. reported by a watcher.
+    """
+    rel_path = os.path.relpath(path, root)
+    if rel_path == os.curdir:
+        return is_dir
+    parts = rel_path.split(os.sep)
+    if parts[0] == os.pardir:
+        return False
+    dir_depth = len(parts) if is_dir else len(parts) - 1
+    if max_depth is not None and dir_depth > max_depth:
+        return False
+    # The path and each directory above it up to `root`.
+    for i in range(len(parts)):
+        if matches_any(parts[i], os.path.join(*parts[:i + 1]), exclude):
+            return False
+    include = list(include)
+    return is_dir or not include or matches_any(parts[-1], rel_path, include)
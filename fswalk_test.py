@@ -0,0 +1,93 @@
+import io
+import os
+import os.path
+import sys
+import tempfile
+import unittest
+
+from unittest.mock import patch
+
+import fswalk
+
+
+class TestWalkFiles(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+
+    def write_file(self, rel_path):
+        path = os.path.join(self.root, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'w').close()
+
+    def walk(self, **kwargs):
+        return [os.path.relpath(e.path, self.root) for e in fswalk.walk_files(self.root, **kwargs)]
+
+    def test_order_is_deterministic(self):
+        for rel_path in ['b/2', 'b/1', 'a/x/1', 'a/1', 'z', 'c']:
+            self.write_file(rel_path)
+        expected = ['c', 'z', 'a/1', 'a/x/1', 'b/1', 'b/2']
+
+        for jobs in [1, 4]:
+            with self.subTest(jobs=jobs):
+                self.assertEqual(self.walk(jobs=jobs), expected)
+
+    def test_include_exclude_and_max_depth(self):
+        for rel_path in ['a.mp4', 'a.txt', '.git/objects/b.mp4', 'sub/c.mp4', 'sub/deeper/d.mp4', 'skip/e.mp4']:
+            self.write_file(rel_path)
+
+        self.assertEqual(self.walk(include=['*.mp4'], exclude=['.git', 'skip']),
+                         ['a.mp4', 'sub/c.mp4', 'sub/deeper/d.mp4'])
+        self.assertEqual(self.walk(exclude=['sub/deeper', '*.txt', '.git']), ['a.mp4', 'skip/e.mp4', 'sub/c.mp4'])
+        self.assertEqual(self.walk(include=['*.mp4'], exclude=['.git'], max_depth=1),
+                         ['a.mp4', 'skip/e.mp4', 'sub/c.mp4'])
+        self.assertEqual(self.walk(max_depth=0), ['a.mp4', 'a.txt'])
+
+    def test_symlink_loops_are_entered_once(self):
+        for rel_path in ['a/1', 'b/2']:
+            self.write_file(rel_path)
+        os.symlink('..', os.path.join(self.root, 'a', 'loop'))
+        os.symlink(os.path.join(self.root, 'b'), os.path.join(self.root, 'a', 'to_b'))
+
+        for jobs in [1, 4]:
+            with self.subTest(jobs=jobs):
+                self.assertEqual(self.walk(jobs=jobs), ['a/1', 'b/2'])
+
+    def test_unlistable_directory_is_skipped(self):
+        for rel_path in ['a/1', 'b/2', 'c/3']:
+            self.write_file(rel_path)
+        scandir = os.scandir
+        def failing_scandir(path):
+            if os.path.basename(path) == 'b':
+                raise PermissionError(13, 'Permission denied', path)
+            return scandir(path)
+
+        with patch('os.scandir', failing_scandir), patch('sys.stderr', io.StringIO()) as stderr:
+            self.assertEqual(self.walk(jobs=1), ['a/1', 'c/3'])
+        self.assertIn('Permission denied', stderr.getvalue())
+
+    def test_nesting_deeper_than_recursion_limit(self):
+        depth = sys.getrecursionlimit() + 100
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.root)
+        try:
+            for _ in range(depth):
+                os.mkdir('d')
+                os.chdir('d')
+            open('leaf', 'w').close()
+        finally:
+            os.chdir(self.root)
+
+        files = list(fswalk.walk_files('d', jobs=2))
+
+        self.assertEqual([f.name for f in files], ['leaf'])
+        # shutil.rmtree of the temporary directory would hit the recursion limit.
+        os.remove(files[0].path)
+        for level in range(depth, 0, -1):
+            os.rmdir(os.path.join(*['d'] * level))
+
+
+if __name__ == '__main__':
+    unittest.main()
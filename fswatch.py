@@ -0,0 +1,243 @@
+# Watching a directory tree for new files, shared by the tools in this repo.
+#
+# On Linux the kernel reports changes through inotify (called through ctypes, no
+# dependency needed), so the cost is proportional to the rate of changes, not to
+# the size of the tree. Elsewhere, or when inotify runs out of watches, the tree
+# is polled by periodic walks.
+
+import ctypes
+import errno
+import os
+import os.path
+import platform
+import select
+import stat
+import struct
+import sys
+import time
+
+from typing import Iterable, Iterator, Optional
+
+import fswalk
+
+
+DEFAULT_POLL_SECS = 30.0
+DEFAULT_SETTLE_SECS = 5.0
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+def load_libc() -> Optional[ctypes.CDLL]:
+    if platform.system() != 'Linux':
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        (libc.inotify_init1, libc.inotify_add_watch)
+    except (OSError, AttributeError):
+        return None
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+libc = load_libc()
+
+
+def filter_options(recursive : bool, include : Iterable[str], exclude : Iterable[str],
+                   max_depth : Optional[int]) -> dict:
+    """Options of `fswalk.walk_files` selecting the watched files."""
+    return {'include': list(include), 'exclude': list(exclude), 'max_depth': max_depth if recursive else 0}
+
+
+class InotifyWatcher:
+    """
+    Reports files created, written or moved in under `root` using inotify.
+    Only files `fswalk.walk_files` would yield with the given include/exclude
+    globs and max_depth are reported, excluded directories aren't watched.
+    """
+
+    def __init__(self, root : str, recursive : bool = True, include : Iterable[str] = (),
+                 exclude : Iterable[str] = (), max_depth : Optional[int] = None):
+        self.root = root
+        self.options = filter_options(recursive, include, exclude, max_depth)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise_errno(root)
+        self.dirs = {}  # Watch descriptor -> directory path.
+        try:
+            self._watch_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def changed_paths(self, timeout : Optional[float]) -> list[str]:
+        """Paths of changed files, waits up to `timeout` seconds (forever if None) for some."""
+        (readable, _, _) = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = b''
+        while True:
+            try:
+                data += os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+        changed = []
+        offset = 0
+        while offset < len(data):
+            (wd, mask, _, name_len) = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + name_len].rstrip(b'\0')
+            offset += EVENT_HEADER.size + name_len
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, fall back to a full walk.
+                changed += walk_paths(self.root, **self.options)
+            elif mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+            elif wd in self.dirs:
+                path = os.path.join(self.dirs[wd], os.fsdecode(name))
+                if not mask & IN_ISDIR:
+                    if fswalk.path_included(self.root, path, **self.options):
+                        changed.append(path)
+                elif mask & (IN_CREATE | IN_MOVED_TO) and self._dir_included(path):
+                    # Files may have landed in the new directory before the watch did.
+                    self._watch_tree(path)
+                    changed += [p for p in walk_paths(path, exclude=self.options['exclude'])
+                                if fswalk.path_included(self.root, p, **self.options)]
+        return changed
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+    def _dir_included(self, path : str) -> bool:
+        return fswalk.path_included(self.root, path, is_dir=True, **self.options)
+
+    def _watch_tree(self, top : str) -> None:
+        dirs = [top]
+        while dirs:
+            path = dirs.pop()
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK | IN_ONLYDIR)
+            if wd < 0:
+                if ctypes.get_errno() in (errno.ENOENT, errno.ENOTDIR):
+                    continue  # Gone already.
+                self._raise_errno(path)
+            self.dirs[wd] = path
+            try:
+                with os.scandir(path) as it:
+                    dirs += [e.path for e in it if e.is_dir(follow_symlinks=False) and self._dir_included(e.path)]
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _raise_errno(path : str):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+
+
+class PollingWatcher:
+    """
+    Reports files created or changed under `root` by walking it every `interval`
+    seconds, with the given include/exclude globs and max_depth.
+    """
+
+    def __init__(self, root : str, recursive : bool = True, interval : float = DEFAULT_POLL_SECS,
+                 include : Iterable[str] = (), exclude : Iterable[str] = (), max_depth : Optional[int] = None):
+        self.root = root
+        self.options = filter_options(recursive, include, exclude, max_depth)
+        self.interval = interval
+        self.seen = self._scan()
+        self.next_poll = time.monotonic() + interval
+
+    def changed_paths(self, timeout : Optional[float]) -> list[str]:
+        now = time.monotonic()
+        wait = self.next_poll - now if timeout is None else min(timeout, self.next_poll - now)
+        time.sleep(max(0, wait))
+        if time.monotonic() < self.next_poll:
+            return []
+        current = self._scan()
+        changed = [path for path, signature in current.items() if self.seen.get(path) != signature]
+        self.seen = current
+        self.next_poll = time.monotonic() + self.interval
+        return changed
+
+    def close(self) -> None:
+        pass
+
+    def _scan(self) -> dict[str, tuple[int, int]]:
+        signatures = {}
+        for path in walk_paths(self.root, **self.options):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            signatures[path] = (st.st_size, st.st_mtime_ns)
+        return signatures
+
+
+def walk_paths(root : str, **walk_options) -> list[str]:
+    """
+    Paths of files under `root` (see `fswalk.walk_files`), none if `root` is
+    gone already (e.g. a temporary directory of a downloader) or unreadable.
+    """
+    try:
+        return [e.path for e in fswalk.walk_files(root, **walk_options)]
+    except OSError:
+        return []
+
+
+def open_watcher(root : str, recursive : bool = True, poll_secs : float = DEFAULT_POLL_SECS, **options):
+    """
+    An inotify watcher where possible, otherwise a polling one. Further
+    options (include/exclude globs, max_depth) select the watched files.
+    """
+    if libc:
+        try:
+            return InotifyWatcher(root, recursive, **options)
+        except OSError as e:
+            # Typically ENOSPC, too few fs.inotify.max_user_watches for the tree.
+            print(f"Warning: cannot watch '{root}' with inotify ({e.strerror}), polling every {poll_secs} s",
+                  file=sys.stderr)
+    return PollingWatcher(root, recursive, poll_secs, **options)
+
+
+def settled_files(watcher, settle_secs : float = DEFAULT_SETTLE_SECS) -> Iterator[str]:
+    """
+    Yields regular files reported by `watcher` once they stay unchanged (size
+    and mtime) for `settle_secs`, so that files still being written (copied,
+    downloaded) aren't touched. Runs until interrupted.
+    """
+    pending = {}  # Path -> (signature, deadline).
+
+    def signature(path : str) -> Optional[tuple[int, int]]:
+        try:
+            st = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        return (st.st_size, st.st_mtime_ns) if stat.S_ISREG(st.st_mode) else None
+
+    while True:
+        timeout = max(0, min(d for (_, d) in pending.values()) - time.monotonic()) if pending else None
+        for path in watcher.changed_paths(timeout):
+            pending[path] = (signature(path), time.monotonic() + settle_secs)
+
+        now = time.monotonic()
+        for path, (old_signature, deadline) in list(pending.items()):
+            if deadline > now:
+                continue
+            new_signature = signature(path)
+            if new_signature is None:
+                del pending[path]
+            elif new_signature != old_signature:
+                # Changed without an event (polling), give it more time.
+                pending[path] = (new_signature, now + settle_secs)
+            else:
+                del pending[path]
+                yield path
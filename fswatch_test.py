@@ -0,0 +1,110 @@
+import os
+import os.path
+import tempfile
+import time
+import unittest
+
+import fswatch
+
+
+class FakeWatcher:
+    def __init__(self, batches):
+        self.batches = list(batches)
+
+    def changed_paths(self, timeout):
+        if self.batches:
+            return self.batches.pop(0)
+        time.sleep(timeout or 0)
+        return []
+
+
+class TestWatch(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+
+    def write_file(self, rel_path, content=b'x'):
+        path = os.path.join(self.root, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def collect(self, watcher, attempts=20):
+        changed = set()
+        for _ in range(attempts):
+            changed.update(watcher.changed_paths(timeout=0.05))
+        return changed
+
+    @unittest.skipUnless(fswatch.libc, 'inotify is Linux only')
+    def test_inotify_reports_files_in_new_directories(self):
+        watcher = fswatch.InotifyWatcher(self.root)
+        self.addCleanup(watcher.close)
+
+        paths = {self.write_file('a.mp4'), self.write_file('new/sub/b.mkv')}
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(self.root)) as outside:
+            moved_in = os.path.join(outside, 'c.avi')
+            open(moved_in, 'w').close()
+            os.rename(moved_in, os.path.join(self.root, 'c.avi'))
+        paths.add(os.path.join(self.root, 'c.avi'))
+
+        self.assertTrue(paths <= self.collect(watcher))
+
+    @unittest.skipUnless(fswatch.libc, 'inotify is Linux only')
+    def test_inotify_ignores_directories_gone_already(self):
+        watcher = fswatch.InotifyWatcher(self.root)
+        self.addCleanup(watcher.close)
+
+        os.makedirs(os.path.join(self.root, 'tmp', 'sub'))
+        os.rmdir(os.path.join(self.root, 'tmp', 'sub'))
+        os.rmdir(os.path.join(self.root, 'tmp'))
+        path = self.write_file('a.mp4')
+
+        self.assertEqual(self.collect(watcher), {path})
+
+    @unittest.skipUnless(fswatch.libc, 'inotify is Linux only')
+    def test_inotify_applies_walk_options(self):
+        os.makedirs(os.path.join(self.root, '.git', 'objects'))
+        watcher = fswatch.InotifyWatcher(self.root, exclude=['.git', '*.part'], max_depth=1)
+        self.addCleanup(watcher.close)
+
+        expected = {self.write_file('a.mp4'), self.write_file('new/b.mp4')}
+        for rel_path in ['.git/objects/c.mp4', 'new/deeper/d.mp4', 'e.mp4.part']:
+            self.write_file(rel_path)
+
+        self.assertEqual(self.collect(watcher), expected)
+        self.assertNotIn(os.path.join(self.root, '.git'), watcher.dirs.values())
+
+    def test_polling_applies_walk_options(self):
+        watcher = fswatch.PollingWatcher(self.root, interval=0.01, exclude=['.git'], max_depth=0)
+
+        expected = {self.write_file('a.mp4')}
+        self.write_file('.git/b.mp4')
+        self.write_file('sub/c.mp4')
+
+        self.assertEqual(self.collect(watcher, attempts=5), expected)
+
+    def test_polling_reports_new_and_changed_files(self):
+        self.write_file('old.mp4')
+        changed = self.write_file('changed.mp4')
+        watcher = fswatch.PollingWatcher(self.root, interval=0.01)
+
+        new = self.write_file('sub/new.mp4')
+        self.write_file('changed.mp4', b'longer')
+
+        self.assertEqual(self.collect(watcher, attempts=5), {new, changed})
+
+    def test_settled_files_waits_for_writes_to_stop(self):
+        path = self.write_file('a.mp4')
+        # Reported, then written again before it settles.
+        watcher = FakeWatcher([[path], [], [path]])
+        settled = fswatch.settled_files(watcher, settle_secs=0.05)
+
+        self.assertEqual(next(settled), path)
+        self.assertEqual(watcher.batches, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,14 @@
 # media scanner and polute the feed.
 
 import argparse
+import array
+import collections
+import csv
+import ctypes
 import datetime
+import heapq
+import itertools
+import json
 import os
 import os.path
 import platform
@@ -10,99 +17,477 @@ import random
 import re
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
+import fswalk
+import fswatch
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from functools import partial
-from typing import Callable, Iterator
+from typing import Callable, Iterator, NamedTuple, Optional
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 HIDDEN_EXTENSION = 'hdn'
 MEDIA_EXTENSIONS = {'3gp', 'asf', 'avi', 'flv', 'webm', 'mkv', 'mp4', 'mpeg', 'mpg', 'mov', 'wmv'}
 
+# Renames are latency bound (especially on network mounts), so run several at once.
+DEFAULT_JOBS = 8
+# Max number of files of a single directory handed to a worker at once.
+BATCH_SIZE = 64
+
+# --print-time: longer paths are shortened in the table, sorting spills runs of this many rows.
+MAX_PATH_WIDTH = 80
+SORT_RUN_SIZE = 100_000
+
+# The journal is fsynced after this many records or seconds, whatever comes first.
+JOURNAL_SYNC_RECORDS = 1000
+JOURNAL_SYNC_SECS = 1.0
+
+# Only Windows has a way to set the creation time (see `set_file_times`).
+CTIME_SETTABLE = platform.system() == 'Windows'
+# Unknown ctime in the int64 columns of `RetimePlan`.
+NO_CTIME = -2**63
+
+NS_PER_MS = 1_000_000
+NS_PER_SEC = 1_000_000_000
+
 
 def find_files(
         path : str,
         file_filter : Callable[[os.DirEntry], bool],
-        recurse : bool) -> Iterator[os.DirEntry]:
+        recurse : bool,
+        **walk_options) -> Iterator[os.DirEntry]:
+    """
+    Files under `path` passing `file_filter`. Further options (include/exclude
+    globs, max_depth, jobs) are passed to `fswalk.walk_files`.
+    """
     # Support specifying a concrete file instead of a directory. Must do this via
     # a limited `os.scandir` to get the file as an `os.DirEntry`.
     if os.path.isfile(path):
         file_filter2 = lambda entry: file_filter(entry) and entry.name == os.path.basename(path)
-        yield from find_files(os.path.dirname(path), file_filter2, recurse=False)
+        yield from find_files(os.path.dirname(path) or '.', file_filter2, recurse=False, **walk_options)
         return
-    with os.scandir(path) as it:
-        for entry in it:
-            if entry.is_file() and file_filter(entry):
-                yield entry
-            if entry.is_dir() and recurse:
-                yield from find_files(entry.path, file_filter, recurse)
+    if not recurse:
+        walk_options['max_depth'] = 0
+    for entry in fswalk.walk_files(path, **walk_options):
+        if file_filter(entry):
+            yield entry
+
+class BatchSummary(NamedTuple):
+    processed : int
+    failed : list[tuple[str, Exception]]
+
+def batches_by_directory(
+        files : Iterator[os.DirEntry],
+        batch_size : int = BATCH_SIZE) -> Iterator[list[os.DirEntry]]:
+    # Consecutive files of the same directory (as `find_files` yields them) go
+    # to the same batch, so that a batch touches a single directory.
+    batch = []
+    for file in files:
+        if batch and (len(batch) >= batch_size or
+                      os.path.dirname(file.path) != os.path.dirname(batch[0].path)):
+            yield batch
+            batch = []
+        batch.append(file)
+    if batch:
+        yield batch
+
+def run_batched(
+        files : Iterator[os.DirEntry],
+        file_mutator : Callable[[os.DirEntry], None],
+        jobs : int = DEFAULT_JOBS) -> BatchSummary:
+    """
+    Applies `file_mutator` to all files on a pool of `jobs` threads, a batch of
+    files of one directory at a time. A failure of one file doesn't stop the
+    others, failures are collected in the returned summary instead.
+    """
+    def run_batch(batch : list[os.DirEntry]) -> list[tuple[str, Exception]]:
+        batch_failed = []
+        for file in batch:
+            try:
+                file_mutator(file)
+            except OSError as e:
+                batch_failed.append((file.path, e))
+        return batch_failed
+
+    processed = 0
+    failed = []
+    if jobs <= 1:
+        for batch in batches_by_directory(files):
+            failed += run_batch(batch)
+            processed += len(batch)
+        return BatchSummary(processed, failed)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        # Bound the number of batches in flight, `files` may be a lazy walk over a huge tree.
+        pending = set()
+        for batch in batches_by_directory(files):
+            if len(pending) >= 2 * jobs:
+                (done, pending) = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    failed += future.result()
+            pending.add(executor.submit(run_batch, batch))
+            processed += len(batch)
+        for future in pending:
+            failed += future.result()
+    failed.sort(key=lambda failure: failure[0])
+    return BatchSummary(processed, failed)
+
+def print_batch_summary(summary : BatchSummary, action : str) -> None:
+    if not summary.failed:
+        return
+    print(f"Failed to {action} {len(summary.failed)} of {summary.processed} files:", file=sys.stderr)
+    for (path, error) in summary.failed:
+        print(f"  - '{path}': {error.strerror or error}", file=sys.stderr)
 
 def rename_files_keeping_time(
         files : Iterator[os.DirEntry],
         renamer : Callable[[str], str],
-        **kvargs) -> None:
+        jobs : int = DEFAULT_JOBS,
+        **kvargs) -> BatchSummary:
     file_mutator = partial(rename_file_keeping_time, renamer=renamer, **kvargs)
-    list(map(file_mutator, files))
+    # Simulation only prints, keep its output in the order of the walk.
+    if kvargs.get('dry_run'):
+        jobs = 1
+    return run_batched(files, file_mutator, jobs)
 
 def rename_file_keeping_time(
         file : os.DirEntry,
         renamer : Callable[[str], str],
         dry_run : bool,
-        verbose : bool) -> None:
-    orig_path = file.path
-    orig_stat = file.stat()
-    new_path = renamer(file.path)
+        verbose : bool,
+        journal : 'Journal' = None) -> None:
+    rename_path_keeping_time(file.path, file.stat(), renamer, dry_run, verbose, journal)
+
+def rename_path_keeping_time(
+        orig_path : str,
+        orig_stat : os.stat_result,
+        renamer : Callable[[str], str],
+        dry_run : bool,
+        verbose : bool,
+        journal : 'Journal' = None) -> None:
+    new_path = renamer(orig_path)
     if dry_run:
         print(f"Simulating rename of '{orig_path}'")
         return
     if verbose: print(f"Renaming '{orig_path}'")
+    if journal:
+        journal.log({'op': 'rename', 'src': os.path.abspath(orig_path), 'dst': os.path.abspath(new_path),
+                     'atime_ns': orig_stat.st_atime_ns, 'mtime_ns': orig_stat.st_mtime_ns})
     os.rename(orig_path, new_path)
-    os.utime(new_path, times=(orig_stat.st_atime, orig_stat.st_mtime))
+    os.utime(new_path, ns=(orig_stat.st_atime_ns, orig_stat.st_mtime_ns))
+
+def watch_and_rename(
+        watcher,
+        name_filter : Callable[[str], bool],
+        renamer : Callable[[str], str],
+        settle_secs : float,
+        **kvargs) -> None:
+    """
+    Renames files matching `name_filter` as `watcher` (see `fswatch`) reports
+    them created, written or moved in, once they are no longer being written.
+    Runs until interrupted.
+    """
+    for file_path in fswatch.settled_files(watcher, settle_secs):
+        if not name_filter(os.path.basename(file_path)):
+            continue
+        try:
+            rename_path_keeping_time(file_path, os.stat(file_path), renamer, **kvargs)
+        except OSError as e:
+            print(f"Failed to rename '{file_path}': {e.strerror or e}", file=sys.stderr)
+
+# Linux reports the birth time only through `statx` (Linux 4.11, glibc 2.28), which
+# Python's `os.stat` doesn't use. Called through ctypes, if unavailable `statx` is None.
+
+class StatxTimestamp(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_int64), ('tv_nsec', ctypes.c_uint32), ('_reserved', ctypes.c_int32)]
+
+class Statx(ctypes.Structure):
+    _fields_ = [
+        ('stx_mask', ctypes.c_uint32), ('stx_blksize', ctypes.c_uint32),
+        ('stx_attributes', ctypes.c_uint64), ('stx_nlink', ctypes.c_uint32),
+        ('stx_uid', ctypes.c_uint32), ('stx_gid', ctypes.c_uint32),
+        ('stx_mode', ctypes.c_uint16), ('_spare0', ctypes.c_uint16),
+        ('stx_ino', ctypes.c_uint64), ('stx_size', ctypes.c_uint64),
+        ('stx_blocks', ctypes.c_uint64), ('stx_attributes_mask', ctypes.c_uint64),
+        ('stx_atime', StatxTimestamp), ('stx_btime', StatxTimestamp),
+        ('stx_ctime', StatxTimestamp), ('stx_mtime', StatxTimestamp),
+        ('stx_rdev_major', ctypes.c_uint32), ('stx_rdev_minor', ctypes.c_uint32),
+        ('stx_dev_major', ctypes.c_uint32), ('stx_dev_minor', ctypes.c_uint32),
+        ('_spare2', ctypes.c_uint64 * 14),
+    ]
+
+AT_FDCWD = -100
+STATX_ATIME = 0x20
+STATX_MTIME = 0x40
+STATX_BTIME = 0x800
+
+def load_statx() -> Optional[Callable]:
+    if platform.system() != 'Linux':
+        return None
+    try:
+        func = ctypes.CDLL(None, use_errno=True).statx
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_uint, ctypes.POINTER(Statx)]
+    func.restype = ctypes.c_int
+    return func
+
+statx = load_statx()
+
+def statx_times(path : str) -> 'FileTimes':
+    buf = Statx()
+    if statx(AT_FDCWD, os.fsencode(path), 0, STATX_ATIME | STATX_MTIME | STATX_BTIME, ctypes.byref(buf)) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+    to_ns = lambda ts: ts.tv_sec * NS_PER_SEC + ts.tv_nsec
+    # Not every filesystem records the birth time.
+    btime_ns = to_ns(buf.stx_btime) if buf.stx_mask & STATX_BTIME else None
+    return FileTimes(path, btime_ns, to_ns(buf.stx_mtime), to_ns(buf.stx_atime))
+
+class FileTimes:
+    """
+    Snapshot of the times of a file taken by a single syscall, as raw
+    nanosecond integers. Cheap to keep around for every file of a big tree,
+    converted to `datetime` only for display.
+
+    In this tool `ctime` is the creation (birth) time, as on Windows, and is
+    None where the OS/filesystem doesn't report it. It is never the POSIX
+    `st_ctime`, the inode change time, which can't be set and moves with
+    every rename or retime.
+    """
+    __slots__ = ('path', 'ctime_ns', 'mtime_ns', 'atime_ns')
+
+    def __init__(self, path : str, ctime_ns : Optional[int], mtime_ns : int, atime_ns : int):
+        self.path = path
+        self.ctime_ns = ctime_ns
+        self.mtime_ns = mtime_ns
+        self.atime_ns = atime_ns
+
+    @classmethod
+    def of_stat(cls, path : str, stat : os.stat_result) -> 'FileTimes':
+        return cls(path, birth_time_ns(stat), stat.st_mtime_ns, stat.st_atime_ns)
+
+    @classmethod
+    def of_path(cls, path : str) -> 'FileTimes':
+        if statx:
+            return statx_times(path)
+        return cls.of_stat(path, os.stat(path))
+
+    @classmethod
+    def of_entry(cls, entry : os.DirEntry) -> 'FileTimes':
+        # `DirEntry.stat()` is free on Windows, a syscall of its own elsewhere.
+        if statx:
+            return statx_times(entry.path)
+        return cls.of_stat(entry.path, entry.stat())
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.path)
+
+    def max_ns(self) -> int:
+        # Windows: Explorer shows `mtime` (TODO: ignore `atime`?).
+        # Mac: Finder shows "Date added" which isn't an attribute of the file entry.
+        # Linux, Mac: creation time can't be set, so it is left out, otherwise
+        # retimed files would still be newer than the cutoff.
+        if CTIME_SETTABLE and self.ctime_ns is not None:
+            return max(self.ctime_ns, self.mtime_ns, self.atime_ns)
+        return max(self.mtime_ns, self.atime_ns)
+
+    def times(self) -> tuple[Optional[int], int, int]:
+        return (self.ctime_ns, self.mtime_ns, self.atime_ns)
+
+    def datetimes(self) -> tuple[Optional[datetime.datetime], datetime.datetime, datetime.datetime]:
+        return (self.ctime_ns and ns_to_datetime(self.ctime_ns), ns_to_datetime(self.mtime_ns),
+                ns_to_datetime(self.atime_ns))
+
+def birth_time_ns(stat : os.stat_result) -> Optional[int]:
+    if hasattr(stat, 'st_birthtime_ns'):  # Windows (Python 3.12+), BSD
+        return stat.st_birthtime_ns
+    if hasattr(stat, 'st_birthtime'):  # Mac
+        return int(stat.st_birthtime * NS_PER_SEC)
+    if platform.system() == 'Windows':
+        return stat.st_ctime_ns
+    return None
+
+def read_file_times(files : Iterator[os.DirEntry], jobs : int = DEFAULT_JOBS) -> Iterator[FileTimes]:
+    """
+    `FileTimes` of the files in their order, read in batches on a pool of
+    `jobs` threads (the stat syscalls release the GIL).
+    """
+    if jobs <= 1:
+        yield from map(FileTimes.of_entry, files)
+        return
+    read_batch = lambda batch: [FileTimes.of_entry(entry) for entry in batch]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        files = iter(files)
+        while batch := list(itertools.islice(files, BATCH_SIZE)):
+            pending.append(executor.submit(read_batch, batch))
+            if len(pending) > 2 * jobs:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
 
 def retime_files(
-        files : list[os.DirEntry],
+        files : list[FileTimes],
         cutoff_time : datetime.datetime,
         spread_secs : int,
-        **kvargs):
-    offsets = (random.random() * (-spread_secs) for _ in files)
-    new_times = [cutoff_time + datetime.timedelta(milliseconds=1000*off) for off in offsets]
-
+        dry_run : bool,
+        verbose : bool,
+        journal : 'Journal' = None,
+        seed : Optional[int] = None) -> Optional[BatchSummary]:
+    plan = plan_retimes(files, datetime_to_ns(cutoff_time), spread_secs * NS_PER_SEC, seed)
+    if dry_run:
+        plan.show()
+        return None
+    return plan.apply(verbose, journal)
+
+class RetimePlan:
+    """
+    New times of files planned by --ceil-time. Times are columns of integer
+    nanoseconds, (ctime, mtime, atime) before and after, as NumPy arrays when
+    NumPy is available, `array('q')` otherwise. Unknown ctime is `NO_CTIME`.
+    """
+    def __init__(self, paths : list[str], old_times : tuple, new_times : tuple):
+        self.paths = paths
+        self.old_times = old_times
+        self.new_times = new_times
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def rows(self) -> Iterator[tuple[str, tuple[Optional[int], int, int], tuple[Optional[int], int, int]]]:
+        as_lists = lambda columns: [c.tolist() if numpy else list(c) for c in columns]
+        with_unknown = lambda times: (None if times[0] == NO_CTIME else times[0],) + times[1:]
+        for (path, old, new) in zip(self.paths, zip(*as_lists(self.old_times)), zip(*as_lists(self.new_times))):
+            yield (path, with_unknown(old), with_unknown(new))
+
+    def show(self, output_format : str = 'table', out = sys.stdout) -> None:
+        if output_format == 'csv':
+            writer = csv.writer(out)
+            writer.writerow(['path'] + [f"{when}_{time}_ns" for when in ['old', 'new']
+                                        for time in ['ctime', 'mtime', 'atime']])
+            writer.writerows([path, *old, *new] for (path, old, new) in self.rows())
+        elif output_format == 'jsonl':
+            for (path, old, new) in self.rows():
+                out.write(json.dumps({'path': path, 'old': old, 'new': new}) + '\n')
+        else:
+            for (path, old, new) in self.rows():
+                print(f"Simulating retiming of '{path}':{describe_time_changes(old, new)}", file=out)
+
+    def apply(self, verbose : bool, journal : 'Journal' = None) -> BatchSummary:
+        if journal:
+            # The whole plan goes to the journal first, --resume can then finish it without a rescan.
+            journal.log_all({'op': 'retime', 'path': os.path.abspath(path), 'old': old, 'new': new}
+                            for (path, old, new) in self.rows())
+            journal.sync()
+        failed = []
+        for (path, old, new) in self.rows():
+            try:
+                set_file_times(path, old, new, dry_run=False, verbose=verbose)
+            except OSError as e:
+                failed.append((path, e))
+        return BatchSummary(len(self), failed)
+
+def plan_retimes(files : list[FileTimes], cutoff_ns : int, spread_ns : int, seed : Optional[int] = None) -> RetimePlan:
+    """
+    Plans new times for all files at once: base times spread randomly within
+    `spread_ns` before the cutoff are assigned to the files in the order of
+    their current latest time, ctime (where settable) moves to the base, mtime
+    and atime follow 100-1000 ms apart. Times not after the cutoff are kept.
+    The same `seed` gives the same plan (with the same NumPy availability).
+    """
+    plan = _plan_retimes_numpy if numpy else _plan_retimes_array
+    return RetimePlan([f.path for f in files], *plan(files, cutoff_ns, spread_ns, seed))
+
+def _plan_retimes_numpy(files : list[FileTimes], cutoff_ns : int, spread_ns : int, seed : Optional[int]):
+    n = len(files)
+    rng = numpy.random.default_rng(seed)
+    column = lambda values: numpy.fromiter(values, dtype=numpy.int64, count=n)
+    ctime = column(NO_CTIME if f.ctime_ns is None else f.ctime_ns for f in files)
+    mtime = column(f.mtime_ns for f in files)
+    atime = column(f.atime_ns for f in files)
+
+    settable = (ctime != NO_CTIME) if CTIME_SETTABLE else numpy.zeros(n, dtype=bool)
+    max_time = numpy.where(settable, numpy.maximum(ctime, numpy.maximum(mtime, atime)), numpy.maximum(mtime, atime))
     # Preserve the relative time order of files after re-timing.
-    sorted_files = sorted(files, key=file_max_time)
-    sorted_new_times = sorted(new_times)
-
-    for file, new_base_time in zip(sorted_files, sorted_new_times):
-        retime_file(file, new_base_time, **kvargs)
-
-def retime_file(file : os.DirEntry, new_base_time : datetime.datetime, dry_run : bool, verbose : bool):
-    small_pos_delta = lambda: datetime.timedelta(milliseconds=random.randrange(100, 1000))
-
-    (cur_ctime, cur_mtime, cur_atime) = file_times(file)
-    # Determine which times need to be shifted backwards.
-    new_ctime = new_base_time                 if (cur_ctime > cutoff_time) else cur_ctime
-    new_mtime = new_ctime + small_pos_delta() if (cur_mtime > cutoff_time) else cur_mtime
-    new_atime = new_mtime + small_pos_delta() if (cur_atime > cutoff_time) else cur_atime
-
+    base = numpy.empty(n, dtype=numpy.int64)
+    base[numpy.argsort(max_time, kind='stable')] = numpy.sort(
+        cutoff_ns - (rng.random(n) * spread_ns).astype(numpy.int64))
+
+    new_ctime = numpy.where(settable & (ctime > cutoff_ns), base, ctime)
+    # Without a settable ctime, keep the new times around the base.
+    anchor = numpy.where(settable, new_ctime, base)
+    new_mtime = numpy.where(mtime > cutoff_ns, anchor + rng.integers(100, 1000, n) * NS_PER_MS, mtime)
+    new_atime = numpy.where(atime > cutoff_ns, new_mtime + rng.integers(100, 1000, n) * NS_PER_MS, atime)
+    return ((ctime, mtime, atime), (new_ctime, new_mtime, new_atime))
+
+def _plan_retimes_array(files : list[FileTimes], cutoff_ns : int, spread_ns : int, seed : Optional[int]):
+    n = len(files)
+    rng = random.Random(seed)
+    ctime = array.array('q', (NO_CTIME if f.ctime_ns is None else f.ctime_ns for f in files))
+    mtime = array.array('q', (f.mtime_ns for f in files))
+    atime = array.array('q', (f.atime_ns for f in files))
+
+    settable = [CTIME_SETTABLE and c != NO_CTIME for c in ctime]
+    max_time = [max(c, m, a) if s else max(m, a) for (s, c, m, a) in zip(settable, ctime, mtime, atime)]
+    # Preserve the relative time order of files after re-timing.
+    base = array.array('q', bytes(8 * n))
+    sorted_bases = sorted(cutoff_ns - int(rng.random() * spread_ns) for _ in range(n))
+    for (i, base_ns) in zip(sorted(range(n), key=max_time.__getitem__), sorted_bases):
+        base[i] = base_ns
+
+    new_ctime = array.array('q', (b if s and c > cutoff_ns else c for (s, c, b) in zip(settable, ctime, base)))
+    # Without a settable ctime, keep the new times around the base.
+    anchor = [nc if s else b for (s, nc, b) in zip(settable, new_ctime, base)]
+    new_mtime = array.array('q', (x + rng.randrange(100, 1000) * NS_PER_MS if m > cutoff_ns else m
+                                  for (m, x) in zip(mtime, anchor)))
+    new_atime = array.array('q', (nm + rng.randrange(100, 1000) * NS_PER_MS if a > cutoff_ns else a
+                                  for (a, nm) in zip(atime, new_mtime)))
+    return ((ctime, mtime, atime), (new_ctime, new_mtime, new_atime))
+
+def describe_time_changes(cur : tuple[Optional[int], int, int], new : tuple[Optional[int], int, int]) -> str:
     change_log = []
-    if cur_ctime != new_ctime: change_log.append(f"ctime {cur_ctime} -> {new_ctime}")
-    if cur_mtime != new_mtime: change_log.append(f"mtime {cur_mtime} -> {new_mtime}")
-    if cur_atime != new_atime: change_log.append(f"atime {cur_atime} -> {new_atime}")
+    for (name, cur_ns, new_ns) in zip(['ctime', 'mtime', 'atime'], cur, new):
+        if cur_ns != new_ns:
+            change_log.append(f"{name} {format_ns(cur_ns)} -> {format_ns(new_ns)}")
+    return ''.join(f"\n* {change}" for change in change_log)
+
+def set_file_times(
+        path : str,
+        cur : tuple[Optional[int], int, int],
+        new : tuple[Optional[int], int, int],
+        dry_run : bool,
+        verbose : bool):
+    """Changes (ctime, mtime, atime) of a file from `cur` to `new`, in nanoseconds."""
+    (cur_ctime_ns, cur_mtime_ns, cur_atime_ns) = cur
+    (new_ctime_ns, new_mtime_ns, new_atime_ns) = new
 
+    change_lines = describe_time_changes(cur, new)
     if dry_run:
-        print(f"Simulating retiming of '{file.path}':{'\n* ' + '\n* '.join(change_log)}")
+        print(f"Simulating retiming of '{path}':{change_lines}")
         return
 
-    if verbose: print(f"Retiming '{file.path}':{'\n* ' + '\n* '.join(change_log)}")
-    if cur_ctime != new_ctime:
+    if verbose: print(f"Retiming '{path}':{change_lines}")
+    if cur_ctime_ns != new_ctime_ns and new_ctime_ns is not None:
         # Creation time cannot be manipulated by Python directly. Using os-specific tricks.
-        if platform.system() == 'Windows':
+        if CTIME_SETTABLE:
             # https://superuser.com/questions/292630/how-can-i-change-the-timestamp-on-a-file
             run_powershell_expecting_success(
-                f"$(Get-Item '{powershell_escape_apostrophes(file.path)}').CreationTime = $(Get-Date '{new_ctime}')")
+                f"$(Get-Item '{powershell_escape_apostrophes(path)}').CreationTime = $(Get-Date '{ns_to_datetime(new_ctime_ns)}')")
         else:
-            print(f"Warning for '{file.name}': ctime change is not implemented for this OS", file=sys.stderr)
-    if (cur_mtime != new_mtime) or (cur_atime != new_atime):
-        os.utime(file.path, times=(new_atime.timestamp(), new_mtime.timestamp()))
-    log_file_times(file, desc='after retime') # debug only
+            print(f"Warning for '{os.path.basename(path)}': ctime change is not implemented for this OS", file=sys.stderr)
+    if (cur_mtime_ns != new_mtime_ns) or (cur_atime_ns != new_atime_ns):
+        os.utime(path, ns=(new_atime_ns, new_mtime_ns))
+    if verbose: log_file_times(path, desc='after retime')
 
 def powershell_escape_apostrophes(s : str) -> str:
     return s.replace("'", "''")
@@ -112,50 +497,212 @@ def run_powershell_expecting_success(cmd : str):
     if ret != 0:
         raise IOError(f"Error: PowerShell command '{cmd}' failed with error code {ret}.")
 
-def print_file_times(files : Iterator[os.DirEntry], base_dir : str):
-    def normalize_path(e : os.DirEntry):
-        result = os.path.relpath(e.path, base_dir)
-        if len(result) > 80:
-            result = result[:75] + "[...]"
-        return result
-
-    files = sorted(files, key=lambda f: f.path)
-    if not files:
-        return
-
-    max_norm_path_len = max(map(lambda f: len(normalize_path(f)), files))
-    fmt_time = "%Y-%m-%d %H:%M:%S.%f"
-    fmt_head = f"{{name:^{max_norm_path_len}}} | {{ctime:^26}} | {{mtime:^26}} | {{atime:^26}}"
-    fmt_body = f"{{name:<{max_norm_path_len}}} | {{ctime:{fmt_time}}} | {{mtime:{fmt_time}}} | {{atime:{fmt_time}}}"
-    print(fmt_head.format(name='File', ctime='ctime', mtime='mtime', atime='atime'))
-    for file in files:
-        (ctime, mtime, atime) = file_times(file)
-        print(fmt_body.format(name=normalize_path(file), ctime=ctime, mtime=mtime, atime=atime))
-
-def log_file_times(file : os.DirEntry, desc : str = ''):
-    to_time = lambda x: datetime.datetime.fromtimestamp(x)
-    stat = os.stat(file.path)  # Grab fresh stat.
+class Journal:
+    """
+    Write-ahead journal of renames and retimes, with absolute paths and the
+    original times, as JSON lines. A record reaches the OS before its operation starts, so an
+    interrupted run can be resumed or undone. The costly fsync happens only
+    every `JOURNAL_SYNC_RECORDS` records or `JOURNAL_SYNC_SECS` seconds, so a
+    power loss may lose the latest records.
+    """
+    def __init__(self, path : str, append : bool = False):
+        # Never overwrite a journal of another run, it may be the only way to undo it.
+        self.file = open(path, 'a' if append else 'x', encoding='utf-8')
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def log(self, record : dict) -> None:
+        self.log_all([record])
+
+    def log_all(self, records : Iterator[dict]) -> None:
+        with self.lock:
+            for record in records:
+                self.file.write(json.dumps(record) + '\n')
+                self.unsynced += 1
+            self.file.flush()
+            if self.unsynced >= JOURNAL_SYNC_RECORDS or time.monotonic() - self.last_sync >= JOURNAL_SYNC_SECS:
+                self._sync()
+
+    def sync(self) -> None:
+        with self.lock:
+            self._sync()
+
+    def _sync(self) -> None:
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def close(self) -> None:
+        self.sync()
+        self.file.close()
+
+    @staticmethod
+    def records(path : str) -> Iterator[dict]:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # The last record may have been cut off by a crash.
+                    pass
+
+def redo_operation(record : dict, dry_run : bool, verbose : bool) -> None:
+    if record['op'] == 'rename':
+        (src, dst) = (record['src'], record['dst'])
+        if os.path.lexists(src) and not os.path.lexists(dst):
+            if dry_run:
+                print(f"Simulating rename of '{src}'")
+                return
+            if verbose: print(f"Renaming '{src}'")
+            os.rename(src, dst)
+        if not dry_run and os.path.lexists(dst):
+            os.utime(dst, ns=(record['atime_ns'], record['mtime_ns']))
+    elif record['op'] == 'retime':
+        cur = FileTimes.of_path(record['path'])
+        # The ctime of a finished retime differs on systems that cannot set it.
+        if cur.times()[1:] != tuple(record['new'][1:]):
+            set_file_times(cur.path, cur.times(), tuple(record['new']), dry_run, verbose)
+
+def undo_operation(record : dict, dry_run : bool, verbose : bool) -> None:
+    if record['op'] == 'rename':
+        (src, dst) = (record['src'], record['dst'])
+        if os.path.lexists(dst) and not os.path.lexists(src):
+            if dry_run:
+                print(f"Simulating rename of '{dst}' back")
+                return
+            if verbose: print(f"Renaming '{dst}' back")
+            os.rename(dst, src)
+            os.utime(src, ns=(record['atime_ns'], record['mtime_ns']))
+    elif record['op'] == 'retime':
+        cur = FileTimes.of_path(record['path'])
+        # Leave files alone that changed since the run.
+        if cur.times()[1:] == tuple(record['new'][1:]):
+            set_file_times(cur.path, cur.times(), tuple(record['old']), dry_run, verbose)
+
+def replay_journal(
+        path : str,
+        operation : Callable[[dict, bool, bool], None],
+        dry_run : bool,
+        verbose : bool,
+        reverse : bool = False) -> BatchSummary:
+    """
+    Applies `operation` (`redo_operation` for --resume, `undo_operation` for
+    --undo) to the records of a journal. Both check the current state of each
+    file first, so replaying a journal again does no harm.
+    """
+    records = [r for r in Journal.records(path) if r['op'] in ('rename', 'retime')]
+    if reverse:
+        records.reverse()
+    failed = []
+    for record in records:
+        try:
+            operation(record, dry_run, verbose)
+        except OSError as e:
+            failed.append((record.get('path') or record['src'], e))
+    return BatchSummary(len(records), failed)
+
+class TimeRow(NamedTuple):
+    path : str  # Relative to the printed directory.
+    ctime_ns : Optional[int]
+    mtime_ns : int
+    atime_ns : int
+
+def time_rows(files : Iterator[os.DirEntry], base_dir : str, jobs : int = DEFAULT_JOBS) -> Iterator[TimeRow]:
+    for times in read_file_times(files, jobs):
+        yield TimeRow(os.path.relpath(times.path, base_dir), times.ctime_ns, times.mtime_ns, times.atime_ns)
+
+def sorted_externally(rows : Iterator[TimeRow], run_size : int = SORT_RUN_SIZE) -> Iterator[TimeRow]:
+    """
+    Sorts rows by path in bounded memory: sorted runs of `run_size` rows are
+    spilled to temporary files and merged. Rows that fit into one run are
+    just sorted in memory.
+    """
+    runs = []
+    try:
+        while True:
+            run = sorted(itertools.islice(rows, run_size))
+            if len(run) < run_size and not runs:
+                yield from run
+                return
+            if not run:
+                break
+            run_file = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+            run_file.writelines(json.dumps(row) + '\n' for row in run)
+            run_file.seek(0)
+            runs.append(run_file)
+        yield from heapq.merge(*((TimeRow(*json.loads(line)) for line in run_file) for run_file in runs))
+    finally:
+        for run_file in runs:
+            run_file.close()
+
+def print_file_times(
+        files : Iterator[os.DirEntry],
+        base_dir : str,
+        output_format : str = 'table',
+        sort : bool = False,
+        out = sys.stdout,
+        jobs : int = DEFAULT_JOBS):
+    """
+    Prints times of the files as the walk finds them, or sorted by path. The
+    table is for reading, CSV and JSON lines have exact nanosecond times.
+    """
+    rows = time_rows(files, base_dir, jobs)
+    if sort:
+        rows = sorted_externally(rows)
+
+    if output_format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(TimeRow._fields)
+        writer.writerows(rows)
+    elif output_format == 'jsonl':
+        for row in rows:
+            out.write(json.dumps(row._asdict()) + '\n')
+    else:
+        def normalize_path(path : str):
+            if len(path) > MAX_PATH_WIDTH:
+                path = path[:MAX_PATH_WIDTH - 5] + "[...]"
+            return path
+
+        # Widths cannot be measured before printing the first row, so the
+        # path column is as wide as the longest path allowed.
+        fmt_head = f"{{name:^{MAX_PATH_WIDTH}}} | {{ctime:^26}} | {{mtime:^26}} | {{atime:^26}}"
+        fmt_body = f"{{name:<{MAX_PATH_WIDTH}}} | {{ctime:<26}} | {{mtime:<26}} | {{atime:<26}}"
+        print(fmt_head.format(name='File', ctime='ctime', mtime='mtime', atime='atime'), file=out)
+        for row in rows:
+            print(fmt_body.format(name=normalize_path(row.path), ctime=format_ns(row.ctime_ns),
+                                  mtime=format_ns(row.mtime_ns), atime=format_ns(row.atime_ns)), file=out)
+
+def log_file_times(path : str, desc : str = ''):
+    fresh = FileTimes.of_path(path)  # Grab fresh stat.
     info = f" ({desc})" if desc else ""
-    print(f"Times of '{file.name}'{info}:")
-    print(f"  - st_atime = {to_time(stat.st_atime)}")
-    print(f"  - st_mtime = {to_time(stat.st_mtime)}")
-    print(f"  - st_ctime = {to_time(stat.st_ctime)}")
+    print(f"Times of '{fresh.name}'{info}:")
+    print(f"  - atime = {format_ns(fresh.atime_ns)}")
+    print(f"  - mtime = {format_ns(fresh.mtime_ns)}")
+    print(f"  - ctime = {format_ns(fresh.ctime_ns)}")
 
 def file_extension(entry : os.DirEntry) -> str:
-    ext_mo = re.match(r".*\.([^.]+)", entry.name)
+    return name_extension(entry.name)
+
+def name_extension(name : str) -> str:
+    ext_mo = re.match(r".*\.([^.]+)", name)
     return ext_mo and ext_mo.group(1).lower()
 
 def file_times(entry : os.DirEntry) -> tuple[datetime.datetime]:
-    ctime = datetime.datetime.fromtimestamp(entry.stat().st_ctime)
-    mtime = datetime.datetime.fromtimestamp(entry.stat().st_mtime)
-    atime = datetime.datetime.fromtimestamp(entry.stat().st_atime)
-    return (ctime, mtime, atime)
+    return FileTimes.of_entry(entry).datetimes()
 
 def file_max_time(entry : os.DirEntry) -> datetime.datetime:
-    # Windows: Explorer shows `mtime` (TODO: ignore `atime`?).
-    # Mac: Finder shows "Date added" which isn't an attribute of the file entry.
-    # Linux: TODO
-    return max(*file_times(entry))
+    return ns_to_datetime(FileTimes.of_entry(entry).max_ns())
+
+def format_ns(ns : Optional[int]) -> str:
+    return ns_to_datetime(ns).strftime("%Y-%m-%d %H:%M:%S.%f") if ns is not None else '-'
+
+def ns_to_datetime(ns : int) -> datetime.datetime:
+    (secs, rem_ns) = divmod(ns, NS_PER_SEC)
+    return datetime.datetime.fromtimestamp(secs) + datetime.timedelta(microseconds=rem_ns // 1000)
+
+def datetime_to_ns(dt : datetime.datetime) -> int:
+    return int(dt.replace(microsecond=0).timestamp()) * NS_PER_SEC + dt.microsecond * 1000
 
 def add_file_ext(name : str, ext : str):
     return f"{name}.{ext}"
@@ -188,6 +735,21 @@ if __name__ == '__main__':
     parser.add_argument('-r', '--recursive', action='store_true')
     parser.add_argument('-s', '--simulate', action='store_true')
     parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('--include', action='append', default=[], metavar='GLOB',
+                        help='only consider files matching the glob (repeatable)')
+    parser.add_argument('--exclude', action='append', default=[], metavar='GLOB',
+                        help='skip files and whole directories matching the glob, e.g. .git (repeatable)')
+    parser.add_argument('--max-depth', type=int, help='max depth of subdirectories with -r')
+    parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_JOBS,
+                        help=f'number of files renamed and directories listed in parallel (default {DEFAULT_JOBS})')
+    parser.add_argument('--watch', action='store_true',
+                        help='with --hide-mm/--unhide-mm, keep running and rename files as they appear')
+    parser.add_argument('--settle-secs', type=float, default=fswatch.DEFAULT_SETTLE_SECS,
+                        help='with --watch, rename a file once unchanged for this long'
+                        f' (default {fswatch.DEFAULT_SETTLE_SECS})')
+    parser.add_argument('--poll-secs', type=float, default=fswatch.DEFAULT_POLL_SECS,
+                        help='with --watch, interval of rescans where inotify is not available'
+                        f' (default {fswatch.DEFAULT_POLL_SECS})')
     parser.add_argument('--hide-mm', action='store_true', help='hide multi-media files')
     parser.add_argument('--unhide-mm', action='store_true', help='unhide multi-media files')
     parser.add_argument('--print-time', action='store_true', help='print timestamps of files')
@@ -195,29 +757,92 @@ if __name__ == '__main__':
                         ' E.g. "2024-08-01 12:00 - 0:30" will shift times of all files to be no'
                         ' no later than 12:00, spread out within 30 minutes, preserving relative'
                         ' order.')
-    parser.add_argument('dir', default='.')
+    parser.add_argument('--seed', type=int, help='seed of the random times of --ceil-time, for reproducible plans')
+    parser.add_argument('--format', choices=['table', 'csv', 'jsonl'], default='table',
+                        help='output format of --print-time and of the plan of --ceil-time with -s,'
+                        ' csv and jsonl have nanosecond times')
+    parser.add_argument('--sort', action='store_true',
+                        help='sort output of --print-time by path (otherwise printed as found)')
+    parser.add_argument('--journal', metavar='FILE',
+                        help='record renames and retimes with the original times to FILE (must not exist)')
+    parser.add_argument('--resume', action='store_true',
+                        help='finish the operations recorded in --journal, then continue the run')
+    parser.add_argument('--undo', action='store_true', help='revert the operations recorded in --journal')
+    parser.add_argument('dir', nargs='?', default='.')
 
     args = parser.parse_args()
 
     kwargs = {'dry_run': args.simulate, 'verbose': args.verbose}
-
-    if args.hide_mm or args.unhide_mm:
-        if args.hide_mm:
-            file_filter = lambda entry: file_extension(entry) in MEDIA_EXTENSIONS
-            renamer = partial(add_file_ext, ext=HIDDEN_EXTENSION)
-        elif args.unhide_mm:
-            file_filter = lambda entry: file_extension(entry) == HIDDEN_EXTENSION
-            renamer = partial(remove_file_ext, ext=HIDDEN_EXTENSION)
-        files_it = find_files(args.dir, file_filter, args.recursive)
-        rename_files_keeping_time(files_it, renamer, **kwargs)
-
-    elif args.ceil_time:
-        (cutoff_time, spread_secs) = args.ceil_time
-        file_filter = lambda entry: cutoff_time < file_max_time(entry)
-        files_it = find_files(args.dir, file_filter, args.recursive)
-        retime_files(list(files_it), cutoff_time, spread_secs, **kwargs)
-
-    elif args.print_time:
-        file_filter = lambda _: True  
-        files_it = find_files(args.dir, file_filter, args.recursive)
-        print_file_times(files_it, args.dir)
+    walk_options = {'include': args.include, 'exclude': args.exclude,
+                    'max_depth': args.max_depth, 'jobs': args.jobs}
+
+    if (args.resume or args.undo) and not args.journal:
+        parser.error('--resume and --undo need --journal')
+    if args.undo:
+        summary = replay_journal(args.journal, undo_operation, reverse=True, **kwargs)
+        print_batch_summary(summary, 'undo')
+        sys.exit(1 if summary.failed else 0)
+
+    failed = []
+    journal = None
+    if args.resume:
+        summary = replay_journal(args.journal, redo_operation, **kwargs)
+        print_batch_summary(summary, 'resume')
+        failed += summary.failed
+    if args.journal and not args.simulate:
+        try:
+            journal = Journal(args.journal, append=args.resume)
+        except FileExistsError:
+            parser.error(f"journal '{args.journal}' already exists, use --resume or --undo")
+        journal.log({'op': 'start', 'argv': sys.argv[1:]})
+        kwargs['journal'] = journal
+
+    try:
+        if args.hide_mm or args.unhide_mm:
+            if args.hide_mm:
+                name_filter = lambda name: name_extension(name) in MEDIA_EXTENSIONS
+                renamer = partial(add_file_ext, ext=HIDDEN_EXTENSION)
+            elif args.unhide_mm:
+                name_filter = lambda name: name_extension(name) == HIDDEN_EXTENSION
+                renamer = partial(remove_file_ext, ext=HIDDEN_EXTENSION)
+            file_filter = lambda entry: name_filter(entry.name)
+            if args.watch:
+                # Start watching first, files appearing during the initial pass aren't missed.
+                watcher = fswatch.open_watcher(args.dir, args.recursive, args.poll_secs, include=args.include,
+                                               exclude=args.exclude, max_depth=args.max_depth)
+            files_it = find_files(args.dir, file_filter, args.recursive, **walk_options)
+            summary = rename_files_keeping_time(files_it, renamer, jobs=args.jobs, **kwargs)
+            print_batch_summary(summary, 'rename')
+            failed += summary.failed
+            if args.watch:
+                try:
+                    watch_and_rename(watcher, name_filter, renamer, args.settle_secs, **kwargs)
+                except KeyboardInterrupt:
+                    pass
+                finally:
+                    watcher.close()
+
+        elif args.ceil_time and not args.resume:
+            # (A resumed run already finished the plan recorded in the journal.)
+            (cutoff_time, spread_secs) = args.ceil_time
+            cutoff_ns = datetime_to_ns(cutoff_time)
+            # Stat each file once, the snapshot serves the filtering, sorting and retiming.
+            times_it = read_file_times(find_files(args.dir, lambda _: True, args.recursive, **walk_options), args.jobs)
+            plan = plan_retimes([t for t in times_it if cutoff_ns < t.max_ns()],
+                                cutoff_ns, spread_secs * NS_PER_SEC, args.seed)
+            if args.simulate:
+                plan.show(args.format)
+            else:
+                summary = plan.apply(args.verbose, journal)
+                print_batch_summary(summary, 'retime')
+                failed += summary.failed
+
+        elif args.print_time:
+            file_filter = lambda _: True
+            files_it = find_files(args.dir, file_filter, args.recursive, **walk_options)
+            print_file_times(files_it, args.dir, args.format, args.sort, jobs=args.jobs)
+    finally:
+        if journal:
+            journal.close()
+    if failed:
+        sys.exit(1)
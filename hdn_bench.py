@@ -0,0 +1,92 @@
+# Benchmarks of hdn.py.
+#
+# rename: the serial path of renames against the parallel batched one. A local
+# filesystem answers renames in microseconds, so to resemble a network mount
+# every rename and utime is delayed by --latency-ms (the delay is injected by
+# wrapping `os.rename` and `os.utime`, it releases the GIL like real I/O does).
+#
+# plan: planning of --ceil-time for N synthetic files (no disk access), with
+# NumPy (if installed) and with the `array` fallback.
+#
+# Usage: python3 hdn_bench.py rename [--files N] [--dirs N] [--latency-ms MS] [--jobs N ...]
+#        python3 hdn_bench.py plan [--files N]
+
+import argparse
+import os
+import os.path
+import random
+import sys
+import tempfile
+import time
+
+from functools import partial
+
+import hdn
+
+
+def make_media_tree(root : str, file_count : int, dir_count : int) -> None:
+    for i in range(file_count):
+        directory = os.path.join(root, f"d{i % dir_count:03}")
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"clip{i:06}.mp4"), 'wb'):
+            pass
+
+def with_latency(func, latency_secs : float):
+    def delayed(*args, **kwargs):
+        time.sleep(latency_secs)
+        return func(*args, **kwargs)
+    return delayed
+
+def bench_hide(root : str, jobs : int) -> tuple[float, int]:
+    file_filter = lambda entry: hdn.file_extension(entry) in hdn.MEDIA_EXTENSIONS
+    renamer = partial(hdn.add_file_ext, ext=hdn.HIDDEN_EXTENSION)
+    files_it = hdn.find_files(root, file_filter, recurse=True)
+    start = time.perf_counter()
+    summary = hdn.rename_files_keeping_time(files_it, renamer, jobs=jobs, dry_run=False, verbose=False)
+    elapsed = time.perf_counter() - start
+    assert not summary.failed, summary.failed
+    return (elapsed, summary.processed)
+
+
+def bench_plan(file_count : int) -> None:
+    rng = random.Random(0)
+    cutoff_ns = 1_700_000_000 * hdn.NS_PER_SEC
+    files = [hdn.FileTimes(f"/media/clip{i:07}.mp4", None,
+                           cutoff_ns + rng.randrange(10**15), cutoff_ns + rng.randrange(10**15))
+             for i in range(file_count)]
+    numpy = hdn.numpy
+    for backend in ([numpy] if numpy else []) + [None]:
+        hdn.numpy = backend
+        start = time.perf_counter()
+        plan = hdn.plan_retimes(files, cutoff_ns, 1800 * hdn.NS_PER_SEC, seed=0)
+        elapsed = time.perf_counter() - start
+        print(f"{'numpy' if backend else 'array':>5} | {len(plan)} files planned in {elapsed:.3f} s")
+    hdn.numpy = numpy
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of hdn.py.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    rename = subparsers.add_parser('rename', help='serial against parallel renames')
+    rename.add_argument('--files', type=int, default=2000)
+    rename.add_argument('--dirs', type=int, default=20)
+    rename.add_argument('--latency-ms', type=float, default=2.0, help='delay of each rename and utime')
+    rename.add_argument('--jobs', type=int, nargs='+', default=[1, 4, hdn.DEFAULT_JOBS, 32])
+    plan = subparsers.add_parser('plan', help='planning of --ceil-time')
+    plan.add_argument('--files', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    if args.benchmark == 'plan':
+        bench_plan(args.files)
+        sys.exit(0)
+
+    os.rename = with_latency(os.rename, args.latency_ms / 1000)
+    os.utime = with_latency(os.utime, args.latency_ms / 1000)
+
+    print(f"{'Jobs':>4} | {'Time [s]':>9} | {'Files/s':>9} | Speedup")
+    serial_time = None
+    for jobs in args.jobs:
+        with tempfile.TemporaryDirectory() as root:
+            make_media_tree(root, args.files, args.dirs)
+            (elapsed, processed) = bench_hide(root, jobs)
+        serial_time = serial_time or elapsed
+        print(f"{jobs:>4} | {elapsed:>9.3f} | {processed / elapsed:>9.0f} | {serial_time / elapsed:.1f}x")
@@ -0,0 +1,205 @@
+import contextlib
+import datetime
+import io
+import os
+import os.path
+import tempfile
+import unittest
+
+from functools import partial
+
+import hdn
+
+
+class TestHdn(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = tmp.name
+
+    def write_file(self, rel_path, content=b'', mtime=None):
+        path = os.path.join(self.root, rel_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def media_files(self):
+        file_filter = lambda entry: hdn.file_extension(entry) in hdn.MEDIA_EXTENSIONS
+        return hdn.find_files(self.root, file_filter, recurse=True)
+
+    def hide(self, files, jobs, journal=None):
+        renamer = partial(hdn.add_file_ext, ext=hdn.HIDDEN_EXTENSION)
+        return hdn.rename_files_keeping_time(files, renamer, jobs=jobs, dry_run=False, verbose=False,
+                                             journal=journal)
+
+    def test_parallel_hide_keeps_times(self):
+        for i in range(50):
+            self.write_file(f"d{i % 5}/clip{i}.mp4", mtime=1000000000 + i)
+        self.write_file('d0/notes.txt')
+
+        summary = self.hide(self.media_files(), jobs=4)
+
+        self.assertEqual(summary.processed, 50)
+        self.assertEqual(summary.failed, [])
+        for i in range(50):
+            path = os.path.join(self.root, f"d{i % 5}/clip{i}.mp4.hdn")
+            self.assertEqual(os.stat(path).st_mtime, 1000000000 + i)
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'd0/notes.txt')))
+
+    def test_failures_are_collected(self):
+        for jobs in [1, 4]:
+            with self.subTest(jobs=jobs):
+                self.write_file(f"{jobs}/a/clip1.mp4")
+                self.write_file(f"{jobs}/a/clip2.mp4")
+                self.write_file(f"{jobs}/b/clip3.mp4")
+                files = [f for f in self.media_files() if f.path.startswith(os.path.join(self.root, str(jobs)))]
+                # Vanished before the rename.
+                os.remove(os.path.join(self.root, f"{jobs}/a/clip2.mp4"))
+
+                summary = self.hide(iter(files), jobs)
+
+                self.assertEqual(summary.processed, 3)
+                self.assertEqual([os.path.basename(path) for (path, _) in summary.failed], ['clip2.mp4'])
+                self.assertTrue(os.path.exists(os.path.join(self.root, f"{jobs}/b/clip3.mp4.hdn")))
+
+    def test_batches_never_span_directories(self):
+        for i in range(5):
+            self.write_file(f"a/clip{i}.mp4")
+        self.write_file('b/clip.mp4')
+
+        batches = list(hdn.batches_by_directory(self.media_files(), batch_size=3))
+
+        self.assertEqual(sorted(len(batch) for batch in batches), [1, 2, 3])
+        for batch in batches:
+            self.assertEqual(len({os.path.dirname(file.path) for file in batch}), 1)
+
+    def test_file_times_snapshot(self):
+        path = self.write_file('clip.mp4')
+        os.utime(path, ns=(1_600_000_000_123_456_789, 1_500_000_000_987_654_321))
+        entry = next(hdn.find_files(path, lambda _: True, recurse=False))
+
+        times = hdn.FileTimes.of_entry(entry)
+
+        self.assertEqual(times.atime_ns, 1_600_000_000_123_456_789)
+        self.assertEqual(times.mtime_ns, 1_500_000_000_987_654_321)
+        self.assertEqual(times.name, 'clip.mp4')
+        self.assertEqual(hdn.datetime_to_ns(hdn.ns_to_datetime(times.mtime_ns)), 1_500_000_000_987_654_000)
+
+    def test_retime_preserves_order_below_cutoff(self):
+        cutoff = datetime.datetime(2024, 8, 1, 12, 0)
+        cutoff_ns = hdn.datetime_to_ns(cutoff)
+        old_ns = cutoff_ns - 10 * 3600 * hdn.NS_PER_SEC
+        snapshot = lambda path, ns: hdn.FileTimes(path, None, ns, ns)
+        files = [snapshot(self.write_file(f"clip{i}.mp4"), cutoff_ns + (10 - i) * hdn.NS_PER_SEC)
+                 for i in range(10)]
+        old_path = self.write_file('old.mp4')
+        os.utime(old_path, ns=(old_ns, old_ns))
+        files.append(snapshot(old_path, old_ns))
+
+        with contextlib.redirect_stderr(io.StringIO()):
+            hdn.retime_files(files, cutoff, 1800, dry_run=False, verbose=False)
+
+        mtimes = [os.stat(os.path.join(self.root, f"clip{i}.mp4")).st_mtime_ns for i in range(10)]
+        self.assertEqual(mtimes, sorted(mtimes, reverse=True))
+        self.assertTrue(all(cutoff_ns - 1800 * hdn.NS_PER_SEC < t < cutoff_ns + 2 * hdn.NS_PER_SEC for t in mtimes))
+        self.assertEqual(os.stat(old_path).st_mtime_ns, old_ns)
+
+    def test_sorted_externally_merges_spilled_runs(self):
+        rows = [hdn.TimeRow(f"f{i:02}", i, i, i) for i in range(20)]
+        shuffled = rows[::3] + rows[1::3] + rows[2::3]
+
+        for run_size in [3, 20, 100]:
+            with self.subTest(run_size=run_size):
+                self.assertEqual(list(hdn.sorted_externally(iter(shuffled), run_size)), rows)
+
+    def test_print_time_csv_has_nanoseconds(self):
+        for name in ['b.mp4', 'a/c.txt']:
+            os.utime(self.write_file(name), ns=(3_000_000_001, 2_000_000_001))
+        out = io.StringIO()
+
+        hdn.print_file_times(hdn.find_files(self.root, lambda _: True, recurse=True), self.root,
+                             'csv', sort=True, out=out)
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'path,ctime_ns,mtime_ns,atime_ns')
+        self.assertEqual([line.split(',')[0] for line in lines[1:]], [os.path.join('a', 'c.txt'), 'b.mp4'])
+        self.assertEqual(lines[2].split(',')[2:], ['2000000001', '3000000001'])
+
+    def test_journal_undo_and_resume(self):
+        path = self.write_file('a/clip.mp4', mtime=1_000_000_000)
+        journal_path = os.path.join(self.root, 'journal.jsonl')
+        journal = hdn.Journal(journal_path)
+        summary = self.hide(self.media_files(), jobs=2, journal=journal)
+        journal.close()
+        self.assertEqual(summary.failed, [])
+        with self.assertRaises(FileExistsError):
+            hdn.Journal(journal_path)
+
+        summary = hdn.replay_journal(journal_path, hdn.undo_operation, dry_run=False, verbose=False, reverse=True)
+
+        self.assertEqual(summary, hdn.BatchSummary(1, []))
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(os.stat(path).st_mtime, 1_000_000_000)
+
+        # The journal now describes a rename that didn't happen, as after a crash.
+        hdn.replay_journal(journal_path, hdn.redo_operation, dry_run=False, verbose=False)
+
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(os.stat(path + '.hdn').st_mtime, 1_000_000_000)
+
+    @unittest.skipUnless(hdn.statx, 'statx is Linux only')
+    def test_statx_times_match_stat(self):
+        path = self.write_file('clip.mp4')
+        os.utime(path, ns=(1_600_000_000_123_456_789, 1_500_000_000_987_654_321))
+        stat = os.stat(path)
+
+        times = hdn.statx_times(path)
+
+        self.assertEqual((times.mtime_ns, times.atime_ns), (stat.st_mtime_ns, stat.st_atime_ns))
+        # Birth time, unlike st_ctime, isn't moved by the utime.
+        if times.ctime_ns is not None:
+            self.assertLessEqual(times.ctime_ns, stat.st_ctime_ns)
+        with self.assertRaises(FileNotFoundError):
+            hdn.statx_times(path + '.missing')
+
+    def test_read_file_times_keeps_order(self):
+        for i in range(200):
+            os.utime(self.write_file(f"d{i // 50}/f{i:03}"), ns=(i, i))
+        entries = list(hdn.find_files(self.root, lambda _: True, recurse=True))
+
+        times = list(hdn.read_file_times(iter(entries), jobs=4))
+
+        self.assertEqual([t.path for t in times], [e.path for e in entries])
+        self.assertEqual([t.mtime_ns for t in times], list(range(200)))
+
+    def test_plan_retimes_with_and_without_numpy(self):
+        cutoff_ns = 2_000_000_000 * hdn.NS_PER_SEC
+        spread_ns = 600 * hdn.NS_PER_SEC
+        files = [hdn.FileTimes(f"f{i}", None, cutoff_ns + (i % 7 + 1) * hdn.NS_PER_SEC, cutoff_ns - i)
+                 for i in range(100)]
+        backends = [None, hdn.numpy] if hdn.numpy else [None]
+        self.addCleanup(setattr, hdn, 'numpy', hdn.numpy)
+
+        for backend in backends:
+            with self.subTest(numpy=bool(backend)):
+                hdn.numpy = backend
+                rows = list(hdn.plan_retimes(files, cutoff_ns, spread_ns, seed=1).rows())
+
+                self.assertEqual(rows, list(hdn.plan_retimes(files, cutoff_ns, spread_ns, seed=1).rows()))
+                self.assertNotEqual(rows, list(hdn.plan_retimes(files, cutoff_ns, spread_ns, seed=2).rows()))
+                for (path, old, new) in rows:
+                    # Unknown ctime stays unknown, atime not after the cutoff stays.
+                    self.assertEqual((new[0], new[2]), (None, old[2]))
+                    self.assertTrue(cutoff_ns - spread_ns < new[1] < cutoff_ns + hdn.NS_PER_SEC)
+                # Files keep their order, up to the < 1 s the mtime is put after the base time.
+                new_mtimes = [new[1] for (_, _, new) in sorted(rows, key=lambda row: row[1][1])]
+                for (earlier, later) in zip(new_mtimes, new_mtimes[1:]):
+                    self.assertGreater(later, earlier - hdn.NS_PER_SEC)
+
+
+if __name__ == '__main__':
+    unittest.main()